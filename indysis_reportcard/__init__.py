@@ -41,5 +41,9 @@ class ReportCardAppConfig(AppConfig):
     name = 'indysis_reportcard'
     verbose_name = 'Report card'
 
+    def ready(self):
+        # Connect cache invalidation signals
+        from indysis_reportcard import access, grading, pdf_cache, template_cache  # noqa: F401
+
 
 default_app_config = 'indysis_reportcard.ReportCardAppConfig'
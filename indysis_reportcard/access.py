@@ -0,0 +1,261 @@
+"""Which teachers may edit what, per term.
+
+Working out whether a teacher may edit a section, subject or student took a
+multi-join query at every call site, often inside loops over the template or
+the class list.  AccessIndex reads a term's access rules once, with the
+classes, students and template grades they refer to, and answers those
+questions from memory.
+
+Indexes are kept per process and keyed on a generation number shared by
+every process (see indysis_reportcard.shared).  Changing an access rule,
+class membership, student, template or template structure bumps the
+generation, so the next lookup in any process rebuilds.  Indexes are also
+rebuilt after REPORTCARD_ACCESS_INDEX_TIMEOUT seconds.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from indysis_reportcard import shared
+from indysis_reportcard.models import (ReportCardAccess, ReportCardSection, ReportCardSubject, ReportCardTemplate,
+                                       ReportCardTerm)
+from sis.studentdb.models import Student, StudentClass, StudentClassTeacher
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'reportcard-access-generation'
+TIMEOUT = getattr(settings, 'REPORTCARD_ACCESS_INDEX_TIMEOUT', 300)
+
+_lock = threading.Lock()
+_indexes = {}
+
+Rule = namedtuple('Rule', 'id teachers sections subjects classes')
+
+
+class AccessIndex(object):
+    """The access rules of one term, resolved to ids.
+
+    teacher arguments may be a User or Faculty, or None for an administrator,
+    who may see and edit everything.
+    """
+
+    def __init__(self, term_id):
+        self.term_id = term_id
+        self.subject_section = {}
+        self.section_subjects = defaultdict(list)
+        self.section_template = {}
+        self.template_grades = defaultdict(set)
+        self.rules = []
+        self.class_year = {}
+        self.class_students = defaultdict(set)
+        self.students = {}
+
+    @classmethod
+    def build(cls, term_id):
+        index = cls(term_id)
+        index._load_structure()
+        index._load_rules()
+        index._load_classes()
+        logger.debug("Built access index for term %s: %d rules, %d students", term_id, len(index.rules),
+                     len(index.students))
+        return index
+
+    def _load_structure(self):
+        for section_id, template_id in ReportCardSection.objects.filter(
+                template__reportcardterm=self.term_id).values_list('id', 'template_id'):
+            self.section_template[section_id] = template_id
+        for subject_id, section_id in ReportCardSubject.objects.filter(
+                section__template__reportcardterm=self.term_id).order_by('sortorder').values_list('id', 'section_id'):
+            self.subject_section[subject_id] = section_id
+            self.section_subjects[section_id].append(subject_id)
+        for template_id, grade_id in ReportCardTemplate.grades.through.objects.filter(
+                reportcardtemplate__reportcardterm=self.term_id).values_list('reportcardtemplate_id', 'gradelevel_id'):
+            self.template_grades[template_id].add(grade_id)
+
+    def _load_rules(self):
+        def related(through, field, keep=None):
+            found = defaultdict(set)
+            for rule_id, value in through.objects.values_list('reportcardaccess_id', field):
+                if keep is None or value in keep:
+                    found[rule_id].add(value)
+            return found
+
+        sections = related(ReportCardAccess.sections.through, 'reportcardsection_id', self.section_template)
+        subjects = related(ReportCardAccess.subjects.through, 'reportcardsubject_id', self.subject_section)
+        teachers = related(ReportCardAccess.teachers.through, 'faculty_id')
+        classes = related(ReportCardAccess.student_classes.through, 'studentclass_id')
+        for rule_id in sorted(set(sections) | set(subjects)):
+            self.rules.append(Rule(rule_id, frozenset(teachers[rule_id]), frozenset(sections[rule_id]),
+                                   frozenset(subjects[rule_id]), frozenset(classes[rule_id])))
+
+    def _load_classes(self):
+        class_ids = {class_id for rule in self.rules for class_id in rule.classes}
+        for class_id, school_year_id in StudentClass.objects.filter(id__in=class_ids).values_list(
+                'id', 'school_year_id'):
+            self.class_year[class_id] = school_year_id
+        for class_id, student_id in StudentClass.students.through.objects.filter(
+                studentclass__in=class_ids).values_list('studentclass_id', 'student_id'):
+            self.class_students[class_id].add(student_id)
+        student_ids = {student_id for ids in self.class_students.values() for student_id in ids}
+        for student_id, year_id, is_active in Student.objects.filter(id__in=student_ids).values_list(
+                'id', 'year_id', 'is_active'):
+            self.students[student_id] = (year_id, is_active)
+
+    def teacher_rules(self, teacher):
+        """The rules that apply to a teacher; every rule for None."""
+        if teacher is None:
+            return self.rules
+        return [rule for rule in self.rules if teacher.id in rule.teachers]
+
+    def rule_subjects(self, rule):
+        """Subjects a rule covers, directly or through one of its sections."""
+        subjects = set(rule.subjects)
+        for section_id in rule.sections:
+            subjects.update(self.section_subjects[section_id])
+        return subjects
+
+    def rule_grades(self, rule):
+        """Grades of the templates whose sections or subjects the rule covers."""
+        grades = set()
+        for section_id in set(rule.sections) | {self.subject_section[subject_id] for subject_id in rule.subjects}:
+            grades |= self.template_grades[self.section_template[section_id]]
+        return grades
+
+    def subject_grades(self, subject_id):
+        """Grades of the subject's template; none for a subject not in the term."""
+        template_id = self.section_template.get(self.subject_section.get(subject_id))
+        return self.template_grades.get(template_id, set())
+
+    def may_edit_section(self, teacher, section_id):
+        """Whether a rule gives the teacher the section, or one of its subjects."""
+        if teacher is None:
+            return True
+        return any(section_id in rule.sections or
+                   any(self.subject_section[subject_id] == section_id for subject_id in rule.subjects)
+                   for rule in self.teacher_rules(teacher))
+
+    def subject_ids(self, teacher=None):
+        """Subjects covered by the rules that apply to a teacher."""
+        subjects = set()
+        for rule in self.teacher_rules(teacher):
+            subjects |= self.rule_subjects(rule)
+        return subjects
+
+    def teaches(self, teacher, subject_id):
+        return subject_id in self.subject_ids(teacher)
+
+    def subject_student_ids(self, subject_id, teacher=None):
+        """Students in the classes of the rules that give the teacher the subject."""
+        students = set()
+        for rule in self.teacher_rules(teacher):
+            if subject_id in self.rule_subjects(rule):
+                for class_id in rule.classes:
+                    students |= self.class_students[class_id]
+        return students
+
+    def student_ids(self, teacher=None, school_year=None):
+        """Active students with a grade in this school year's classes that the teacher's rules cover.
+
+        A student is only included through a rule covering a template for their grade.
+        """
+        students = set()
+        for rule in self.teacher_rules(teacher):
+            grades = self.rule_grades(rule)
+            for class_id in rule.classes:
+                if school_year is not None and self.class_year.get(class_id) != school_year.id:
+                    continue
+                for student_id in self.class_students[class_id]:
+                    year_id, is_active = self.students[student_id]
+                    if is_active and year_id is not None and year_id in grades:
+                        students.add(student_id)
+        return students
+
+    def subject_grade_pairs(self, teacher=None):
+        """(subject id, grade id) for each grade in a rule's classes that has the rule's subject."""
+        pairs = set()
+        for rule in self.teacher_rules(teacher):
+            years = {self.students[student_id][0] for class_id in rule.classes
+                     for student_id in self.class_students[class_id]}
+            for subject_id in self.rule_subjects(rule):
+                for grade_id in years & self.subject_grades(subject_id):
+                    pairs.add((subject_id, grade_id))
+        return pairs
+
+
+def generation():
+    """The current generation; changes whenever access may have changed."""
+    return shared.generation(GENERATION_KEY)
+
+
+def invalidate():
+    """Make every process rebuild its indexes on next use."""
+    shared.bump(GENERATION_KEY)
+
+
+def get_index(term):
+    """The access index for a term or term id."""
+    term_id = getattr(term, 'id', term)
+    current = generation()
+    with _lock:
+        entry = _indexes.get(term_id)
+    if entry is not None and entry[0] == current and time.time() - entry[1] < TIMEOUT:
+        return entry[2]
+    index = AccessIndex.build(term_id)
+    with _lock:
+        _indexes[term_id] = (current, time.time(), index)
+    return index
+
+
+def clear():
+    with _lock:
+        _indexes.clear()
+
+
+@receiver([post_save, post_delete], sender=ReportCardAccess)
+@receiver([post_save, post_delete], sender=ReportCardSection)
+@receiver([post_save, post_delete], sender=ReportCardSubject)
+@receiver([post_save, post_delete], sender=ReportCardTemplate)
+@receiver([post_save, post_delete], sender=StudentClass)
+@receiver([post_save, post_delete], sender=StudentClassTeacher)
+@receiver(post_delete, sender=Student)
+def access_changed(sender, **kwargs):
+    invalidate()
+
+
+STUDENT_FIELDS = ('year_id', 'is_active')
+
+
+@receiver(pre_save, sender=Student)
+def student_saving(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Note whether the save changes a student's grade or active flag, the only fields the index uses."""
+    instance._access_changed = True
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not {'year', 'year_id', 'is_active'} & set(update_fields):
+        instance._access_changed = False
+        return
+    saved = Student.objects.filter(pk=instance.pk).values_list(*STUDENT_FIELDS).first()
+    instance._access_changed = saved != tuple(getattr(instance, field) for field in STUDENT_FIELDS)
+
+
+@receiver(post_save, sender=Student)
+def student_saved(sender, instance, created=False, **kwargs):
+    if created or getattr(instance, '_access_changed', True):
+        invalidate()
+
+
+@receiver(m2m_changed, sender=ReportCardAccess.teachers.through)
+@receiver(m2m_changed, sender=ReportCardAccess.subjects.through)
+@receiver(m2m_changed, sender=ReportCardAccess.sections.through)
+@receiver(m2m_changed, sender=ReportCardAccess.student_classes.through)
+@receiver(m2m_changed, sender=ReportCardTemplate.grades.through)
+@receiver(m2m_changed, sender=ReportCardTerm.templates.through)
+@receiver(m2m_changed, sender=StudentClass.students.through)
+def membership_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate()
@@ -0,0 +1,65 @@
+"""Archive of the final PDFs for a closed term.
+
+Closing a term renders every report card in it once.  Each PDF is stored
+under a path unique to the archive together with its SHA-256, and the
+archive keeps a JSON manifest of what it holds.  Reopening the term marks
+the archive stale, after which cards are rendered live again until the term
+is closed and a new archive is built.
+"""
+import hashlib
+import json
+import logging
+
+from django.core.files.base import ContentFile
+from unidecode import unidecode
+
+from indysis_reportcard.models import ReportCardArchive, ReportCardArchiveItem
+
+logger = logging.getLogger(__name__)
+
+
+def checksum(pdf):
+    return hashlib.sha256(pdf).hexdigest()
+
+
+def lookup(reportcard):
+    """The archived PDF for a report card, or None.
+
+    The file is only returned if it still matches the checksum recorded
+    when it was archived.
+    """
+    if reportcard.term.is_open:
+        return None
+    item = ReportCardArchiveItem.objects.filter(
+        reportcard=reportcard, archive__state=ReportCardArchive.COMPLETE).order_by('-archive__created').first()
+    if item is None:
+        return None
+    try:
+        with item.pdf.open('rb') as archived:
+            pdf = archived.read()
+    except (IOError, OSError):
+        logger.warning("Archived report card %s is missing", item.pdf.name, exc_info=True)
+        return None
+    if checksum(pdf) != item.sha256:
+        logger.error("Archived report card %s does not match its checksum", item.pdf.name)
+        return None
+    return pdf
+
+
+def add(archive, result):
+    """Store one successfully rendered BatchResult in the archive."""
+    item = ReportCardArchiveItem(archive=archive, reportcard=result.reportcard,
+                                 sha256=checksum(result.pdf), size=len(result.pdf))
+    item.pdf.save(unidecode(result.filename).replace('/', '-'), ContentFile(result.pdf), save=False)
+    item.save()
+    return item
+
+
+def write_manifest(archive):
+    """Record the archive contents as JSON."""
+    archive.manifest = json.dumps([
+        dict(reportcard=item.reportcard_id, student=item.reportcard.student_id, file=item.pdf.name,
+             sha256=item.sha256, size=item.size)
+        for item in archive.items.select_related('reportcard').order_by('reportcard__student__last_name',
+                                                                          'reportcard__student__first_name')
+    ], indent=1)
@@ -0,0 +1,274 @@
+"""Bulk loading of everything a report card template needs.
+
+Rendering a card used to query entry by entry and subject by subject, so the
+query count grew with both the size of the template and the number of cards.
+ReportCardBundle.load() fetches the same data for a list of report cards in a
+fixed number of queries and hands back per-card lookup dicts.
+"""
+from collections import OrderedDict, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, IntegerField, Prefetch, Q, Sum, When
+
+from indysis_reportcard.models import (ReportCard, ReportCardCompletion, ReportCardEntry, ReportCardSection,
+                                       ReportCardStrand, ReportCardSubject, ReportCardTemplate,
+                                       ReportCardTemplateImage, ReportCardTerm, ReportCardYearGradeContent)
+from indysis_reportcard.teachers import get_resolver
+from sis.attendance.models import StudentAttendance
+from sis.studentdb.models import Faculty, TeacherHomeroom
+
+ENTRY_RELATED = ('choice', 'second_choice', 'section__gradingscheme', 'section__second_gradingscheme',
+                 'subject', 'strand')
+
+
+class ReportCardBundle(object):
+    """The data for rendering one report card."""
+
+    def __init__(self, reportcard):
+        self.reportcard = reportcard
+        self.data = {}
+        self.element_to_entry = {}
+        self.element_to_past = OrderedDict()
+        self.term_objects = []
+        self.teachers_by_subject = {}
+        self.grading_schemes = []
+        self.head = None
+        self.assistant_head = None
+        self.static_content = None
+        self.images = {}
+
+    @property
+    def elements(self):
+        """Sections, subjects and strands of the template, in order."""
+        for section in self.reportcard.template.sections:
+            yield section
+            for subject in section.subjects:
+                yield subject
+                for strand in subject.strands:
+                    yield strand
+
+    @property
+    def subject_teachers(self):
+        """Teachers by subject name, as used by the report card templates."""
+        teachers = {}
+        for subject in self.teachers_by_subject:
+            if subject.name_en:
+                teachers[subject.name_en.replace(" ", "_").lower()] = self.teachers_by_subject[subject]
+        for subject in self.teachers_by_subject:
+            if subject.name_fr:
+                teachers[subject.name_fr.replace(" ", "_").lower()] = self.teachers_by_subject[subject]
+        return teachers
+
+    @classmethod
+    def load(cls, reportcards):
+        """Load bundles for a list of report cards, returned in the same order."""
+        ids = [rc.id for rc in reportcards]
+        reportcards = ReportCard.objects.filter(id__in=ids).select_related(
+            'student__year', 'term__term', 'term__school_year', 'template__shared_template')
+        by_id = {rc.id: rc for rc in reportcards}
+        bundles = [cls(by_id[rc_id]) for rc_id in ids]
+        if not bundles:
+            return bundles
+
+        _load_templates(bundles)
+        _load_entries(bundles)
+        _load_past_entries(bundles)
+        _load_teachers(bundles)
+        _load_school_year(bundles)
+        _load_data(bundles)
+
+        images = {image.name: image for image in ReportCardTemplateImage.objects.all()}
+        for bundle in bundles:
+            bundle.images = images
+        return bundles
+
+
+def _load_templates(bundles):
+    """Share one prefetched copy of each template's structure between the cards using it."""
+    templates = ReportCardTemplate.objects.filter(
+        id__in={bundle.reportcard.template_id for bundle in bundles}
+    ).select_related('shared_template').prefetch_related(
+        Prefetch('reportcardsection_set', queryset=ReportCardSection.objects.select_related(
+            'gradingscheme', 'second_gradingscheme').order_by('sortorder')),
+        Prefetch('reportcardsection_set__reportcardsubject_set',
+                 queryset=ReportCardSubject.objects.order_by('sortorder')),
+        Prefetch('reportcardsection_set__reportcardsubject_set__reportcardstrand_set',
+                 queryset=ReportCardStrand.objects.order_by('sortorder')),
+    )
+    templates = {template.id: template for template in templates}
+    schemes = {}
+    for template in templates.values():
+        seen = OrderedDict()
+        for section in template.sections:
+            seen.setdefault(section.gradingscheme_id, section.gradingscheme)
+        schemes[template.id] = list(seen.values())
+
+    for bundle in bundles:
+        bundle.reportcard.template = templates[bundle.reportcard.template_id]
+        bundle.grading_schemes = schemes[bundle.reportcard.template_id]
+
+
+def _entry_key(entry):
+    return entry.section_id, entry.subject_id, entry.strand_id
+
+
+def _element_key(element):
+    if isinstance(element, ReportCardStrand):
+        return element.subject.section_id, element.subject_id, element.id
+    if isinstance(element, ReportCardSubject):
+        return element.section_id, element.id, None
+    return element.id, None, None
+
+
+def _fetch_entries(bundles):
+    found = defaultdict(dict)
+    for entry in ReportCardEntry.objects.filter(
+            reportcard__in=[bundle.reportcard for bundle in bundles]).select_related(*ENTRY_RELATED).order_by('id'):
+        # The lowest id wins where there are duplicates, as in get_or_create_reportcard_entry
+        found[entry.reportcard_id].setdefault(_entry_key(entry), entry)
+    return found
+
+
+def _load_entries(bundles):
+    """Entries for every element of each card's template, creating any that are missing."""
+    found = _fetch_entries(bundles)
+    missing = []
+    for bundle in bundles:
+        for element in bundle.elements:
+            key = _element_key(element)
+            if key not in found[bundle.reportcard.id]:
+                section_id, subject_id, strand_id = key
+                missing.append(ReportCardEntry(reportcard=bundle.reportcard, section_id=section_id,
+                                               subject_id=subject_id, strand_id=strand_id))
+    if missing:
+        try:
+            with transaction.atomic():
+                ReportCardEntry.objects.bulk_create(missing)
+        except IntegrityError:
+            # Someone else created some of them; fall back to creating one at a time
+            for bundle in bundles:
+                bundle.reportcard.template.get_or_create_all_entries(bundle.reportcard)
+        ReportCardCompletion.refresh({entry.reportcard_id for entry in missing})
+        found = _fetch_entries(bundles)
+
+    complete = defaultdict(list)
+    for bundle in bundles:
+        entries = found[bundle.reportcard.id]
+        bundle.element_to_entry = {element: entries[_element_key(element)] for element in bundle.elements
+                                   if _element_key(element) in entries}
+        template = bundle.reportcard.template
+        if bundle.reportcard.entries_version != template.structure_version and \
+                all(_element_key(element) in entries for element in bundle.elements):
+            complete[template.structure_version].append(bundle.reportcard.id)
+    for version, ids in complete.items():
+        ReportCard.objects.filter(id__in=ids).update(entries_version=version)
+
+
+def _load_past_entries(bundles):
+    """Entries from earlier terms of the same school year, as ReportCard.get_past_terms."""
+    terms = list(ReportCardTerm.objects.filter(
+        school_year__in={bundle.reportcard.term.school_year_id for bundle in bundles},
+        number__lt=max(bundle.reportcard.term.number for bundle in bundles),
+    ).order_by('number'))
+
+    past_reportcards = {}
+    for rc_id, student_id, term_id in ReportCard.objects.filter(
+            student__in={bundle.reportcard.student_id for bundle in bundles},
+            term__in=terms).order_by('id').values_list('id', 'student_id', 'term_id'):
+        past_reportcards.setdefault((student_id, term_id), rc_id)
+
+    past_entries = defaultdict(list)
+    for entry in ReportCardEntry.objects.filter(
+            reportcard__in=set(past_reportcards.values())).select_related(*ENTRY_RELATED).order_by('id'):
+        past_entries[entry.reportcard_id].append(entry)
+
+    for bundle in bundles:
+        term = bundle.reportcard.term
+        bundle.term_objects = [t for t in terms if t.school_year_id == term.school_year_id
+                               and t.number < term.number and t.interim == term.interim]
+        for past_term in bundle.term_objects:
+            rc_id = past_reportcards.get((bundle.reportcard.student_id, past_term.id))
+            bundle.element_to_past[past_term.number] = {
+                entry.most_specific_element: entry for entry in past_entries.get(rc_id, ())
+            }
+
+
+def _load_teachers(bundles):
+    """Teachers for each subject and student, as ReportCardSubject.teachers(student)."""
+    by_term = defaultdict(list)
+    for bundle in bundles:
+        by_term[bundle.reportcard.term_id].append(bundle)
+    for term_id, term_bundles in by_term.items():
+        resolver = get_resolver(term_id)
+        resolver.resolve([bundle.reportcard.student_id for bundle in term_bundles])
+        for bundle in term_bundles:
+            bundle.teachers_by_subject = resolver.by_subject(
+                bundle.reportcard.student_id,
+                [subject for subject in bundle.elements if isinstance(subject, ReportCardSubject)])
+
+
+def _load_school_year(bundles):
+    """Head and assistant head, and the static content for each grade."""
+    school_years = {bundle.reportcard.term.school_year for bundle in bundles}
+    heads = {teacher.id: teacher for teacher in Faculty.objects.filter(
+        user_ptr__in=[user_id for school_year in school_years
+                      for user_id in (school_year.principal_id, school_year.vice_principal_id) if user_id])}
+
+    content = {}
+    for item in ReportCardYearGradeContent.objects.filter(
+            school_year__in=school_years,
+            grade_level__in={bundle.reportcard.student.year_id for bundle in bundles}).order_by('-id'):
+        content[(item.school_year_id, item.grade_level_id)] = item
+
+    for bundle in bundles:
+        school_year = bundle.reportcard.term.school_year
+        bundle.head = heads.get(school_year.principal_id)
+        bundle.assistant_head = heads.get(school_year.vice_principal_id)
+        bundle.static_content = content.get((school_year.id, bundle.reportcard.student.year_id))
+
+
+def _attendance(students, term):
+    """Absences and lates for the term and school year, per student, as Student.days_absent/times_late."""
+    def count(condition):
+        return Sum(Case(When(condition, then=1), default=0, output_field=IntegerField()))
+
+    in_term = Q(date__gte=term.term.start_date, date__lte=term.term.end_date)
+    in_year = Q(date__gte=term.school_year.start_date, date__lte=term.school_year.end_date)
+    late = Q(status__tardy=True, status__excused=False)
+    rows = StudentAttendance.objects.filter(student__in=students).filter(in_term | in_year).values(
+        'student').order_by().annotate(
+        term_half=count(in_term & Q(status__half=True)),
+        term_absent=count(in_term & Q(status__absent=True)),
+        year_half=count(in_year & Q(status__half=True)),
+        year_absent=count(in_year & Q(status__absent=True)),
+        term_late=count(in_term & late),
+        year_late=count(in_year & late),
+    )
+    attendance = {student: dict(TermAbsences=0.0, YearAbsences=0.0, TermLates=0, YearLates=0)
+                  for student in students}
+    for row in rows:
+        attendance[row['student']] = dict(
+            TermAbsences=row['term_half'] * 0.5 + row['term_absent'] * 1.0,
+            YearAbsences=row['year_half'] * 0.5 + row['year_absent'] * 1.0,
+            TermLates=row['term_late'],
+            YearLates=row['year_late'],
+        )
+    return attendance
+
+
+def _load_data(bundles):
+    """ReportCard.data, with attendance and homeroom teachers counted for all cards at once."""
+    homeroom_teachers = {}
+    for homeroom in TeacherHomeroom.objects.filter(
+            grade_level__in={bundle.reportcard.student.year_id for bundle in bundles},
+            primary=True, teacher__is_active=True).select_related('teacher').order_by('-id'):
+        homeroom_teachers[homeroom.grade_level_id] = homeroom.teacher
+
+    by_term = defaultdict(list)
+    for bundle in bundles:
+        by_term[bundle.reportcard.term].append(bundle)
+    for term, term_bundles in by_term.items():
+        attendance = _attendance({bundle.reportcard.student_id for bundle in term_bundles}, term)
+        for bundle in term_bundles:
+            bundle.data = bundle.reportcard.get_data(attendance=attendance[bundle.reportcard.student_id],
+                                                     homeroom_teachers=homeroom_teachers)
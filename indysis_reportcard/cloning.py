@@ -0,0 +1,122 @@
+"""Copying templates, terms and access rules in bulk.
+
+sis.studentdb.models.duplicate saves each copy on its own and adds its
+many-to-many relations one item at a time.  Cloner copies a whole level of
+the report card hierarchy (templates, then their sections, subjects and
+strands) with one bulk insert, and the level's many-to-many relations with
+one insert per relation.  Foreign keys and many-to-many relations that point
+at something copied earlier are pointed at the copy instead.  Cloner.ids maps
+each model to {old id: new id}.
+"""
+import copy
+from collections import defaultdict
+
+from django.db import connection, models, transaction
+
+from indysis_reportcard import access
+from indysis_reportcard.models import ReportCardSection, ReportCardStrand, ReportCardSubject
+
+
+class Cloner(object):
+    """Copies objects level by level, keeping the old to new id map."""
+
+    def __init__(self):
+        self.ids = defaultdict(dict)
+
+    def copy(self, objects, changes=None, parent=None):
+        """Copy objects, applying changes ({field: value, or a function of the original}).
+
+        parent names the foreign key to a model copied earlier; new ids are
+        read back through it where the database does not return them.
+        Without one each object is saved on its own.
+        """
+        objects = list(objects)
+        if not objects:
+            return []
+        model = type(objects[0])
+        remap = [field for field in model._meta.concrete_fields
+                 if isinstance(field, models.ForeignKey) and field.related_model in self.ids]
+        copies = []
+        for obj in objects:
+            new = copy.copy(obj)
+            new.pk = None
+            for field in remap:
+                old = getattr(obj, field.attname)
+                setattr(new, field.attname, self.ids[field.related_model].get(old, old))
+            for name, value in (changes or {}).items():
+                setattr(new, name, value(obj) if callable(value) else value)
+            copies.append(new)
+
+        if parent is None:
+            for new in copies:
+                new.save()
+        else:
+            model.objects.bulk_create(copies)
+            if not connection.features.can_return_ids_from_bulk_insert:
+                # Everything under the new parents was just inserted, in this order
+                field = model._meta.get_field(parent)
+                new_ids = model.objects.filter(**{
+                    field.attname + '__in': {getattr(new, field.attname) for new in copies}
+                }).order_by('pk').values_list('pk', flat=True)
+                for new, pk in zip(copies, new_ids):
+                    new.pk = pk
+
+        ids = {obj.pk: new.pk for obj, new in zip(objects, copies)}
+        self.ids[model].update(ids)
+        self._copy_m2m(model, ids)
+        return copies
+
+    def _copy_m2m(self, model, ids):
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            if not through._meta.auto_created:
+                continue
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_name() + '_id'
+            targets = self.ids.get(field.related_model, {})
+            through.objects.bulk_create([
+                through(**{source: ids[old], target: targets.get(value, value)})
+                for old, value in through.objects.filter(**{source + '__in': list(ids)}).values_list(source, target)
+            ])
+
+
+@transaction.atomic
+def clone_templates(templates, cloner=None, changes=None):
+    """Copy templates with their sections, subjects and strands.  Returns the Cloner."""
+    cloner = cloner or Cloner()
+    templates = list(templates)
+    cloner.copy(templates, changes=changes)
+    old_templates = [template.pk for template in templates]
+    cloner.copy(ReportCardSection.objects.filter(template__in=old_templates).order_by('id'), parent='template')
+    cloner.copy(ReportCardSubject.objects.filter(section__template__in=old_templates).order_by('id'),
+                parent='section')
+    cloner.copy(ReportCardStrand.objects.filter(subject__section__template__in=old_templates).order_by('id'),
+                parent='subject')
+    return cloner
+
+
+@transaction.atomic
+def clone_access(rules, cloner=None, changes=None):
+    """Copy access rules, onto copied sections and subjects where there are any.  Returns the Cloner."""
+    cloner = cloner or Cloner()
+    cloner.copy(rules, changes=changes)
+    transaction.on_commit(access.invalidate)
+    return cloner
+
+
+@transaction.atomic
+def clone_terms(terms, cloner=None, changes=None):
+    """Copy terms, closed and not yet opened, onto copied templates where there are any.  Returns the Cloner."""
+    cloner = cloner or Cloner()
+    reset = dict(is_open=False, open_state='', open_progress=0, open_total=0, open_failures='', open_finished=None)
+    reset.update(changes or {})
+    cloner.copy(terms, changes=reset)
+    return cloner
+
+
+def clone_year_grade_content(contents, cloner=None, changes=None):
+    """Copy static report card content.  Returns the Cloner."""
+    cloner = cloner or Cloner()
+    cloner.copy(contents, changes=changes)
+    return cloner
+
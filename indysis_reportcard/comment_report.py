@@ -0,0 +1,171 @@
+"""The grids of a grade's comment report, for the HTML, PDF and CSV outputs.
+
+Building the grids entry by entry took a few queries per report card for
+every section and subject.  CommentReport loads the grade's entries in one
+query, with the template structure and the subject teachers alongside, and
+pivots them into the same grids in memory.
+"""
+from collections import defaultdict
+
+from django.db.models import Q
+
+from indysis_reportcard.models import ReportCardEntry
+from sis.studentdb.models import Faculty
+
+CSV_HEADER = ['Subject', 'Teacher(s)', 'Student', 'Marks', 'Comments']
+
+
+class CommentReport(object):
+    """Section and subject grids of one grade's report cards in a term."""
+
+    def __init__(self, term, grade):
+        self.term = term
+        self.grade = grade
+        self.reportcards = list(term.reportcard_set.filter(student__year=grade).select_related(
+            'student', 'template').order_by('id'))
+        # (reportcard, section, subject) -> entries of the subject itself, or of the section if subject is None
+        self.own = defaultdict(list)
+        # (reportcard, section) -> entries of the section's graded subjects
+        self.graded_subjects = defaultdict(list)
+        # (reportcard, section, subject) -> entries of the subject's strands
+        self.strands = defaultdict(list)
+        self.sections = []
+        self.subjects = defaultdict(list)
+        self._load()
+
+    def _load(self):
+        if not self.reportcards:
+            return
+        for element, (section_id, subject_id, strand_id) in self.reportcards[0].template.elements():
+            if subject_id is None:
+                self.sections.append(element)
+            elif strand_id is None:
+                self.subjects[section_id].append(element)
+
+        for entry in ReportCardEntry.objects.filter(reportcard__in=self.reportcards).select_related(
+                'choice', 'subject', 'strand').order_by('id'):
+            if entry.strand_id is not None:
+                self.strands[(entry.reportcard_id, entry.section_id, entry.subject_id)].append(entry)
+            else:
+                self.own[(entry.reportcard_id, entry.section_id, entry.subject_id)].append(entry)
+                if entry.subject_id is not None and entry.subject.graded:
+                    self.graded_subjects[(entry.reportcard_id, entry.section_id)].append(entry)
+        for entries in self.graded_subjects.values():
+            entries.sort(key=lambda entry: entry.subject.sortorder)
+        for entries in self.strands.values():
+            entries.sort(key=lambda entry: entry.strand.sortorder)
+
+    @staticmethod
+    def mark_or_grade(section, entry):
+        if section.gradingscheme.percentile and not entry.choice:
+            return entry.percentile if entry.percentile is not None else ''
+        else:
+            if not entry.choice:
+                return '-'
+            if entry.strand:
+                language = entry.strand.rc_language
+            else:
+                language = entry.subject.rc_language
+            return getattr(entry.choice, 'name_' + language)
+
+    def section_grid(self, section):
+        students = {reportcard.id: reportcard.student for reportcard in self.reportcards}
+        items = [entry for reportcard in self.reportcards
+                 for entry in self.own[(reportcard.id, section.id, None)]]
+        items.sort(key=lambda entry: (students[entry.reportcard_id].last_name,
+                                      students[entry.reportcard_id].first_name))
+        return [{
+            "student": students[item.reportcard_id],
+            "marks": [(mark.subject.name, self.mark_or_grade(section, mark))
+                      for mark in self.graded_subjects[(item.reportcard_id, section.id)]],
+            "comments": item.comment}
+            for item in items]
+
+    def subject_grid(self, section, subject):
+        out = []
+        for reportcard in self.reportcards:
+            own = self.own[(reportcard.id, section.id, subject.id)]
+            subjectent = own[0] if own else None
+
+            marks = []
+            comments = []
+
+            if subject.comments_area:
+                if subject.comments_area and subjectent:
+                    comments.append(subjectent.comment
+                                    if subjectent.comment is not None else '')
+                if subject.graded and subjectent:
+                    marks.append((subject.rc_label,
+                                  self.mark_or_grade(section, subjectent)))
+            for strand in self.strands[(reportcard.id, section.id, subject.id)]:
+                if strand.strand.graded:
+                    marks.append((strand.strand.rc_label,
+                                  self.mark_or_grade(section, strand)))
+
+            out.append({"student": reportcard.student, "marks": marks,
+                        "comments": "\n\n".join(comments)})
+        return out
+
+    def subject_teachers(self):
+        """Teachers of each subject, as ReportCardEntry.get_teachers(), in one query."""
+        sections = {section.id for section in self.sections}
+        subjects = {subject.id for subject in self.all_subjects()}
+        by_section = defaultdict(set)
+        by_subject = defaultdict(set)
+        for teacher_id, section_id, subject_id in Faculty.objects.filter(
+                Q(reportcardaccess__sections__in=sections) | Q(reportcardaccess__subjects__in=subjects)
+        ).values_list('id', 'reportcardaccess__sections', 'reportcardaccess__subjects'):
+            if section_id in sections:
+                by_section[section_id].add(teacher_id)
+            if subject_id in subjects:
+                by_subject[subject_id].add(teacher_id)
+        faculty = list(Faculty.objects.filter(id__in={teacher_id for ids in list(by_section.values()) +
+                                                      list(by_subject.values()) for teacher_id in ids}))
+        return {subject: [teacher for teacher in faculty
+                          if teacher.id in by_section[subject.section_id] | by_subject[subject.id]]
+                for subject in self.all_subjects()}
+
+    def all_subjects(self):
+        return [subject for section in self.sections for subject in self.subjects[section.id]]
+
+    def data(self):
+        """The grade and a list of headed grids, as used by comment_report_template.html."""
+        subjects = []
+        data = {
+            "grade": self.grade.name,
+            "subjects": subjects,
+        }
+        if not self.reportcards:
+            return data
+
+        first = self.reportcards[0]
+        teachers = self.subject_teachers()
+        homeroom_teacher = None
+        if any(section.comments_area for section in self.sections):
+            homeroom_teacher = first.student.homeroom_teacher
+
+        for section in self.sections:
+            if section.comments_area:
+                subjects.append({
+                    "name": section.name,
+                    "grid": self.section_grid(section),
+                    "teacher": homeroom_teacher,
+                })
+            for subject in self.subjects[section.id]:
+                subject_teachers = ""
+                if self.own[(first.id, section.id, subject.id)]:
+                    subject_teachers = " and ".join(teacher.fullname_nocomma for teacher in teachers[subject])
+                subjects.append({
+                    "name": subject.name,
+                    "grid": self.subject_grid(section, subject),
+                    "teacher": subject_teachers,
+                })
+        return data
+
+    def rows(self):
+        """CSV rows: a header, then one row per student in each grid."""
+        yield CSV_HEADER
+        for subject in self.data()["subjects"]:
+            for row in subject["grid"]:
+                yield [subject["name"], subject["teacher"] or '', row["student"].fullname,
+                       "; ".join("%s: %s" % mark for mark in row["marks"]), row["comments"] or '']
@@ -0,0 +1,34 @@
+"""Merging entries that stand for the same element of a report card.
+
+Used by the check_reportcards command to repair duplicates, and when moving
+report cards to another template maps two entries onto one element.
+"""
+from indysis_reportcard.models import ReportCardEntry
+
+VALUE_FIELDS = ('percentile', 'choice_id', 'second_percentile', 'second_choice_id', 'comment', 'completed')
+
+
+def filled(entry):
+    return sum(1 for field in VALUE_FIELDS[:-1] if getattr(entry, field) not in (None, ''))
+
+
+def best(entries):
+    """The entry whose values to keep: the completed, then the fullest, then the most recently changed."""
+    return max(entries, key=lambda entry: (entry.completed, filled(entry), entry.modified, entry.id))
+
+
+def plan(entries):
+    """(keep, source, others) for entries of one element: the lowest id is kept, with the best values."""
+    entries = sorted(entries, key=lambda entry: entry.id)
+    return entries[0], best(entries), entries[1:]
+
+
+def merge(merges):
+    """Apply (keep, source, others) merges: copy source's values to keep and delete the others."""
+    for keep, source, others in merges:
+        if source is not keep:
+            ReportCardEntry.objects.filter(pk=keep.pk).update(
+                modified=source.modified, **{field: getattr(source, field) for field in VALUE_FIELDS})
+            for field in VALUE_FIELDS + ('modified',):
+                setattr(keep, field, getattr(source, field))
+        ReportCardEntry.objects.filter(pk__in=[entry.pk for entry in others]).delete()
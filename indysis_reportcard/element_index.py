@@ -0,0 +1,90 @@
+"""In-memory lookup of a report card's entries for the rc_item template tags.
+
+Custom templates pick entries out by section, subject and strand, given by
+name, field code or sortorder, and used to run a query for every lookup.
+ElementIndex loads a card's entries once and answers the same lookups from
+memory, matching exactly as the old queries did.
+"""
+from indysis_reportcard.bundle import ENTRY_RELATED
+from indysis_reportcard.models import ReportCardEntry
+
+# The raw columns the old queries compared against, not the translated attributes
+ROW_FIELDS = ('id',
+              'section__name', 'section__field_code', 'section__sortorder',
+              'subject_id', 'subject__name', 'subject__field_code', 'subject__sortorder',
+              'strand_id', 'strand__text', 'strand__field_code', 'strand__sortorder')
+
+
+def _iexact(value, param):
+    if param is None:
+        return value is None
+    return value is not None and str(value).upper() == str(param).upper()
+
+
+def _sortorder(param):
+    """The sortorder a parameter also matches, if it is a plain number."""
+    try:
+        if str(int(param)) == param:
+            return int(param)
+    except ValueError:
+        pass
+    return None
+
+
+class ElementIndex(object):
+    """Entries of one report card, looked up by section, subject and strand."""
+
+    def __init__(self, reportcard, entries=()):
+        self.reportcard_id = reportcard.id
+        self.entries = {entry.id: entry for entry in entries}
+        self.rows = None
+        self.cache = {}
+
+    def load(self):
+        self.rows = list(ReportCardEntry.objects.filter(
+            reportcard_id=self.reportcard_id).order_by('id').values_list(*ROW_FIELDS))
+        missing = [row[0] for row in self.rows if row[0] not in self.entries]
+        if missing:
+            self.entries.update(
+                (entry.id, entry)
+                for entry in ReportCardEntry.objects.filter(id__in=missing).select_related(*ENTRY_RELATED))
+
+    def get(self, section, subject, strand):
+        """The lowest id entry matching, as rc_item's query did, or None."""
+        key = (section, subject, strand)
+        if key not in self.cache:
+            if self.rows is None:
+                self.load()
+            match = self._matcher(section, subject, strand)
+            entry_id = next((row[0] for row in self.rows if match(row)), None)
+            self.cache[key] = self.entries.get(entry_id)
+        return self.cache[key]
+
+    @staticmethod
+    def _matcher(section, subject, strand):
+        # Mirrors the Q objects rc_item used to build, including a sortorder
+        # match on subject or strand being OR'ed onto everything before it.
+        section_order = _sortorder(section)
+        subject_order = _sortorder(subject) if subject else None
+        strand_order = _sortorder(strand) if strand else None
+
+        def match(row):
+            (_, section_name, section_code, section_sortorder,
+             subject_id, subject_name, subject_code, subject_sortorder,
+             strand_id, strand_text, strand_code, strand_sortorder) = row
+            result = (_iexact(section_name, section) or _iexact(section_code, section) or
+                      (section_order is not None and section_sortorder == section_order))
+            if subject:
+                result = result and (_iexact(subject_name, subject) or _iexact(subject_code, subject))
+                if subject_order is not None:
+                    result = result or subject_sortorder == subject_order
+            else:
+                result = result and subject_id is None
+            if strand:
+                result = result and (_iexact(strand_text, strand) or _iexact(strand_code, strand))
+                if strand_order is not None:
+                    result = result or strand_sortorder == strand_order
+            else:
+                result = result and strand_id is None
+            return result
+        return match
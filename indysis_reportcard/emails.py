@@ -0,0 +1,192 @@
+"""Report card emails.
+
+Each report card is rendered once and attached to a message per recipient.
+Messages are delivered in batches over one connection (SMTP) or one
+authorised Gmail service, and report cards are marked as emailed together
+once their messages have gone.
+"""
+import logging
+import os
+
+import reversion
+from constance import config
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.utils.text import slugify
+from raven.contrib.django.raven_compat.models import client
+
+from indysis_reportcard import template_cache
+from indysis_reportcard.google import GmailSender
+from indysis_reportcard.models import ReportCard
+from indysis_reportcard.rendering import render_batch, rendered_context
+
+EMAIL_BATCH_SIZE = getattr(settings, 'REPORTCARD_EMAIL_BATCH_SIZE', 50)
+
+
+def sender_address():
+    return config.REPORT_CARD_SENDER_EMAIL or settings.DEFAULT_REPORT_CARD_SENDER_EMAIL
+
+
+def reportcard_messages(student, term, pdf, data, recipients, bcc_ok=False):
+    """Build one message per recipient for a rendered report card."""
+    filename = '%s.pdf' % slugify(student.fullname)
+    message_body = template_cache.render_field(term, 'email_body_template', data)
+    subject = template_cache.render_field(term, 'email_subject_template', data)
+
+    html = get_template("email_wrapper.html").render({
+        "school_name": config.SCHOOL_NAME,
+        "content": message_body,
+    })
+
+    result = []
+    for to in recipients:
+        msg = EmailMultiAlternatives(
+            subject=subject,
+            body=message_body,
+            from_email=sender_address(),
+            to=[to])
+        msg.attach_alternative(html, "text/html")
+
+        if bcc_ok and config.REPORT_CARD_BCC_EMAIL:
+            msg.bcc.append(config.REPORT_CARD_BCC_EMAIL)
+        msg.attach(filename=filename, content=pdf, mimetype="application/pdf")
+        result.append(msg)
+    return result
+
+
+class ReportCardMailer(object):
+    """Sends messages in batches over one connection, recording which report cards went out."""
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or EMAIL_BATCH_SIZE
+        self.pending = []
+        self.sent = 0
+        self.emailed = []
+        self.failed = []
+        self.connection = None
+        self.gmail = None
+        if os.environ.get('NO_EMAIL'):
+            self.method = 'none'
+        elif config.REPORT_CARD_GMAIL and config.REPORT_CARD_SENDER_EMAIL:
+            self.method = 'gmail'
+        else:
+            self.method = 'smtp'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, student, messages, reportcard=None):
+        """Queue a student's messages; reportcard is marked as emailed once they are sent."""
+        self.pending.append((student, messages, reportcard))
+        if sum(len(item[1]) for item in self.pending) >= self.batch_size:
+            self.flush()
+
+    def _deliver(self, messages):
+        """Send messages; returns the error for each, None if it was sent."""
+        if self.method == 'gmail':
+            if self.gmail is None:
+                self.gmail = GmailSender.get()
+            return self.gmail.send_messages(messages)
+        elif self.method == 'smtp':
+            return [self._send_smtp(msg) for msg in messages]
+        return [None] * len(messages)
+
+    def _send_smtp(self, msg):
+        """Send one message over the shared connection; returns its error, None if it was sent."""
+        try:
+            if self.connection is None:
+                self.connection = get_connection()
+                self.connection.open()
+            sent = self.connection.send_messages([msg])
+        except Exception as e:
+            # The connection may be broken; open a new one for the next message
+            connection, self.connection = self.connection, None
+            try:
+                if connection is not None:
+                    connection.close()
+            except Exception:
+                logging.warning("Unable to close the mail connection", exc_info=True)
+            return e
+        return None if sent else "Not accepted by the mail server"
+
+    def flush(self):
+        """Send the queued messages."""
+        pending, self.pending = self.pending, []
+        messages = [msg for student, student_messages, reportcard in pending for msg in student_messages]
+        if not messages:
+            return
+        try:
+            errors = dict(zip(map(id, messages), self._deliver(messages)))
+        except Exception:
+            logging.exception("Unable to send %d report card emails", len(messages))
+            client.captureException()
+            self.failed += [student for student, student_messages, reportcard in pending]
+            return
+
+        for student, student_messages, reportcard in pending:
+            failed = [msg for msg in student_messages if errors[id(msg)] is not None]
+            for msg in failed:
+                logging.error("Unable to send report card for %s to %s: %s", student.fullname, msg.to[0],
+                              errors[id(msg)])
+            if failed:
+                self.failed.append(student)
+            for msg in student_messages:
+                if msg in failed:
+                    continue
+                self.sent += 1
+                logging.info("%s report card using %s to %s",
+                             'DID NOT send' if self.method == 'none' else 'Sent', self.method, msg.to[0],
+                             extra={
+                                 "from": msg.from_email,
+                                 "to": msg.to[0],
+                                 "subject": msg.subject,
+                                 "student": student.id,
+                                 "student_name": student.fullname,
+                                 "grade": student.year.name
+                             })
+            if reportcard is not None and not failed:
+                self.emailed.append(reportcard)
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.gmail is not None:
+            logging.info("Gmail sender: %s", self.gmail.metrics())
+        set_emailed(self.emailed)
+
+
+def set_emailed(reportcards):
+    """Set ReportCard.emailed on many report cards, as one revision."""
+    if not reportcards:
+        return
+    with reversion.create_revision():
+        reversion.set_comment("Emailed")
+        ReportCard.objects.filter(id__in=[rc.id for rc in reportcards]).update(emailed=True)
+        for reportcard in reportcards:
+            reportcard.emailed = True
+            reversion.add_to_revision(reportcard)
+
+
+def email_reportcards(students, term, recipients, mark_emailed=False, base_url=None, bcc_ok=False):
+    """Email report cards, rendering each student's card once for all of its recipients.
+
+    recipients maps student id to a list of addresses.  Returns the mailer,
+    whose sent, emailed and failed attributes describe the outcome.
+    """
+    with ReportCardMailer() as mailer:
+        for result in render_batch(students, term, base_url=base_url):
+            if not result.ok:
+                logging.error("Unable to email report card for %s: %s", result.student.fullname, result.error)
+                mailer.failed.append(result.student)
+                continue
+            data = rendered_context(result.reportcard, result.prepared, base_url=base_url)
+            messages = reportcard_messages(result.student, term, result.pdf, data,
+                                           recipients[result.student.id], bcc_ok=bcc_ok)
+            mailer.add(result.student, messages, result.reportcard if mark_emailed else None)
+    return mailer
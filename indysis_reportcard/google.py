@@ -1,7 +1,13 @@
 import base64
+import hashlib
 import json
+import logging
+import threading
+import time
+from collections import deque
 from json import JSONDecodeError
 
+from django.conf import settings
 from django.core.mail import EmailMessage
 from googleapiclient import discovery
 from httplib2 import Http
@@ -12,45 +18,170 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.send',
 ]
 
+# Gmail recommends no more than 50 requests in a batch
+BATCH_SIZE = getattr(settings, 'REPORTCARD_GMAIL_BATCH_SIZE', 50)
+# Collect messages locally instead of sending them
+USE_STUB = getattr(settings, 'REPORTCARD_GMAIL_STUB', False)
+
 
 class NotConfigured(Exception):
     """Improperly Configured"""
     pass
 
 
+class SendError(Exception):
+    """A message could not be sent."""
+
+
+def encode_message(message: EmailMessage):
+    body = message.message().as_bytes()
+    return {'raw': base64.urlsafe_b64encode(body).decode('utf-8')}
+
+
+class GmailApiTransport(object):
+    """Sends through the Gmail API, one service per process, refreshing the token when it expires."""
+
+    def __init__(self, sender, credentials_json):
+        self.sender = sender
+        self.credentials_json = credentials_json
+        self.credentials = None
+        self.service = None
+
+    def get_credentials(self):
+        """Delegated credentials, reused until the access token expires."""
+        if self.credentials is None:
+            try:
+                credentials = ServiceAccountCredentials.from_json_keyfile_dict(
+                    json.loads(self.credentials_json), scopes=SCOPES)
+            except JSONDecodeError:
+                if self.credentials_json in (None, ""):
+                    raise NotConfigured("GOOGLE_SYNC_CREDENTIALS not set")
+                else:
+                    raise NotConfigured("Invalid GOOGLE_SYNC_CREDENTIALS")
+            self.credentials = credentials.create_delegated(self.sender)
+        if self.credentials.access_token is None or self.credentials.access_token_expired:
+            self.credentials.get_access_token()
+        return self.credentials
+
+    def get_service(self):
+        credentials = self.get_credentials()
+        if self.service is None:
+            self.service = discovery.build('gmail', 'v1', http=credentials.authorize(Http()),
+                                           cache_discovery=False)
+        return self.service
+
+    def send(self, bodies):
+        """Send encoded messages in one batch request.  Returns an exception or None for each."""
+        service = self.get_service()
+        results = [None] * len(bodies)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception
+
+        batch = service.new_batch_http_request(callback=callback)
+        for i, body in enumerate(bodies):
+            batch.add(service.users().messages().send(userId=self.sender, body=body), request_id=str(i))
+        batch.execute()
+        return results
+
+
+class StubTransport(object):
+    """Collects messages instead of sending them, for testing without Google.
+
+    Set fail to a collection of recipient addresses to simulate failures.
+    """
+
+    def __init__(self, fail=()):
+        self.outbox = []
+        self.fail = set(fail)
+
+    def send(self, bodies):
+        results = []
+        for body in bodies:
+            message = base64.urlsafe_b64decode(body['raw'].encode('utf-8'))
+            if any(address.encode('utf-8') in message for address in self.fail):
+                results.append(SendError("Simulated failure"))
+            else:
+                self.outbox.append(message)
+                results.append(None)
+        return results
+
+
 class GmailSender(object):
+    """Sends report card emails through Gmail as REPORT_CARD_SENDER_EMAIL.
+
+    Use GmailSender.get() for the process-wide sender, which keeps its
+    credentials and API service between messages.  Latency of each recent
+    message is kept in latencies; see metrics().
+    """
 
-    @staticmethod
-    def get_credentials():
-        """Get credentials from google using service acccount."""
+    _senders = {}
+    _senders_lock = threading.Lock()
+
+    def __init__(self, transport, batch_size=None):
+        self.transport = transport
+        self.batch_size = batch_size or BATCH_SIZE
+        self.latencies = deque(maxlen=10000)
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """The sender for the current configuration, shared within this process."""
         if config.REPORT_CARD_SENDER_EMAIL in (None, ''):
             raise NotConfigured("REPORT_CARD_SENDER_EMAIL not set")
+        credentials = config.GOOGLE_SYNC_CREDENTIALS or ''
+        key = (config.REPORT_CARD_SENDER_EMAIL, hashlib.sha256(credentials.encode('utf-8')).hexdigest())
+        with cls._senders_lock:
+            if key not in cls._senders:
+                if USE_STUB:
+                    transport = StubTransport()
+                else:
+                    transport = GmailApiTransport(config.REPORT_CARD_SENDER_EMAIL, credentials)
+                cls._senders[key] = cls(transport)
+            return cls._senders[key]
 
-        try:
-            credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-                json.loads(config.GOOGLE_SYNC_CREDENTIALS), scopes=SCOPES)
-            delegated_credentials = credentials.create_delegated(config.REPORT_CARD_SENDER_EMAIL)
-        except JSONDecodeError:
-            if config.GOOGLE_SYNC_CREDENTIALS in (None, ""):
-                raise NotConfigured("GOOGLE_SYNC_CREDENTIALS not set")
-            else:
-                raise NotConfigured("Invalid GOOGLE_SYNC_CREDENTIALS")
-        http = delegated_credentials.authorize(Http())
-        delegated_credentials.get_access_token()  # Tests token
-        return http
+    def send_messages(self, messages):
+        """Send messages in batches.  Returns the error for each message, None if it was sent."""
+        errors = []
+        with self.lock:
+            for start in range(0, len(messages), self.batch_size):
+                bodies = [encode_message(message) for message in messages[start:start + self.batch_size]]
+                started = time.time()
+                try:
+                    results = self.transport.send(bodies)
+                except Exception as e:
+                    # Earlier batches went out; only this one failed
+                    logging.exception("Unable to send %d messages through Gmail", len(bodies))
+                    results = [e] * len(bodies)
+                # A batch is one round trip, so its messages share its latency
+                elapsed = time.time() - started
+                self.latencies.extend([elapsed] * len(bodies))
+                errors += results
+        self.errors += sum(1 for error in errors if error is not None)
+        return errors
 
-    @classmethod
-    def get_gmail_service(cls, creds=None):
-        if not creds:
-            creds = cls.get_credentials()
-        service = discovery.build('gmail', 'v1', http=creds, cache_discovery=False)
-        return service
+    def send(self, message: EmailMessage):
+        """Send one message, raising its error if it fails."""
+        error, = self.send_messages([message])
+        if error is not None:
+            raise error
+
+    def metrics(self):
+        """Count, error count and latency summary in seconds for the messages sent so far."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return dict(count=0, errors=self.errors)
+        return dict(
+            count=len(latencies),
+            errors=self.errors,
+            mean=sum(latencies) / len(latencies),
+            p50=latencies[len(latencies) // 2],
+            p95=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            max=latencies[-1],
+        )
 
     @classmethod
-    def send_email(cls, message: EmailMessage, creds=None):
-        if not creds:
-            creds = cls.get_credentials()
-        gmail = cls.get_gmail_service(creds)
-        body = message.message().as_bytes()
-        b64body = {'raw': base64.urlsafe_b64encode(body).decode('utf-8')}
-        gmail.users().messages().send(userId=config.REPORT_CARD_SENDER_EMAIL, body=b64body).execute()
+    def send_email(cls, message: EmailMessage):
+        """Send one message with the shared sender."""
+        return cls.get().send(message)
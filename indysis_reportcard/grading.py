@@ -0,0 +1,121 @@
+"""Grading schemes, levels and choices, held in process.
+
+Every mark dropdown on the editing pages ran its own query for its scheme's
+choices, and rendering looked choices and schemes up entry by entry.  The
+registry loads all of them at once (they are small tables) and hands them
+out by id.
+
+As with the access index, the registry is rebuilt when its shared generation
+number changes, which saving or deleting a scheme, level or choice in any
+process does, and after REPORTCARD_GRADING_REGISTRY_TIMEOUT seconds.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from indysis_reportcard import shared
+from indysis_reportcard.models import GradingScheme, GradingSchemeLevel, GradingSchemeLevelChoice
+
+GENERATION_KEY = 'reportcard-grading-generation'
+TIMEOUT = getattr(settings, 'REPORTCARD_GRADING_REGISTRY_TIMEOUT', 300)
+
+_lock = threading.Lock()
+_registry = None
+
+
+class GradingRegistry(object):
+    """All grading schemes, their levels and their choices, by id."""
+
+    def __init__(self):
+        self.schemes = {}
+        self.levels = {}
+        self.choices = {}
+        self.scheme_levels = defaultdict(list)
+        self.scheme_choices = defaultdict(list)
+
+    @classmethod
+    def build(cls):
+        registry = cls()
+        for scheme in GradingScheme.objects.all():
+            registry.schemes[scheme.id] = scheme
+        for level in GradingSchemeLevel.objects.order_by('sortorder', 'id'):
+            registry.levels[level.id] = level
+            registry.scheme_levels[level.gradingscheme_id].append(level)
+        for choice in GradingSchemeLevelChoice.objects.order_by('sortorder', 'id'):
+            registry.choices[choice.id] = choice
+            level = registry.levels.get(choice.gradingschemelevel_id)
+            if level is not None:
+                registry.scheme_choices[level.gradingscheme_id].append(choice)
+        return registry
+
+    def choices_for(self, scheme_id):
+        """A scheme's choices in sortorder, as GradingSchemeLevelChoice.get_all_choices."""
+        return self.scheme_choices[getattr(scheme_id, 'id', scheme_id)]
+
+    def prime(self, entry):
+        """Fill in an entry's choices and its section's schemes from the registry, where not loaded yet."""
+        _prime(entry, ('choice', 'second_choice'), self.choices)
+        if entry.section_id is not None:
+            _prime(entry.section, ('gradingscheme', 'second_gradingscheme'), self.schemes)
+        return entry
+
+
+def _prime(instance, names, objects):
+    for name in names:
+        field = instance._meta.get_field(name)
+        value = getattr(instance, field.attname)
+        if value is not None and value in objects and not hasattr(instance, field.get_cache_name()):
+            setattr(instance, name, objects[value])
+
+
+def generation():
+    return shared.generation(GENERATION_KEY)
+
+
+def invalidate():
+    """Make every process reload its registry on next use."""
+    shared.bump(GENERATION_KEY)
+
+
+def get_registry():
+    global _registry
+    current = generation()
+    with _lock:
+        entry = _registry
+    if entry is not None and entry[0] == current and time.time() - entry[1] < TIMEOUT:
+        return entry[2]
+    registry = GradingRegistry.build()
+    with _lock:
+        _registry = (current, time.time(), registry)
+    return registry
+
+
+def clear():
+    global _registry
+    with _lock:
+        _registry = None
+
+
+def limit_choices(field, scheme):
+    """Restrict a choice form field to a scheme's choices, listing them from the registry.
+
+    The queryset is still used to validate what is posted.
+    """
+    field.queryset = GradingSchemeLevelChoice.objects.filter(
+        gradingschemelevel__gradingscheme=scheme).order_by('sortorder')
+    choices = [(field.prepare_value(choice), field.label_from_instance(choice))
+               for choice in get_registry().choices_for(scheme)]
+    if field.empty_label is not None:
+        choices.insert(0, ('', field.empty_label))
+    field.choices = choices
+
+
+@receiver([post_save, post_delete], sender=GradingScheme)
+@receiver([post_save, post_delete], sender=GradingSchemeLevel)
+@receiver([post_save, post_delete], sender=GradingSchemeLevelChoice)
+def grading_changed(sender, **kwargs):
+    invalidate()
@@ -0,0 +1,188 @@
+"""Edit leases, so two teachers don't edit the same student and subject at once.
+
+Editing pages hold a lease on each (student, subject) pair they show and
+renew them on every ping; a lease lapses LOCK_TIMEOUT seconds after its last
+renewal.  Acquiring, renewing and releasing are done for all of a page's
+pairs at once, in one round trip, so a ping costs the same however many
+students are on the page.
+
+Leases live in Redis (REPORTCARD_LOCK_REDIS_URL, by default the Celery
+broker).  Set REPORTCARD_LOCK_BACKEND to 'memory' to keep them in process
+instead, eg. for tests.
+"""
+import json
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BACKEND = getattr(settings, 'REPORTCARD_LOCK_BACKEND', 'redis')
+REDIS_URL = getattr(settings, 'REPORTCARD_LOCK_REDIS_URL', getattr(settings, 'CELERY_BROKER_URL', None))
+LOCK_TIMEOUT = getattr(settings, 'REPORTCARD_LOCK_TIMEOUT', 300)
+KEY = 'reportcard-lock:%s:%s'
+
+
+class Lease(object):
+    """A lease held by another user."""
+
+    def __init__(self, student, subject, user_id, name, edit_type, pinged):
+        self.student = student
+        self.subject = subject
+        self.user_id = user_id
+        self.name = name
+        self.edit_type = edit_type
+        self.pinged = pinged
+
+    def __repr__(self):
+        return '<Lease: %s>' % self.conflict_str
+
+    @property
+    def conflict_str(self):
+        """Compute a descriptive string for conflict object."""
+        seconds = time.time() - self.pinged
+        if seconds > 60:
+            minutes = int(seconds / 60)
+            timestr = '- last seen %d minutes ago' % minutes
+        else:
+            timestr = ''
+
+        return "%s is editing %s %s - %s %s" % (
+            self.name,
+            self.edit_type or '',
+            self.student.fullname,
+            self.subject.name, timestr)
+
+
+class MemoryBackend(object):
+    """Leases in a dict, for a single process."""
+
+    def __init__(self):
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, keys, owner, value, ttl, check_only=False):
+        """Returns {key: value} of leases held by others; takes all the keys if there are none."""
+        now = time.time()
+        with self.lock:
+            held = {key: self.leases[key][0] for key in keys
+                    if key in self.leases and self.leases[key][1] > now}
+            conflicts = {key: lease for key, lease in held.items() if json.loads(lease)['user'] != owner}
+            if not conflicts and not check_only:
+                for key in keys:
+                    self.leases[key] = (value, now + ttl)
+        return conflicts
+
+    def release(self, keys, owner):
+        with self.lock:
+            for key in keys:
+                if key in self.leases and json.loads(self.leases[key][0])['user'] == owner:
+                    del self.leases[key]
+
+
+ACQUIRE = """
+local conflicts = {}
+for i, key in ipairs(KEYS) do
+    local current = redis.call('GET', key)
+    if current and cjson.decode(current)['user'] ~= tonumber(ARGV[1]) then
+        table.insert(conflicts, key)
+        table.insert(conflicts, current)
+    end
+end
+if #conflicts == 0 and ARGV[4] ~= '1' then
+    for i, key in ipairs(KEYS) do
+        redis.call('SET', key, ARGV[2], 'PX', ARGV[3])
+    end
+end
+return conflicts
+"""
+
+RELEASE = """
+for i, key in ipairs(KEYS) do
+    local current = redis.call('GET', key)
+    if current and cjson.decode(current)['user'] == tonumber(ARGV[1]) then
+        redis.call('DEL', key)
+    end
+end
+return 0
+"""
+
+
+class RedisBackend(object):
+    """Leases as Redis keys that expire, checked and set together by a script."""
+
+    def __init__(self, url=None):
+        self.client = redis.StrictRedis.from_url(url or REDIS_URL)
+        self.acquire_script = self.client.register_script(ACQUIRE)
+        self.release_script = self.client.register_script(RELEASE)
+
+    def acquire(self, keys, owner, value, ttl, check_only=False):
+        result = self.acquire_script(keys=keys, args=[owner, value, int(ttl * 1000), '1' if check_only else '0'])
+        return {result[i].decode('utf-8'): result[i + 1].decode('utf-8') for i in range(0, len(result), 2)}
+
+    def release(self, keys, owner):
+        self.release_script(keys=keys, args=[owner])
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'redis': RedisBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = BACKENDS[BACKEND]()
+        return _backend
+
+
+def set_backend(backend):
+    """Use a different backend.  Returns the previous one."""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def _keys(subjects, students):
+    return {KEY % (student.id, subject.id): (student, subject) for subject in subjects for student in students}
+
+
+def conflicting_check(user, subjects, students, edit_type=None, check_only=False):
+    """Take or renew the user's leases, unless another user holds one.  Returns the other users' leases."""
+    pairs = _keys(subjects, students)
+    if not pairs:
+        return []
+    value = json.dumps(dict(user=user.id, name=user.get_full_name() or user.username, edit_type=edit_type,
+                            pinged=time.time()))
+    try:
+        held = get_backend().acquire(sorted(pairs), user.id, value, LOCK_TIMEOUT, check_only=check_only)
+    except redis.RedisError:
+        logger.warning("Unable to check edit leases", exc_info=True)
+        return []
+
+    conflicts = []
+    for key, lease in sorted(held.items()):
+        lease = json.loads(lease)
+        student, subject = pairs[key]
+        conflicts.append(Lease(student, subject, lease['user'], lease['name'], lease['edit_type'], lease['pinged']))
+    return conflicts
+
+
+def conflicting_clear(user, subjects, students):
+    """Release the user's leases."""
+    pairs = _keys(subjects, students)
+    if not pairs:
+        return
+    try:
+        get_backend().release(sorted(pairs), user.id)
+    except redis.RedisError:
+        logger.warning("Unable to release edit leases", exc_info=True)
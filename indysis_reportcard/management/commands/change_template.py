@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from indysis_reportcard.models import ReportCard, ReportCardTemplate
+from indysis_reportcard.template_migration import migrate_reportcards
+
+
+class Command(BaseCommand):
+    help = """
+    Move a term's report cards to another template, keeping the entries that have an equivalent in it.
+    Prints a JSON diff of matched, unmatched, deleted and merged entries.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('term', type=int, help='Term id')
+        parser.add_argument('template', type=int, help='Id of the template to move to')
+        parser.add_argument('--grade', type=int, action='append', help='Grade level id; all grades if not given')
+        parser.add_argument('--from-template', type=int, help='Only move report cards on this template')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        try:
+            template = ReportCardTemplate.objects.get(pk=options['template'])
+        except ReportCardTemplate.DoesNotExist:
+            raise CommandError("No template %s" % options['template'])
+        reportcards = ReportCard.objects.filter(term=options['term']).exclude(template=template)
+        if options['grade']:
+            reportcards = reportcards.filter(student__year__in=options['grade'])
+        if options['from_template']:
+            reportcards = reportcards.filter(template=options['from_template'])
+
+        diff = migrate_reportcards(reportcards, template, dry_run=options['dry_run'])
+        diff['dry_run'] = options['dry_run']
+        self.stdout.write(json.dumps(diff, cls=DjangoJSONEncoder, indent=2))
@@ -1,29 +1,108 @@
-from django.core.management.base import BaseCommand
+import json
 
-from indysis_reportcard.models import ReportCard, ReportCardEntry
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Count
+
+from indysis_reportcard import duplicates, pdf_cache
+from indysis_reportcard.materialize import chunked
+from indysis_reportcard.models import ReportCardCompletion, ReportCardEntry
+
+KEY = ('reportcard', 'section', 'subject', 'strand')
+
+GUARD_NAME = 'indysis_reportcard_entry_element_uniq'
+# unique_together does not stop duplicates where section, subject or strand is NULL
+GUARD_SQL = {
+    'sqlite': 'CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} '
+              '(reportcard_id, IFNULL(section_id, 0), IFNULL(subject_id, 0), IFNULL(strand_id, 0))',
+    'postgresql': 'CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} '
+                  '(reportcard_id, COALESCE(section_id, 0), COALESCE(subject_id, 0), COALESCE(strand_id, 0))',
+}
+
+
+def duplicate_keys():
+    """(reportcard, section, subject, strand) of every element with more than one entry."""
+    keys = [tuple(row[field] for field in KEY) for row in ReportCardEntry.objects.values(*KEY).order_by().annotate(
+        entries=Count('id')).filter(entries__gt=1)]
+    return sorted(keys, key=lambda key: [value or 0 for value in key])
 
 
 class Command(BaseCommand):
     help = """
-    Check report cards for duplicate grade entries.
+    Check report cards for duplicate grade entries, optionally merging them.
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Merge duplicates into the lowest id entry, keeping the best values')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Duplicated elements merged per transaction (default 200)')
+        parser.add_argument('--json', action='store_true', help='Output JSON')
+        parser.add_argument('--guard', action='store_true',
+                            help='Add a unique index that also covers NULL sections, subjects and strands')
+
     def handle(self, *args, **options):
-        rc: ReportCard
-        for rc in ReportCard.objects.all():
-            out = False
-            items = dict()
-            dupes = set()
-            entry: ReportCardEntry
-            for entry in rc.reportcardentry_set.order_by('section', 'subject', 'strand', 'id').all():
-                key = entry.unique_key()
-                if key in items:
-                    if key not in dupes:
-                        print(items[key].dump())
-                    print(entry.dump())
-                    out = True
-                    dupes.add(key)
-                else:
-                    items[key] = entry
-            if out:
-                print("----------------------------------------------------------------")
\ No newline at end of file
+        keys = duplicate_keys()
+        groups = []
+        for batch in chunked(keys, options['batch_size']):
+            groups.extend(self.check(batch, repair=options['repair']))
+
+        guarded = False
+        if options['guard']:
+            if keys and not options['repair']:
+                raise CommandError("Remove the duplicates (--repair) before adding the guard")
+            guarded = self.add_guard()
+
+        if options['json']:
+            self.stdout.write(json.dumps(dict(duplicates=groups, repaired=options['repair'], guarded=guarded),
+                                         cls=DjangoJSONEncoder, indent=2))
+            return
+        for group in groups:
+            self.stdout.write("%(student)s (report card %(reportcard)s) %(element)s: entries %(entries)s, "
+                              "keeping %(keep)s with the values of %(values_from)s" % group)
+        self.stdout.write("%d duplicated elements%s" % (len(groups), ', merged' if options['repair'] else ''))
+
+    def check(self, keys, repair=False):
+        """Describe, and merge if repairing, one batch of duplicated elements."""
+        wanted = set(keys)
+        found = {}
+        for entry in ReportCardEntry.objects.filter(reportcard__in={key[0] for key in keys}).select_related(
+                'reportcard__student', 'section', 'subject', 'strand').order_by('id'):
+            key = (entry.reportcard_id, entry.section_id, entry.subject_id, entry.strand_id)
+            if key in wanted:
+                found.setdefault(key, []).append(entry)
+
+        groups = []
+        merges = []
+        for key in keys:
+            entries = found.get(key, [])
+            if len(entries) < 2:
+                continue
+            keep, source, others = duplicates.plan(entries)
+            merges.append((keep, source, others))
+            groups.append(dict(
+                reportcard=key[0],
+                student=keep.reportcard.student.fullname,
+                element=' / '.join(str(element) for element in (keep.section, keep.subject, keep.strand)
+                                   if element is not None),
+                entries=[entry.id for entry in entries],
+                keep=keep.id,
+                values_from=source.id,
+            ))
+
+        if repair and merges:
+            with transaction.atomic():
+                duplicates.merge(merges)
+                reportcard_ids = list({keep.reportcard_id for keep, source, others in merges})
+                ReportCardCompletion.refresh(reportcard_ids)
+            pdf_cache.invalidate(*reportcard_ids)
+        return groups
+
+    def add_guard(self):
+        sql = GUARD_SQL.get(connection.vendor)
+        if sql is None:
+            raise CommandError("No duplicate guard for %s databases" % connection.vendor)
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(name=GUARD_NAME, table=ReportCardEntry._meta.db_table))
+        return True
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from reversion.models import Revision, Version
+
+from indysis_reportcard.materialize import chunked
+
+
+class Command(BaseCommand):
+    help = """
+    Collapse consecutive autosave revisions by the same user, keeping only the last version of each object.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=24,
+                            help='Only compact revisions older than this many hours (default 24)')
+        parser.add_argument('--gap', type=int, default=60,
+                            help='Minutes between autosaves that end a run (default 60)')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.versions_deleted = 0
+        self.revisions_deleted = 0
+        gap = timedelta(minutes=options['gap'])
+        revisions = Revision.objects.filter(
+            date_created__lt=timezone.now() - timedelta(hours=options['older_than'])
+        ).order_by('user_id', 'date_created', 'id').values_list('id', 'user_id', 'date_created', 'comment')
+
+        run = []
+        last = None
+        for revision_id, user_id, created, comment in revisions.iterator():
+            autosave = (comment or '').startswith('Autosave')
+            if run and (not autosave or user_id != last[0] or created - last[1] > gap):
+                self.compact(run)
+                run = []
+            if autosave:
+                run.append(revision_id)
+            last = (user_id, created)
+        self.compact(run)
+
+        self.stdout.write("%s %d versions and %d revisions" % (
+            'Would delete' if self.dry_run else 'Deleted', self.versions_deleted, self.revisions_deleted))
+
+    def compact(self, run):
+        """Keep the latest version of each object saved in a run of revisions."""
+        if len(run) < 2:
+            return
+        latest = {}
+        versions = []
+        for version_id, revision_id, content_type_id, object_id in Version.objects.filter(
+                revision__in=run).order_by('revision__date_created', 'revision_id', 'id').values_list(
+                'id', 'revision_id', 'content_type_id', 'object_id'):
+            latest[(content_type_id, object_id)] = (version_id, revision_id)
+            versions.append(version_id)
+        keep = {version_id for version_id, revision_id in latest.values()}
+        kept_revisions = {revision_id for version_id, revision_id in latest.values()}
+        drop = [version_id for version_id in versions if version_id not in keep]
+        emptied = [revision_id for revision_id in run if revision_id not in kept_revisions]
+
+        self.versions_deleted += len(drop)
+        self.revisions_deleted += len(emptied)
+        if self.dry_run:
+            return
+        with transaction.atomic():
+            for chunk in chunked(drop, 500):
+                Version.objects.filter(id__in=chunk).delete()
+            Revision.objects.filter(id__in=emptied).delete()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from indysis_reportcard.materialize import chunked
+from indysis_reportcard.models import ReportCard, ReportCardCompletion, ReportCardTerm
+
+
+class Command(BaseCommand):
+    help = """
+    Recount completed entries for the term dashboards, fixing any counters that have drifted.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--term', type=int, action='append', help='Term id; all terms if not given')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        terms = ReportCardTerm.objects.all()
+        if options['term']:
+            terms = terms.filter(id__in=options['term'])
+        for term in terms:
+            ids = list(ReportCard.objects.filter(term=term).values_list('id', flat=True))
+            changed = sum(ReportCardCompletion.refresh(chunk) for chunk in chunked(ids, options['chunk_size']))
+            self.stdout.write("%s: %d report cards, %d counters corrected" % (term, len(ids), changed))
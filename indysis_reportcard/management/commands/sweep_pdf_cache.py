@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from indysis_reportcard import pdf_cache
+
+
+class Command(BaseCommand):
+    help = """
+    Delete cached report card PDFs that have outlived REPORTCARD_PDF_CACHE_MAX_AGE.  Run it from cron.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, help='Age in seconds; REPORTCARD_PDF_CACHE_MAX_AGE if not given')
+
+    def handle(self, *args, **options):
+        deleted = pdf_cache.sweep(options['max_age'])
+        self.stdout.write("%d cached report cards deleted" % deleted)
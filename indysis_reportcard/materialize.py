@@ -0,0 +1,174 @@
+"""Bulk creation of report cards and their entries for a term.
+
+Works out which report cards and entries are missing by comparing what the
+templates call for with what exists, and inserts only those with
+bulk_create.  Running it again creates nothing, so it is safe to retry.
+"""
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from raven.contrib.django.raven_compat.models import client
+
+from indysis_reportcard.models import (ReportCard, ReportCardCompletion, ReportCardEntry, ReportCardSection,
+                                       ReportCardStrand, ReportCardSubject, ReportCardTemplate)
+from sis.studentdb.models import Student
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = getattr(settings, 'REPORTCARD_BULK_CHUNK_SIZE', 1000)
+
+
+class MaterializeResult(object):
+    """Counts of what was created, and students that could not be given a report card."""
+
+    def __init__(self):
+        self.reportcards_created = 0
+        self.entries_created = 0
+        self.failures = []
+
+    def __repr__(self):
+        return '<MaterializeResult reportcards=%d entries=%d failures=%d>' % (
+            self.reportcards_created, self.entries_created, len(self.failures))
+
+    def as_dict(self):
+        return dict(reportcards_created=self.reportcards_created, entries_created=self.entries_created,
+                    failures=self.failures)
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def term_templates(term):
+    """Grade level id to the term's template for it, as ReportCardTerm.get_template.
+
+    Grades with no template or more than one map to the error get_template would raise.
+    """
+    by_grade = defaultdict(list)
+    for template in ReportCardTemplate.objects.filter(reportcardterm=term, interim=term.interim).prefetch_related(
+            'grades'):
+        for grade in template.grades.all():
+            by_grade[grade.id].append(template)
+    templates = {}
+    for grade_id, grade_templates in by_grade.items():
+        if len(grade_templates) == 1:
+            templates[grade_id] = grade_templates[0]
+        else:
+            templates[grade_id] = ReportCardTemplate.MultipleObjectsReturned(
+                "%d templates for grade %s in %s" % (len(grade_templates), grade_id, term))
+    return templates
+
+
+def template_elements(template_ids):
+    """The (section, subject, strand) id of every entry each template calls for."""
+    elements = defaultdict(set)
+    for template_id, section_id in ReportCardSection.objects.filter(
+            template__in=template_ids).values_list('template_id', 'id'):
+        elements[template_id].add((section_id, None, None))
+    for template_id, section_id, subject_id in ReportCardSubject.objects.filter(
+            section__template__in=template_ids).values_list('section__template_id', 'section_id', 'id'):
+        elements[template_id].add((section_id, subject_id, None))
+    for template_id, section_id, subject_id, strand_id in ReportCardStrand.objects.filter(
+            subject__section__template__in=template_ids).values_list(
+            'subject__section__template_id', 'subject__section_id', 'subject_id', 'id'):
+        elements[template_id].add((section_id, subject_id, strand_id))
+    return elements
+
+
+def _insert(model, objects, fallback):
+    """bulk_create, or fallback() one object at a time if something else got there first."""
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objects)
+        return len(objects)
+    except IntegrityError:
+        created = 0
+        for obj in objects:
+            created += fallback(obj)
+        return created
+
+
+def _get_or_create_reportcard(reportcard):
+    return int(ReportCard.objects.get_or_create(
+        student_id=reportcard.student_id, term=reportcard.term, template_id=reportcard.template_id)[1])
+
+
+def _get_or_create_entry(entry):
+    return int(ReportCardEntry.objects.get_or_create(
+        reportcard_id=entry.reportcard_id, section_id=entry.section_id, subject_id=entry.subject_id,
+        strand_id=entry.strand_id)[1])
+
+
+def _stamp(reportcards, versions):
+    """Record that these (report card id, template id) pairs have all their entries."""
+    by_template = defaultdict(list)
+    for rc_id, template_id in reportcards:
+        by_template[template_id].append(rc_id)
+    for template_id, ids in by_template.items():
+        ReportCard.objects.filter(id__in=ids).exclude(entries_version=versions[template_id]).update(
+            entries_version=versions[template_id])
+
+
+def materialize_reportcards(term, students=None, chunk_size=None):
+    """Create every missing report card and entry for a term.
+
+    students defaults to the active students with a grade.  Returns a
+    MaterializeResult.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    result = MaterializeResult()
+    if students is None:
+        students = Student.objects.filter(is_active=True, year__isnull=False)
+    students = list(students.values_list('id', 'year_id') if hasattr(students, 'values_list')
+                    else [(student.id, student.year_id) for student in students])
+    templates = term_templates(term)
+
+    wanted = {}
+    for student_id, grade_id in students:
+        template = templates.get(grade_id) or ReportCardTemplate.DoesNotExist(
+            "No template for grade %s in %s" % (grade_id, term))
+        if isinstance(template, Exception):
+            result.failures.append(dict(student=student_id, error=str(template)))
+            continue
+        wanted[(student_id, template.id)] = template
+
+    # Report cards
+    existing = set(ReportCard.objects.filter(term=term, student__in=[s for s, t in wanted]).values_list(
+        'student_id', 'template_id'))
+    missing = [ReportCard(student_id=student_id, term=term, template_id=template_id)
+               for student_id, template_id in sorted(set(wanted) - existing)]
+    for chunk in chunked(missing, chunk_size):
+        result.reportcards_created += _insert(ReportCard, chunk, _get_or_create_reportcard)
+
+    # Entries, a chunk of report cards at a time
+    elements = template_elements({template.id for template in wanted.values()})
+    reportcards = list(ReportCard.objects.filter(
+        term=term, student__in=[s for s, t in wanted]).values_list('id', 'student_id', 'template_id'))
+    reportcards = [(rc_id, template_id) for rc_id, student_id, template_id in reportcards
+                   if (student_id, template_id) in wanted]
+    versions = {template.id: template.structure_version for template in wanted.values()}
+    per_chunk = max(1, chunk_size // max(1, max((len(e) for e in elements.values()), default=1)))
+    for chunk in chunked(reportcards, per_chunk):
+        existing = set(ReportCardEntry.objects.filter(reportcard__in=[rc_id for rc_id, t in chunk]).values_list(
+            'reportcard_id', 'section_id', 'subject_id', 'strand_id'))
+        missing = [
+            ReportCardEntry(reportcard_id=rc_id, section_id=section_id, subject_id=subject_id, strand_id=strand_id)
+            for rc_id, template_id in chunk
+            for section_id, subject_id, strand_id in sorted(elements[template_id], key=str)
+            if (rc_id, section_id, subject_id, strand_id) not in existing
+        ]
+        for entries in chunked(missing, chunk_size):
+            result.entries_created += _insert(ReportCardEntry, entries, _get_or_create_entry)
+        _stamp(chunk, versions)
+        if missing:
+            ReportCardCompletion.refresh(rc_id for rc_id, template_id in chunk)
+
+    for failure in result.failures:
+        logger.warning("Unable to create report card for student %s: %s", failure['student'], failure['error'])
+    if result.failures:
+        client.captureMessage("Unable to create %d report cards for %s" % (len(result.failures), term))
+    logger.info("Materialized %s: %r", term, result)
+    return result
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('studentdb', '0012_auto_20190828_1918'),
+        ('indysis_reportcard', '0021_auto_20190828_1935'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportCardExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('kind', models.CharField(choices=[('pdf', 'Combined PDF'), ('zip', 'Zip of PDFs'), ('comments', 'Comment report')], max_length=20)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('progress', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('output', models.FileField(blank=True, null=True, upload_to='reportcard/exports')),
+                ('message', models.TextField(blank=True, default='')),
+                ('base_url', models.CharField(blank=True, default='', max_length=255)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('grade_level', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='studentdb.GradeLevel')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCardTerm')),
+            ],
+            options={
+                'ordering': ['-created'],
+                'verbose_name': 'Report card export',
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+import indysis_reportcard.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0022_reportcardexportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportCardArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('state', models.CharField(choices=[('building', 'Building'), ('complete', 'Complete'), ('stale', 'Stale'), ('failed', 'Failed')], default='building', max_length=20)),
+                ('progress', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('manifest', models.TextField(blank=True, default='', help_text='JSON list of archived cards and checksums')),
+                ('message', models.TextField(blank=True, default='')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCardTerm')),
+            ],
+            options={
+                'ordering': ['-created'],
+                'verbose_name': 'Report card archive',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportCardArchiveItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('pdf', models.FileField(upload_to=indysis_reportcard.models.archive_upload_path)),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('archive', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='indysis_reportcard.ReportCardArchive')),
+                ('reportcard', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCard')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='reportcardarchiveitem',
+            unique_together=set([('archive', 'reportcard')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0023_reportcardarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportcardterm',
+            name='open_failures',
+            field=models.TextField(blank=True, default='', editable=False, help_text='JSON list of students whose report cards could not be created'),
+        ),
+        migrations.AddField(
+            model_name='reportcardterm',
+            name='open_finished',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportcardterm',
+            name='open_progress',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='reportcardterm',
+            name='open_state',
+            field=models.CharField(blank=True, choices=[('', 'Not started'), ('running', 'Creating report cards'), ('ready', 'Ready'), ('failed', 'Ready with failures')], default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='reportcardterm',
+            name='open_total',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
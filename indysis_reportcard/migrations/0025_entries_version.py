@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0024_reportcardterm_open_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportcardtemplate',
+            name='structure_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='reportcard',
+            name='entries_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
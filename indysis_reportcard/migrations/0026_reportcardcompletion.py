@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, Sum, When
+import django.db.models.deletion
+
+
+def count_entries(apps, schema_editor):
+    ReportCardEntry = apps.get_model('indysis_reportcard', 'ReportCardEntry')
+    ReportCardCompletion = apps.get_model('indysis_reportcard', 'ReportCardCompletion')
+    rows = ReportCardEntry.objects.values('reportcard', 'reportcard__term', 'subject').order_by().annotate(
+        total=Count('id'),
+        filled=Sum(Case(When(completed=True, then=1), default=0, output_field=IntegerField())))
+    ReportCardCompletion.objects.bulk_create([
+        ReportCardCompletion(term_id=row['reportcard__term'], reportcard_id=row['reportcard'],
+                             subject_id=row['subject'], total=row['total'], filled=row['filled'])
+        for row in rows
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0025_entries_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportCardCompletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('filled', models.PositiveIntegerField(default=0)),
+                ('reportcard', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCard')),
+                ('subject', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCardSubject')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='indysis_reportcard.ReportCardTerm')),
+            ],
+            options={
+                'verbose_name': 'Report card completion',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='reportcardcompletion',
+            unique_together=set([('reportcard', 'subject')]),
+        ),
+        migrations.RunPython(count_entries, migrations.RunPython.noop),
+    ]
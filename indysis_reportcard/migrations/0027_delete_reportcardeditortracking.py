@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0026_reportcardcompletion'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='ReportCardEditorTracking',
+        ),
+    ]
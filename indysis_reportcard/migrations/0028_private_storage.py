@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import indysis_reportcard.models
+import indysis_reportcard.storage
+
+
+def move_archived_pdfs(apps, schema_editor):
+    """Move PDFs archived under the public media root to private storage."""
+    storage = indysis_reportcard.storage.private_storage
+    ReportCardArchiveItem = apps.get_model('indysis_reportcard', 'ReportCardArchiveItem')
+    for name in ReportCardArchiveItem.objects.values_list('pdf', flat=True).iterator():
+        if not name or not default_storage.exists(name) or storage.exists(name):
+            continue
+        with default_storage.open(name, 'rb') as pdf:
+            storage.save(name, pdf)
+        default_storage.delete(name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0027_delete_reportcardeditortracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportcardarchive',
+            name='base_url',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='reportcardarchiveitem',
+            name='pdf',
+            field=models.FileField(storage=indysis_reportcard.storage.PrivateStorage(),
+                                   upload_to=indysis_reportcard.models.archive_upload_path),
+        ),
+        migrations.RunPython(move_archived_pdfs, migrations.RunPython.noop),
+    ]
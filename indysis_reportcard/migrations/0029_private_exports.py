@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import indysis_reportcard.storage
+
+
+def move_exports(apps, schema_editor):
+    """Move finished exports from the public media root to private storage."""
+    storage = indysis_reportcard.storage.private_storage
+    ReportCardExportJob = apps.get_model('indysis_reportcard', 'ReportCardExportJob')
+    for name in ReportCardExportJob.objects.exclude(output='').exclude(output=None).values_list(
+            'output', flat=True).iterator():
+        if not default_storage.exists(name) or storage.exists(name):
+            continue
+        with default_storage.open(name, 'rb') as output:
+            storage.save(name, output)
+        default_storage.delete(name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0028_private_storage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportcardexportjob',
+            name='output',
+            field=models.FileField(blank=True, null=True, storage=indysis_reportcard.storage.PrivateStorage(),
+                                   upload_to='reportcard/exports'),
+        ),
+        migrations.RunPython(move_exports, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+INDEX_NAME = 'indysis_reportcard_completion_section_uniq'
+
+
+def add_section_index(apps, schema_editor):
+    """unique_together does not cover section counters, whose subject is NULL; a partial index does."""
+    ReportCardCompletion = apps.get_model('indysis_reportcard', 'ReportCardCompletion')
+    for row in ReportCardCompletion.objects.filter(subject=None).values('reportcard').order_by().annotate(
+            rows=Count('id'), first=Min('id')).filter(rows__gt=1):
+        ReportCardCompletion.objects.filter(reportcard=row['reportcard'], subject=None).exclude(
+            id=row['first']).delete()
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (reportcard_id) WHERE subject_id IS NULL' % (
+            INDEX_NAME, ReportCardCompletion._meta.db_table))
+
+
+def remove_section_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % INDEX_NAME)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0029_private_exports'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_section_index, remove_section_index),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.files.storage import default_storage
+from django.db import migrations
+
+CACHE_DIR = 'reportcard/cache'
+
+
+def delete_public_cache(apps, schema_editor):
+    """Cached PDFs are now kept in private storage; the copies under the public media root can go."""
+    try:
+        prefixes, _ = default_storage.listdir(CACHE_DIR)
+    except OSError:
+        return
+    for prefix in prefixes:
+        directory = '%s/%s' % (CACHE_DIR, prefix)
+        for name in default_storage.listdir(directory)[1]:
+            default_storage.delete('%s/%s' % (directory, name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indysis_reportcard', '0030_completion_section_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_public_cache, migrations.RunPython.noop),
+    ]
@@ -1,23 +1,25 @@
 # -*- coding: utf-8 -*-
 """Report card models."""
 
+import json
 import locale
 import logging
 import threading
+from collections import defaultdict
 from contextlib import contextmanager
-from datetime import datetime, timedelta
 from typing import List
 
 import reversion
 from ckeditor.fields import RichTextField
-from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.core import serializers
 from django.core.exceptions import ValidationError, MultipleObjectsReturned
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models, transaction
-from django.db.models import Count, Q, F
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, IntegerField, Q, F, Sum, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
 from django.utils.translation import gettext as _
 from django_extensions.db.models import TimeStampedModel
 
@@ -26,9 +28,9 @@ from sis.studentdb.models import duplicate, Term
 from sis.studentdb.thumbs import ImageWithThumbsField
 from raven.contrib.django.raven_compat.models import client
 
-LOCALE_LOCK = threading.Lock()
+from indysis_reportcard.storage import private_storage
 
-LOCK_TIMEOUT = getattr(settings, 'REPORTCARD_LOCK_TIMEOUT', 300)
+LOCALE_LOCK = threading.Lock()
 
 
 @contextmanager
@@ -44,6 +46,15 @@ def setlocale(name):
 
 RC_LANGUAGES = (('en', 'English'), ('fr', 'French'))
 
+
+def sorted_related(manager):
+    """Related objects in sortorder, using prefetched results when there are some."""
+    objects = manager.all()
+    if objects._result_cache is not None:
+        return objects
+    return manager.order_by('sortorder')
+
+
 @reversion.register()
 class GradingScheme(TimeStampedModel):
     """Grading schemes - Eg ABC, percentiles, or other schemes."""
@@ -131,9 +142,10 @@ class GradingSchemeLevelChoice(TimeStampedModel):
 
     def get_all_choices(self):
         """All choices."""
-        gs = self.gradingschemelevel.gradingscheme
-        return self.__class__.objects.filter(
-            gradingschemelevel__gradingscheme=gs).order_by('sortorder')
+        from indysis_reportcard.grading import get_registry
+        registry = get_registry()
+        level = registry.levels.get(self.gradingschemelevel_id) or self.gradingschemelevel
+        return registry.choices_for(level.gradingscheme_id)
 
 
 @reversion.register()
@@ -177,6 +189,8 @@ class ReportCardTemplate(TimeStampedModel):
     body_template = models.TextField(blank=True, null=True)
 
     shared_template = models.ForeignKey(ReportCardSharedTemplate, null=True, blank=True)
+    # Bumped whenever a section, subject or strand is added, changed or removed
+    structure_version = models.PositiveIntegerField(default=1, editable=False)
 
     class Meta:
         verbose_name = "Template"
@@ -189,22 +203,8 @@ class ReportCardTemplate(TimeStampedModel):
 
     def copy_instance(self, request):
         """Make a copy of this template and all it's subordinate objects."""
-        changes = ()
-        new = duplicate(self, changes)
-        new.name += " (copy)"
-        for section in self.reportcardsection_set.all():
-            section_copy = duplicate(section, changes)
-            section_copy.name = section.name
-            for subject in section.reportcardsubject_set.all():
-                subject_copy = duplicate(subject, changes)
-                subject_copy.name = subject.name
-                for strand in subject.reportcardstrand_set.all():
-                    strand_copy = duplicate(strand, changes)
-                    subject_copy.reportcardstrand_set.add(strand_copy)
-                section_copy.reportcardsubject_set.add(subject_copy)
-            new.reportcardsection_set.add(section_copy)
-
-        new.save()
+        from indysis_reportcard.cloning import clone_templates
+        clone_templates([self], changes={'name': lambda template: template.name + " (copy)"})
         messages.success(request, 'Copy successful!')
 
     def __str__(self):
@@ -218,11 +218,55 @@ class ReportCardTemplate(TimeStampedModel):
     @property
     def sections(self):
         """Sections."""
-        return self.reportcardsection_set.order_by('sortorder')
+        return sorted_related(self.reportcardsection_set)
+
+    def elements(self):
+        """(element, (section id, subject id, strand id)) for each section, subject and strand, in order.
+
+        Loads the whole structure in three queries.
+        """
+        subjects = defaultdict(list)
+        for subject in ReportCardSubject.objects.filter(section__template=self).order_by('sortorder'):
+            subjects[subject.section_id].append(subject)
+        strands = defaultdict(list)
+        for strand in ReportCardStrand.objects.filter(subject__section__template=self).order_by('sortorder'):
+            strands[strand.subject_id].append(strand)
+
+        for section in ReportCardSection.objects.filter(template=self).order_by('sortorder'):
+            yield section, (section.id, None, None)
+            for subject in subjects[section.id]:
+                yield subject, (section.id, subject.id, None)
+                for strand in strands[subject.id]:
+                    yield strand, (section.id, subject.id, strand.id)
+
+    def _existing_entries(self, reportcard):
+        """All entries of a report card keyed by element, or None if any are missing."""
+        found = {}
+        for entry in ReportCardEntry.objects.filter(reportcard=reportcard).order_by('id'):
+            # The lowest id wins where there are duplicates, as in get_or_create_reportcard_entry
+            found.setdefault((entry.section_id, entry.subject_id, entry.strand_id), entry)
+        fields = {}
+        for element, key in self.elements():
+            if key not in found:
+                return None
+            fields[element] = found[key]
+        return fields
 
     @transaction.atomic
     def get_or_create_all_entries(self, reportcard):
-        """Get or create all report card entries."""
+        """Get or create all report card entries.
+
+        When the report card's entries_version matches the template's
+        structure_version the entries already exist and are loaded in one
+        query; otherwise they are created and the report card is stamped.
+        """
+        entries_version, structure_version = ReportCard.objects.filter(pk=reportcard.pk).values_list(
+            'entries_version', 'template__structure_version').get()
+        if entries_version == structure_version:
+            fields = self._existing_entries(reportcard)
+            if fields is not None:
+                return fields
+
         fields = {}
 
         for section in self.sections:
@@ -232,18 +276,34 @@ class ReportCardTemplate(TimeStampedModel):
                 for strand in subject.strands:
                     fields[strand] = strand.get_entry(reportcard)
 
+        ReportCard.objects.filter(pk=reportcard.pk).update(entries_version=structure_version)
+        reportcard.entries_version = structure_version
+        ReportCardCompletion.refresh([reportcard.pk])
         return fields
 
+    def ensure_entries(self, reportcards):
+        """Create the entries of any of these report cards that might be missing some."""
+        stale = ReportCard.objects.filter(id__in=[rc.id for rc in reportcards]).exclude(
+            entries_version=F('template__structure_version'))
+        for reportcard in stale:
+            self.get_or_create_all_entries(reportcard)
+
+    @classmethod
+    def bump_structure_version(cls, **lookup):
+        """Mark templates' entries as needing to be checked again."""
+        cls.objects.filter(**lookup).update(structure_version=F('structure_version') + 1)
+
     def get_grading_schemes(self):
         """Return a unique list of graing schemes in use in this template."""
+        from indysis_reportcard.grading import get_registry
+        registry = get_registry()
         seen = set()
-        schemes = GradingScheme.objects.filter(
-            reportcardsection__template=self).order_by('reportcardsection__sortorder').all()
         ok = []
-        for item in schemes:
-            if item.id not in seen:
-                seen.add(item.id)
-                ok.append(item)
+        for scheme_id in ReportCardSection.objects.filter(template=self).order_by('sortorder').values_list(
+                'gradingscheme_id', flat=True):
+            if scheme_id not in seen:
+                seen.add(scheme_id)
+                ok.append(registry.schemes.get(scheme_id) or GradingScheme.objects.get(pk=scheme_id))
 
         return ok
 
@@ -283,7 +343,7 @@ class ReportCardSection(TimeStampedModel):
     @property
     def subjects(self):
         """Sorted list of subjects."""
-        return self.reportcardsubject_set.order_by('sortorder')
+        return sorted_related(self.reportcardsubject_set)
 
     def get_entry(self, reportcard):
         """Get a reportcard entry for this section."""
@@ -293,11 +353,18 @@ class ReportCardSection(TimeStampedModel):
             subject=None,
             strand=None)
 
-    def may_edit(self, teacher):
-        """Check if teacher can edit this term/student."""
+    def may_edit(self, teacher, term=None):
+        """Check if teacher can edit this term/student.
+
+        Pass the term to answer from its access index rather than the database.
+        """
         if not teacher:
             return True
 
+        if term is not None:
+            from indysis_reportcard.access import get_index
+            return get_index(term).may_edit_section(teacher, self.id)
+
         return ReportCardAccess.objects.filter(
             Q(teachers=teacher) &
             (
@@ -345,7 +412,7 @@ class ReportCardSubject(TimeStampedModel):
     @property
     def strands(self):
         """Sorted list of strands for subject."""
-        return self.reportcardstrand_set.order_by('sortorder')
+        return sorted_related(self.reportcardstrand_set)
 
     def get_entry(self, reportcard):
         """Get report card entry for strand."""
@@ -355,17 +422,30 @@ class ReportCardSubject(TimeStampedModel):
             subject=self,
             strand=None)
 
-    def students(self, grade=None, teacher=None):
-        """List of students that have this subject."""
+    def students(self, grade=None, teacher=None, term=None):
+        """List of students that have this subject.
+
+        Pass a term using this subject's template to answer from its access index.
+        """
+        index = None
+        if term is not None:
+            from indysis_reportcard.access import get_index
+            index = get_index(term)
 
         if grade:
-            has_grade = self.section.template.grades.filter(id=grade.id).count()
+            if index is not None:
+                has_grade = grade.id in index.subject_grades(self.id)
+            else:
+                has_grade = self.section.template.grades.filter(id=grade.id).count()
             if not has_grade:
                 return []
             students = Student.objects.filter(year=grade, is_active=True)
         else:
             students = Student.objects.filter(is_active=True)
 
+        if teacher and index is not None:
+            return students.filter(id__in=index.subject_student_ids(self.id, teacher))
+
         if teacher:
             return students.filter(
                 Q(classes__reportcardaccess__teachers=teacher) &
@@ -377,15 +457,19 @@ class ReportCardSubject(TimeStampedModel):
 
         return students.order_by('last_name', 'first_name')
 
-    def may_edit(self, teacher, student):
+    def may_edit(self, teacher, student, term=None):
         """Whether or not the teacher can edit."""
         return (
-                self.teacher_teaches(teacher) and
-                student in self.students(grade=student.year)
+                self.teacher_teaches(teacher, term=term) and
+                student in self.students(grade=student.year, term=term)
         )
 
-    def teacher_teaches(self, teacher):
+    def teacher_teaches(self, teacher, term=None):
         """Whether or not a teacher teaches this subject."""
+        if term is not None:
+            from indysis_reportcard.access import get_index
+            return get_index(term).teaches(teacher, self.id)
+
         return ReportCardAccess.objects.filter(
             Q(teachers=teacher) &
             (
@@ -433,8 +517,12 @@ class ReportCardSubject(TimeStampedModel):
             parts.append(self.text_fr)
         return ' / '.join(parts)
 
-    def teachers_string(self, student=None):
-        teachers = self.teachers(student)
+    def teachers_string(self, student=None, term=None):
+        if student and term:
+            from indysis_reportcard.teachers import get_resolver
+            teachers = get_resolver(term).teachers(student.id, self)
+        else:
+            teachers = self.teachers(student)
         return ' / '.join([teacher.fullname_nocomma for teacher in teachers])
 
 
@@ -516,13 +604,10 @@ class ReportCardYearGradeContent(TimeStampedModel):
             if max_used_id == max_year.id:
                 raise Exception("An entry exists for %s already" % max_year)
 
-            new = self.__class__()
-            new.school_year = school_year
-            new.content = self.content
-            new.grade_level = GradeLevel.objects.get(pk=max_used_id + 1)
-            new.grade_level_id = new.grade_level.id
-            new.save()
-            messages.success(request, 'Created a content entry for %s.' % new.grade_level)
+            from indysis_reportcard.cloning import clone_year_grade_content
+            grade_level = GradeLevel.objects.get(pk=max_used_id + 1)
+            clone_year_grade_content([self], changes={'school_year': school_year, 'grade_level': grade_level})
+            messages.success(request, 'Created a content entry for %s.' % grade_level)
         except Exception as e:
             messages.error(request, "Failed to make copy: %s" % e)
 
@@ -558,6 +643,20 @@ class ReportCardTerm(TimeStampedModel):
     email_body_template = models.TextField(
         default="The report card for {{ rc.student.longname }} is attached.")
 
+    # Progress of creating report cards when the term is opened
+    OPEN_RUNNING = 'running'
+    OPEN_READY = 'ready'
+    OPEN_FAILED = 'failed'
+    OPEN_STATES = (('', 'Not started'), (OPEN_RUNNING, 'Creating report cards'),
+                   (OPEN_READY, 'Ready'), (OPEN_FAILED, 'Ready with failures'))
+
+    open_state = models.CharField(max_length=20, choices=OPEN_STATES, blank=True, default='', editable=False)
+    open_progress = models.PositiveIntegerField(default=0, editable=False)
+    open_total = models.PositiveIntegerField(default=0, editable=False)
+    open_failures = models.TextField(blank=True, default='', editable=False,
+                                     help_text="JSON list of students whose report cards could not be created")
+    open_finished = models.DateTimeField(blank=True, null=True, editable=False)
+
     class Meta:
         verbose_name = "Term"
 
@@ -584,6 +683,11 @@ class ReportCardTerm(TimeStampedModel):
         """Open or Closed based on is_open."""
         return "Open" if self.is_open else "Closed"
 
+    @property
+    def open_failure_list(self):
+        """Students whose report cards could not be created when the term was opened."""
+        return json.loads(self.open_failures) if self.open_failures else []
+
     def subjects(self, teacher=None):
         """Get a list of subjects for this report card term."""
 
@@ -637,24 +741,16 @@ class ReportCardTerm(TimeStampedModel):
         """Return subject objects for the report card term."""
 
         if teacher:
-            return ReportCardSubject.objects.filter(
-                (
-                        Q(section__reportcardaccess__teachers=teacher) |
-                        Q(reportcardaccess__teachers=teacher)
-                ) &
-                Q(section__template__reportcardterm=self)
-            )
+            from indysis_reportcard.access import get_index
+            return ReportCardSubject.objects.filter(id__in=get_index(self).subject_ids(teacher))
         else:
             return ReportCardSubject.objects.filter(
                 section__template__reportcardterm=self)
 
     def copy_instance(self, request):
         """Make a copy of this object."""
-        changes = ()
-        new = duplicate(self, changes)
-        new.is_open = False
-        new.name += " (copy)"
-        new.save()
+        from indysis_reportcard.cloning import clone_terms
+        clone_terms([self], changes={'name': lambda term: term.name + " (copy)"})
         messages.success(request, 'Copy successful!')
 
 
@@ -667,6 +763,8 @@ class ReportCard(TimeStampedModel):
     template = models.ForeignKey(ReportCardTemplate, on_delete=models.PROTECT)
     emailed = models.BooleanField(default=False)
     grade_level = models.ForeignKey(GradeLevel, default=1)
+    # The template structure_version this report card's entries were last completed for
+    entries_version = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         """
@@ -706,8 +804,9 @@ class ReportCard(TimeStampedModel):
         if not teacher:
             return False
         sub = self.get_submission(teacher)
-        sub.completed = completed
-        sub.save()
+        if sub.completed != completed:
+            sub.completed = completed
+            sub.save()
         return completed
 
     def calculate_completed(self, teacher):
@@ -804,25 +903,44 @@ class ReportCard(TimeStampedModel):
     @property
     def data(self):
         """Get report card data as a dictionary."""
+        return self.get_data()
+
+    def get_data(self, attendance=None, homeroom_teachers=None):
+        """Make Report Card Data.
+
+        attendance (TermAbsences, YearAbsences, TermLates, YearLates) and
+        homeroom_teachers (grade level id to teacher) may be supplied by a
+        caller that loaded them for many report cards at once.
+        """
         rc = self
 
-        """Make Report Card Data."""
         with setlocale('fr_CA.UTF-8'):
             date_fr = rc.term.delivery_date.strftime("%-d %B %Y") if rc.term.delivery_date else ''
 
-        hrt = rc.student.homeroom_teacher
+        if homeroom_teachers is not None:
+            hrt = homeroom_teachers.get(rc.student.year_id)
+        else:
+            hrt = rc.student.homeroom_teacher
         if hrt:
             homeroom_teacher = hrt.teacher.fullname_nocomma
         else:
             homeroom_teacher = ""
 
+        if attendance is None:
+            attendance = dict(
+                TermAbsences=rc.student.days_absent(term=rc.term.term),
+                YearAbsences=rc.student.days_absent(school_year=rc.term.school_year),
+                TermLates=rc.student.times_late(term=rc.term.term),
+                YearLates=rc.student.times_late(school_year=rc.term.school_year),
+            )
+
         basics = {"Year": rc.term.school_year.name,
                   "TermNo": rc.term.number,
                   "StudentName": rc.student.longname,
-                  "TermAbsences": '%1.1f' % rc.student.days_absent(term=rc.term.term),
-                  "YearAbsences": '%1.1f' % rc.student.days_absent(school_year=rc.term.school_year),
-                  "TermLates": '%1d' % rc.student.times_late(term=rc.term.term),
-                  "YearLates": '%1d' % rc.student.times_late(school_year=rc.term.school_year),
+                  "TermAbsences": '%1.1f' % attendance['TermAbsences'],
+                  "YearAbsences": '%1.1f' % attendance['YearAbsences'],
+                  "TermLates": '%1d' % attendance['TermLates'],
+                  "YearLates": '%1d' % attendance['YearLates'],
                   "GradeEN": rc.student.year.name or "",
                   "GradeFR": rc.student.year.name_fr or "",
                   "GradeCodeEN": rc.student.year.shortname or "",
@@ -849,71 +967,14 @@ class ReportCard(TimeStampedModel):
             path += ["(Draft)"]
         return ' '.join(path) + ".pdf"
 
-    def change_template(self, new_template):
+    def change_template(self, new_template, dry_run=False):
         """Change from one template to another.
 
-        Iterates report card entries and finds equivalents in the new one.
-        If no equivalent is found, the entry is deleted, with the output printed to JSON.
+        Entries are moved to their equivalents in the new one; entries with
+        no equivalent are deleted.  Returns the diff from migrate_reportcards.
         """
-        for entry in self.reportcardentry_set.all():
-            if entry.strand:
-
-                new = ReportCardStrand.objects.filter(
-                    subject__section__template=new_template,
-                    subject__name_en=entry.subject.name_en,
-                    subject__name_fr=entry.subject.name_fr,
-                    subject__section__name=entry.section.name,
-                    text_en=entry.strand.text_en,
-                    text_fr=entry.strand.text_fr).first()
-                if not new:
-                    print("Unmatched strand %s - deleted" % entry.strand)
-                    print(serializers.serialize('json', [entry]))
-                    entry.delete()
-                else:
-                    print("Update strand %s to %s" % (entry.strand, new))
-                    entry.strand = new
-                    entry.subject = new.subject
-                    entry.section = new.subject.section
-                    entry.save()
-
-            elif entry.subject:
-
-                new = ReportCardSubject.objects.filter(
-                    section__template=new_template,
-                    section__name=entry.section.name,
-                    name_en=entry.subject.name_en,
-                    name_fr=entry.subject.name_fr).first()
-                if not new:
-                    print("Unmatched subject %s - deleted" % entry.subject)
-                    print(serializers.serialize('json', [entry]))
-                    entry.delete()
-                else:
-                    print("Update subject %s to %s" % (entry.subject, new))
-                    entry.subject = new
-                    entry.section = new.section
-                    entry.save()
-
-            elif entry.section:
-                new = ReportCardSection.objects.filter(
-                    template=new_template,
-                    name=entry.section.name).first()
-                if not new:
-                    print("Unmatched section - deleted")
-                    print(serializers.serialize('json', [entry]))
-                    entry.delete()
-                else:
-                    print("Update section %s to %s" % (entry.section, new))
-                    entry.section = new
-                    entry.save()
-
-            else:
-                # Huh
-                print("Unmatched entry (not strand, subject, or section) - deleted")
-                print(serializers.serialize('json', [entry]))
-                entry.delete()
-
-        self.template = new_template
-        self.save()
+        from indysis_reportcard.template_migration import migrate_reportcards
+        return migrate_reportcards([self], new_template, dry_run=dry_run)
 
 
 @reversion.register()
@@ -1119,9 +1180,8 @@ class ReportCardAccess(TimeStampedModel):
 
     def copy_instance(self, request):
         """Make a copy of this object."""
-        changes = (('description', self.description + " (copy)"), )
-        new = duplicate(self, changes)
-        new.save()
+        from indysis_reportcard.cloning import clone_access
+        clone_access([self], changes={'description': self.description + " (copy)"})
         messages.success(request, 'Copy successful!')
 
     def __str__(self):
@@ -1140,78 +1200,245 @@ class ReportCardTemplateImage(TimeStampedModel):
         verbose_name = "Template image"
 
 
-class ReportCardEditorTracking(TimeStampedModel):
-    """Tracking of active editing."""
+class ReportCardExportJob(TimeStampedModel):
+    """A background export of report cards (PDF, ZIP or comment report)."""
+
+    PDF = 'pdf'
+    ZIP = 'zip'
+    COMMENT_REPORT = 'comments'
+    KINDS = ((PDF, 'Combined PDF'), (ZIP, 'Zip of PDFs'), (COMMENT_REPORT, 'Comment report'))
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
 
     class Meta:
-        """Metadata."""
+        ordering = ['-created']
+        verbose_name = "Report card export"
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    term = models.ForeignKey(ReportCardTerm, on_delete=models.CASCADE)
+    grade_level = models.ForeignKey(GradeLevel, on_delete=models.CASCADE)
+    state = models.CharField(max_length=20, choices=STATES, default=PENDING)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    output = models.FileField(upload_to='reportcard/exports', blank=True, null=True, storage=private_storage)
+    message = models.TextField(blank=True, default='')
+    base_url = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
+
+    def __str__(self):
+        """Unicode representation."""
+        return f"{self.get_kind_display()} - {self.grade_level} - {self.term}"
+
+    @property
+    def filename(self):
+        """Download file name."""
+        if self.kind == self.COMMENT_REPORT:
+            name = f"Comment Report - {self.grade_level}"
+        else:
+            name = f"{self.grade_level} - {self.term}"
+        if self.term.is_open:
+            name += " (Draft)"
+        return name + ('.zip' if self.kind == self.ZIP else '.pdf')
+
+    def set_state(self, state, message=None):
+        """Update the job state."""
+        self.state = state
+        if message is not None:
+            self.message = message
+        self.save(update_fields=['state', 'message', 'modified'])
+
+    def set_progress(self, progress, total=None):
+        """Record N of M cards done."""
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        self.save(update_fields=['progress', 'total', 'modified'])
+
+    @property
+    def download_url(self):
+        """Where to download a finished export from; the file itself has no public URL."""
+        if self.state == self.DONE and self.output:
+            return reverse('reportcard:download_export', args=[self.id])
+        return None
+
+    def as_dict(self):
+        """Status for JSON polling."""
+        return {
+            "id": self.id,
+            "kind": self.get_kind_display(),
+            "grade": str(self.grade_level),
+            "state": self.state,
+            "progress": self.progress,
+            "total": self.total,
+            "message": self.message,
+            "url": self.download_url,
+        }
+
+
+def archive_upload_path(instance, filename):
+    """Archived PDFs are stored per term and per archive, so they are never overwritten."""
+    return f"reportcard/archive/{instance.archive.term_id}/{instance.archive_id}/{filename}"
+
 
-        unique_together = ('user', 'student', 'subject')
+class ReportCardArchive(TimeStampedModel):
+    """Rendered PDFs of every report card in a closed term."""
 
-    user = models.ForeignKey(User, blank=True, null=True, db_index=True,
-                             related_name='editor_locks', on_delete=models.CASCADE)
-    student = models.ForeignKey(Student, blank=True, null=True, db_index=True, on_delete=models.CASCADE)
-    subject = models.ForeignKey(ReportCardSubject, blank=True, null=True, db_index=True, on_delete=models.CASCADE)
-    edit_type = models.CharField(max_length=64, null=True, blank=True)
-    last_ping = models.DateTimeField(auto_now_add=True)
+    BUILDING = 'building'
+    COMPLETE = 'complete'
+    STALE = 'stale'
+    FAILED = 'failed'
+    STATES = ((BUILDING, 'Building'), (COMPLETE, 'Complete'), (STALE, 'Stale'), (FAILED, 'Failed'))
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = "Report card archive"
+
+    term = models.ForeignKey(ReportCardTerm, on_delete=models.CASCADE)
+    state = models.CharField(max_length=20, choices=STATES, default=BUILDING)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    manifest = models.TextField(blank=True, default='', help_text="JSON list of archived cards and checksums")
+    message = models.TextField(blank=True, default='')
+    base_url = models.CharField(max_length=255, blank=True, default='')
+
+    def __str__(self):
+        """Unicode representation."""
+        return f"Archive of {self.term} ({self.get_state_display()})"
 
     @classmethod
-    def conflicting_check(cls, user, subjects, students, edit_type=None, check_only=False):
-        """Check for conflicting edits."""
-        ping_since = datetime.now() - timedelta(seconds=LOCK_TIMEOUT)
-
-        # Obtain list of locks for other faculty
-        locks = cls.objects.filter(
-            subject__in=subjects,
-            student__in=students,
-            last_ping__gte=ping_since).exclude(user=user).all()
-
-        if locks or check_only:
-            return locks
-
-        # Set/Update locks
-        for subject in subjects:
-            for student in students:
-                obj, created = cls.objects.get_or_create(
-                    user=user,
-                    student=student,
-                    subject=subject)
-                obj.last_ping = datetime.now()
-                obj.edit_type = edit_type
-                obj.save()
-
-        return locks
+    def current(cls, term):
+        """The complete, up to date archive for a term, if there is one."""
+        return cls.objects.filter(term=term, state=cls.COMPLETE).first()
 
     @classmethod
-    def conflicting_clear(cls, user, subjects, students):
-        """Clear conflicts."""
-        for s in students:
-            cls.objects.filter(
-                user=user,
-                student=s,
-                subject__in=subjects,
-            ).delete()
+    def mark_stale(cls, term):
+        """Archives no longer reflect the term once it is reopened."""
+        cls.objects.filter(term=term).exclude(state=cls.FAILED).update(state=cls.STALE)
 
-    def __repr__(self):
-        """String representation."""
-        return '<ReportCardEditorTracking: %s>' % self.conflict_str.encode('utf-8')
 
-    @property
-    def conflict_str(self):
-        """Compute a descriptive string for conflict object."""
-        age = datetime.now() - self.last_ping
-        seconds = age.total_seconds()
-        if seconds > 60:
-            minutes = int(seconds / 60)
-            timestr = '- last seen %d minutes ago' % minutes
-        else:
-            timestr = ''
+class ReportCardArchiveItem(TimeStampedModel):
+    """One archived report card PDF."""
+
+    class Meta:
+        unique_together = ('archive', 'reportcard')
+
+    archive = models.ForeignKey(ReportCardArchive, on_delete=models.CASCADE, related_name='items')
+    reportcard = models.ForeignKey(ReportCard, on_delete=models.CASCADE)
+    pdf = models.FileField(upload_to=archive_upload_path, storage=private_storage)
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveIntegerField(default=0)
 
-        return "%s is editing %s %s - %s %s" % (
-            self.user.get_full_name() or self.user.username,
-            self.edit_type or '',
-            self.student.fullname,
-            self.subject.name, timestr)
+
+class ReportCardCompletion(models.Model):
+    """How many of a report card's entries for a subject are completed.
+
+    subject is null for section entries; unique_together does not cover
+    those rows, so a partial unique index is added for them on SQLite and
+    PostgreSQL.  Kept up to date by refresh() when
+    entries are created or their completed flag changes, so the term
+    dashboards can read aggregated counts.  The reconcile_completion command
+    rebuilds them.
+    """
+
+    class Meta:
+        unique_together = ('reportcard', 'subject')
+        verbose_name = "Report card completion"
+
+    term = models.ForeignKey(ReportCardTerm, on_delete=models.CASCADE)
+    reportcard = models.ForeignKey(ReportCard, on_delete=models.CASCADE)
+    subject = models.ForeignKey(ReportCardSubject, null=True, blank=True, on_delete=models.CASCADE)
+    total = models.PositiveIntegerField(default=0)
+    filled = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def refresh(cls, reportcard_ids):
+        """Recount the entries of some report cards.  Returns the number of counters changed.
+
+        The report cards are locked while they are recounted, so two refreshes
+        of the same card cannot both add its missing counters.
+        """
+        reportcard_ids = list(reportcard_ids)
+        if not reportcard_ids:
+            return 0
+        with transaction.atomic():
+            terms = dict(ReportCard.objects.select_for_update().filter(id__in=reportcard_ids).order_by(
+                'id').values_list('id', 'term_id'))
+            return cls._refresh(reportcard_ids, terms)
+
+    @classmethod
+    def _refresh(cls, reportcard_ids, terms):
+        counts = {
+            (row['reportcard'], row['subject']): (row['total'], row['filled'])
+            for row in ReportCardEntry.objects.filter(reportcard__in=reportcard_ids).values(
+                'reportcard', 'subject').order_by().annotate(
+                total=Count('id'),
+                filled=Sum(Case(When(completed=True, then=1), default=0, output_field=IntegerField())))
+        }
+        existing = {}
+        stale = []
+        for row in cls.objects.filter(reportcard__in=reportcard_ids).order_by('id'):
+            # Section counters (no subject) are not covered by unique_together; drop any duplicates
+            if (row.reportcard_id, row.subject_id) in existing:
+                stale.append(row)
+            else:
+                existing[(row.reportcard_id, row.subject_id)] = row
+
+        changed = 0
+        missing = []
+        for (reportcard_id, subject_id), (total, filled) in counts.items():
+            row = existing.pop((reportcard_id, subject_id), None)
+            if row is None:
+                missing.append(cls(term_id=terms[reportcard_id], reportcard_id=reportcard_id,
+                                   subject_id=subject_id, total=total, filled=filled))
+            elif (row.total, row.filled) != (total, filled):
+                cls.objects.filter(pk=row.pk).update(total=total, filled=filled)
+                changed += 1
+        stale += existing.values()
+        if stale:
+            cls.objects.filter(pk__in=[row.pk for row in stale]).delete()
+            changed += len(stale)
+        if missing:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(missing)
+            except IntegrityError:
+                for row in missing:
+                    updated = cls.objects.filter(reportcard_id=row.reportcard_id, subject_id=row.subject_id).update(
+                        term_id=row.term_id, total=row.total, filled=row.filled)
+                    if not updated:
+                        row.save()
+            changed += len(missing)
+        return changed
+
+    @classmethod
+    def entry_completed_changed(cls, entry):
+        """Count one entry's new completed state without recounting its report card."""
+        updated = cls.objects.filter(reportcard=entry.reportcard_id, subject=entry.subject_id).update(
+            filled=F('filled') + (1 if entry.completed else -1))
+        if not updated:
+            cls.refresh([entry.reportcard_id])
+
+    @classmethod
+    def filled_by_subject_grade(cls, term):
+        """(subject id, grade id) to the number of report cards with all of that subject's entries completed."""
+        return {
+            (row['subject'], row['reportcard__student__year']): row['num']
+            for row in cls.objects.filter(term=term, subject__isnull=False, total__gt=0, filled=F('total')).values(
+                'subject', 'reportcard__student__year').order_by().annotate(num=Count('id'))
+        }
+
+    @classmethod
+    def totals_by_student(cls, term):
+        """Student id to (total, completed) entries in the term."""
+        return {
+            row['reportcard__student']: (row['total'], row['filled'])
+            for row in cls.objects.filter(term=term).values('reportcard__student').order_by().annotate(
+                total=Sum('total'), filled=Sum('filled'))
+        }
 
 
 def get_or_create_reportcard_entry(reportcard, section=None, subject=None,
@@ -1243,3 +1470,18 @@ def get_or_create_reportcard_entry(reportcard, section=None, subject=None,
     if created:
         obj.save()
     return obj
+
+
+@receiver([post_save, post_delete], sender=ReportCardSection)
+def section_changed(sender, instance, **kwargs):
+    ReportCardTemplate.bump_structure_version(pk=instance.template_id)
+
+
+@receiver([post_save, post_delete], sender=ReportCardSubject)
+def subject_changed(sender, instance, **kwargs):
+    ReportCardTemplate.bump_structure_version(reportcardsection=instance.section_id)
+
+
+@receiver([post_save, post_delete], sender=ReportCardStrand)
+def strand_changed(sender, instance, **kwargs):
+    ReportCardTemplate.bump_structure_version(reportcardsection__reportcardsubject=instance.subject_id)
@@ -0,0 +1,185 @@
+"""Cache of rendered report card PDFs.
+
+PDFs are stored in private storage, outside the public media root, named by
+a digest of everything that goes into rendering them, so a changed input can
+never be served a stale file.  The latest digest for each report card is
+remembered in the shared store (see indysis_reportcard.shared) so that edits
+in any process can delete the file they made obsolete.  Files that are missed
+anyway, eg. when a pointer was lost, are removed by sweep() once they are
+REPORTCARD_PDF_CACHE_MAX_AGE seconds old.  Only closed terms are cached;
+drafts change too often to be worth keeping.
+"""
+import hashlib
+import logging
+from datetime import timedelta
+
+from constance import config
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from indysis_reportcard import shared, teachers
+from indysis_reportcard.models import (GradingScheme, GradingSchemeLevel, GradingSchemeLevelChoice,
+                                       ReportCard, ReportCardAccess, ReportCardEntry, ReportCardSection,
+                                       ReportCardSharedTemplate, ReportCardStrand, ReportCardSubject,
+                                       ReportCardTemplate, ReportCardTemplateImage, ReportCardYearGradeContent)
+from indysis_reportcard.storage import private_storage
+from sis.studentdb.models import Faculty
+
+logger = logging.getLogger(__name__)
+
+# Bump when the rendering code changes in a way that alters the output.
+CACHE_VERSION = 1
+
+CACHE_DIR = 'reportcard/cache'
+POINTER_KEY = 'reportcard-pdf:%d'
+MAX_AGE = getattr(settings, 'REPORTCARD_PDF_CACHE_MAX_AGE', 30 * 24 * 3600)
+
+TEMPLATE_FIELDS = ('header_template', 'footer_template', 'coverpage_template', 'body_template')
+
+SCHOOL_CONFIG = (
+    'SCHOOL_NAME', 'SCHOOL_ADDRESS_LINE1', 'SCHOOL_ADDRESS_LINE2', 'SCHOOL_ADDRESS_CITY',
+    'SCHOOL_ADDRESS_PROVSTATE', 'SCHOOL_ADDRESS_POSTCODE', 'SCHOOL_EMAIL', 'SCHOOL_PHONE', 'SCHOOL_FAX',
+)
+
+
+def cacheable(reportcard):
+    """Whether PDFs for this report card are cached."""
+    return not reportcard.term.is_open
+
+
+def reportcard_digest(reportcard, base_url=None):
+    """Digest of the inputs to a report card's PDF, rendered against base_url."""
+    term = reportcard.term
+    school_year = term.school_year
+    template = reportcard.template
+
+    parts = [
+        CACHE_VERSION, base_url,
+        reportcard.id, reportcard.modified, template.id, term.id, term.modified, school_year.id,
+        school_year.principal_id, school_year.principal_title_en, school_year.principal_title_fr,
+        school_year.vice_principal_id, school_year.vice_principal_title_en, school_year.vice_principal_title_fr,
+    ]
+
+    # Student details and attendance, as shown on the card
+    parts += sorted((key, str(value)) for key, value in reportcard.data.items() if key != 'rc')
+
+    # Marks and comments for this and prior terms
+    parts += list(ReportCardEntry.objects.filter(
+        reportcard__student=reportcard.student_id,
+        reportcard__term__school_year=school_year,
+    ).order_by('id').values_list('id', 'modified'))
+
+    # Template text and structure
+    parts += [template.get_template(name) for name in TEMPLATE_FIELDS]
+    parts += [
+        ReportCardSection.objects.filter(template=template).aggregate(m=Max('modified'))['m'],
+        ReportCardSubject.objects.filter(section__template=template).aggregate(m=Max('modified'))['m'],
+        ReportCardStrand.objects.filter(subject__section__template=template).aggregate(m=Max('modified'))['m'],
+        ReportCardAccess.objects.aggregate(m=Max('modified'))['m'],
+    ]
+    parts += [model.objects.aggregate(m=Max('modified'))['m']
+              for model in (GradingScheme, GradingSchemeLevel, GradingSchemeLevelChoice)]
+    parts += teachers.get_resolver(term).teacher_ids(reportcard.student_id)
+    parts += list(ReportCardYearGradeContent.objects.filter(
+        school_year=school_year, grade_level=reportcard.student.year_id).values_list('id', 'modified'))
+
+    # Images and signatures
+    parts += list(ReportCardTemplateImage.objects.order_by('id').values_list('name', 'image', 'modified'))
+    parts += list(Faculty.objects.filter(is_active=True).exclude(signature='').exclude(
+        signature__isnull=True).order_by('id').values_list('id', 'signature'))
+
+    parts += [getattr(config, name) for name in SCHOOL_CONFIG]
+
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _path(digest):
+    return '%s/%s/%s.pdf' % (CACHE_DIR, digest[:2], digest)
+
+
+def lookup(reportcard, base_url=None):
+    """Find a cached PDF for a report card rendered against base_url.
+
+    Returns (digest, pdf).  pdf is None on a miss.  digest is None when the
+    report card is not cacheable.
+    """
+    if not cacheable(reportcard):
+        return None, None
+    digest = reportcard_digest(reportcard, base_url)
+    path = _path(digest)
+    if private_storage.exists(path):
+        with private_storage.open(path, 'rb') as cached:
+            return digest, cached.read()
+    return digest, None
+
+
+def store(reportcard, digest, pdf):
+    """Save a freshly rendered PDF, replacing the report card's previous one."""
+    if digest is None:
+        return
+    invalidate(reportcard.id)
+    path = _path(digest)
+    if not private_storage.exists(path):
+        private_storage.save(path, ContentFile(pdf))
+    shared.set_value(POINTER_KEY % reportcard.id, digest)
+
+
+def invalidate(*reportcard_ids):
+    """Remove cached PDFs for the given report cards."""
+    keys = [POINTER_KEY % rc_id for rc_id in reportcard_ids]
+    for key, digest in shared.get_many(keys).items():
+        try:
+            private_storage.delete(_path(digest))
+        except OSError:
+            logger.warning("Unable to delete cached report card %s", digest, exc_info=True)
+    shared.delete_many(keys)
+
+
+def sweep(max_age=None):
+    """Delete cached PDFs older than max_age seconds.  Returns how many were deleted."""
+    cutoff = timezone.now() - timedelta(seconds=MAX_AGE if max_age is None else max_age)
+    deleted = 0
+    try:
+        prefixes, _ = private_storage.listdir(CACHE_DIR)
+    except OSError:
+        return 0
+    for prefix in prefixes:
+        directory = '%s/%s' % (CACHE_DIR, prefix)
+        for name in private_storage.listdir(directory)[1]:
+            path = '%s/%s' % (directory, name)
+            try:
+                if private_storage.get_modified_time(path) < cutoff:
+                    private_storage.delete(path)
+                    deleted += 1
+            except OSError:
+                logger.warning("Unable to sweep cached report card %s", path, exc_info=True)
+    return deleted
+
+
+def invalidate_queryset(reportcards):
+    invalidate(*reportcards.values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=ReportCardEntry)
+def entry_changed(sender, instance, **kwargs):
+    invalidate(instance.reportcard_id)
+
+
+@receiver(post_save, sender=ReportCardTemplate)
+def template_changed(sender, instance, **kwargs):
+    invalidate_queryset(ReportCard.objects.filter(template=instance))
+
+
+@receiver(post_save, sender=ReportCardSharedTemplate)
+def shared_template_changed(sender, instance, **kwargs):
+    invalidate_queryset(ReportCard.objects.filter(template__shared_template=instance))
+
+
+@receiver([post_save, post_delete], sender=ReportCardYearGradeContent)
+def static_content_changed(sender, instance, **kwargs):
+    invalidate_queryset(ReportCard.objects.filter(
+        term__school_year=instance.school_year_id, student__year=instance.grade_level_id))
@@ -0,0 +1,469 @@
+"""Report card rendering.
+
+HTML for a report card is prepared in the calling process (it needs the ORM),
+then handed to wkhtmltopdf.  Batches render their PDFs on a bounded worker
+pool and are returned in the same order as the students were given.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from constance import config
+from django.conf import settings
+from django.http import Http404
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+from unidecode import unidecode
+
+from indysis_reportcard import archive, pdf_cache, template_cache
+from indysis_reportcard.bundle import ReportCardBundle
+from indysis_reportcard.comment_report import CommentReport
+from indysis_reportcard.element_index import ElementIndex
+from indysis_reportcard.models import ReportCard
+from sis.studentdb.models import Faculty
+from sis.studentdb.pdf_render import render_pdf
+
+logger = logging.getLogger(__name__)
+
+# wkhtmltopdf runs as a child process, so threads are enough to keep every core busy.
+RENDER_WORKERS = getattr(settings, 'REPORTCARD_RENDER_WORKERS', None) or os.cpu_count() or 1
+
+PDF_OPTIONS = {
+    'load-error-handling': 'skip',
+    'page-size': 'Letter',
+    'margin-top': '0.6in',
+    'margin-left': '0.5in',
+    'margin-right': '0.5in',
+    'margin-bottom': '0.6in',
+    'encoding': "UTF-8",
+    'no-outline': None,
+    'no-header-line': None,
+    'disable-smart-shrinking': None,
+    'zoom': 1,
+}
+
+COMMENT_REPORT_PDF_OPTIONS = {
+    'load-error-handling': 'skip',
+    'page-size': 'Letter',
+    'margin-top': '1in',
+    'margin-left': '0.5in',
+    'margin-right': '0.5in',
+    'margin-bottom': '0.8in',
+    'encoding': "UTF-8",
+    'no-outline': None,
+    'no-header-line': None,
+    'disable-smart-shrinking': None,
+    'zoom': 1,
+    'dpi': 300,
+}
+
+
+class PreparedReportCard(object):
+    """The rendered HTML parts of one report card."""
+
+    def __init__(self, reportcard, data, header, footer, cover, content):
+        self.reportcard = reportcard
+        self.data = data
+        self.header = header
+        self.footer = footer
+        self.cover = cover
+        self.content = content
+
+    @property
+    def filename(self):
+        return self.reportcard.filename
+
+
+class BatchResult(object):
+    """Outcome of rendering one report card in a batch."""
+
+    def __init__(self, student, reportcard=None, prepared=None, pdf=None, error=None, digest=None):
+        self.student = student
+        self.reportcard = reportcard
+        self.prepared = prepared
+        self.pdf = pdf
+        self.error = error
+        self.digest = digest
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def filename(self):
+        if self.reportcard:
+            return self.reportcard.filename
+        return self.student.fullname + ".pdf"
+
+
+def stage_signatures():
+    """Copy faculty signatures to /tmp, where the report card templates expect them."""
+    for teach in Faculty.objects.filter(is_active=True).exclude(signature='').exclude(signature__isnull=True):
+        sigpath = "/tmp/%s" % os.path.basename(teach.signature.url_300x60)
+        if not os.path.exists(sigpath):
+            shutil.copy(
+                os.path.join(settings.MEDIA_ROOT, 'signatures',
+                             os.path.basename(
+                                 teach.signature.url_300x60)), sigpath)
+
+
+def get_reportcard(student, term):
+    """Find the report card for a student and term, or raise Http404."""
+    template = term.get_template(grade=student.year)
+    reportcard = ReportCard.objects.filter(student=student,
+                                           term=term, template=template).first()
+
+    if not reportcard:
+        raise Http404('No report card data found for student %s' % student.fullname)
+    return reportcard
+
+
+def basic_context(reportcard, html=False, base_url=None, data=None):
+    """Report card data, school details and the main objects, without loading any entries."""
+    data = deepcopy(reportcard.data if data is None else data)
+    data.update(dict(
+        reportcard=reportcard,
+        student=reportcard.student,
+        term=reportcard.term,
+        template=reportcard.template,
+        school_name=config.SCHOOL_NAME,
+        school_address_line1=config.SCHOOL_ADDRESS_LINE1,
+        school_address_line2=config.SCHOOL_ADDRESS_LINE2,
+        school_address_city=config.SCHOOL_ADDRESS_CITY,
+        school_address_provstate=config.SCHOOL_ADDRESS_PROVSTATE,
+        school_address_postcode=config.SCHOOL_ADDRESS_POSTCODE,
+        school_email=config.SCHOOL_EMAIL,
+        school_phone=config.SCHOOL_PHONE,
+        school_fax=config.SCHOOL_FAX,
+        html=html,
+        base_url=base_url,
+    ))
+    return data
+
+
+def reportcard_context(reportcard, html=False, base_url=None, bundle=None):
+    """Build the template context used by the report card templates."""
+    if bundle is None:
+        bundle, = ReportCardBundle.load([reportcard])
+    reportcard = bundle.reportcard
+    term = reportcard.term
+
+    data = basic_context(reportcard, html=html, base_url=base_url, data=bundle.data)
+    terms = bundle.element_to_past.keys()
+
+    head = bundle.head
+    head_title = term.school_year.principal_title or ''
+    head_title_en = term.school_year.principal_title_en or ''
+    head_title_fr = term.school_year.principal_title_fr or ''
+    head_signature = ''
+    if head and head.signature:
+        head_signature = head.signature
+    head = head.fullname_nocomma
+
+    assistant_head = bundle.assistant_head
+    assistant_head_title = term.school_year.vice_principal_title or ''
+    assistant_head_title_en = term.school_year.vice_principal_title_en or ''
+    assistant_head_title_fr = term.school_year.vice_principal_title_fr or ''
+    assistant_head_signature = ''
+    if assistant_head and assistant_head.signature:
+        assistant_head_signature = assistant_head.signature
+    assistant_head = assistant_head.fullname_nocomma
+
+    data.update(dict(
+        element_to_entry=bundle.element_to_entry,
+        element_index=ElementIndex(reportcard, bundle.element_to_entry.values()),
+        element_to_past=bundle.element_to_past,
+        terms=terms,
+        term_objects=bundle.term_objects,
+        unseen_terms=range(len(terms) + 1, 3),
+        head=head,
+        head_title=head_title,
+        head_title_en=head_title_en,
+        head_title_fr=head_title_fr,
+        head_signature=head_signature,
+        assistant_head=assistant_head,
+        assistant_head_title=assistant_head_title,
+        assistant_head_title_en=assistant_head_title_en,
+        assistant_head_title_fr=assistant_head_title_fr,
+        assistant_head_signature=assistant_head_signature,
+        subject_teachers=bundle.subject_teachers,
+        teachers_by_subject=bundle.teachers_by_subject,
+        grading_schemes=bundle.grading_schemes,
+    ))
+
+    if bundle.static_content:
+        data['static_content'] = mark_safe(bundle.static_content.content)
+
+    data['images'] = bundle.images
+    return data
+
+
+def prepare_reportcard(reportcard, html=False, base_url=None, bundle=None):
+    """Render the header, footer, cover and body HTML of a report card."""
+    data = reportcard_context(reportcard, html=html, base_url=base_url, bundle=bundle)
+    reportcard = data['reportcard']
+    template = reportcard.template
+    return PreparedReportCard(
+        reportcard, data,
+        header=template_cache.render_field(template, 'header_template', data),
+        footer=template_cache.render_field(template, 'footer_template', data),
+        cover=template_cache.render_field(template, 'coverpage_template', data),
+        content=template_cache.render_field(template, 'body_template', data),
+    )
+
+
+def html_to_pdf(content, header=None, footer=None, cover=None, options=None):
+    """Render report card HTML to PDF bytes.
+
+    Does not touch the database, so it is safe to call from a worker thread.
+    """
+    return render_pdf(content, header=header, footer=footer, cover=cover, options=options or PDF_OPTIONS)
+
+
+def render_prepared(prepared):
+    """Turn a prepared report card into a PDF."""
+    return html_to_pdf(prepared.content, prepared.header, prepared.footer, prepared.cover)
+
+
+def rendered_context(reportcard, prepared=None, base_url=None):
+    """The template context of a rendered report card.
+
+    That is the context it was prepared with, or the same context built
+    again when its PDF came from the archive or cache, so templates that use
+    it (the email ones) see the same keys either way.
+    """
+    if prepared is not None:
+        return prepared.data
+    return reportcard_context(reportcard, base_url=base_url)
+
+
+def render_reportcard(reportcard, base_url=None, context=True):
+    """Render a report card to PDF, from the term archive or cache when possible.
+
+    Returns (pdf, data), data being the template context, or None if context is False.
+    """
+    pdf = archive.lookup(reportcard)
+    if pdf is None:
+        digest, pdf = pdf_cache.lookup(reportcard, base_url)
+    if pdf is not None:
+        return pdf, rendered_context(reportcard, base_url=base_url) if context else None
+
+    prepared = prepare_reportcard(reportcard, base_url=base_url)
+    stage_signatures()
+    pdf = render_prepared(prepared)
+    pdf_cache.store(reportcard, digest, pdf)
+    return pdf, prepared.data
+
+
+def find_reportcards(students, term):
+    """Report cards for a list of students, keyed by student id.
+
+    As get_reportcard for each student, but in a query per grade.  Students
+    with no report card map to the exception get_reportcard would raise.
+    """
+    templates = {}
+    for grade_id in {student.year_id for student in students}:
+        try:
+            templates[grade_id] = term.get_template(grade=grade_id)
+        except Exception as e:
+            templates[grade_id] = e
+
+    found = {}
+    for reportcard in ReportCard.objects.filter(student__in=students, term=term).order_by('id'):
+        found.setdefault((reportcard.student_id, reportcard.template_id), reportcard)
+
+    reportcards = {}
+    for student in students:
+        template = templates[student.year_id]
+        if isinstance(template, Exception):
+            reportcards[student.id] = template
+        else:
+            reportcards[student.id] = found.get((student.id, template.id)) or Http404(
+                'No report card data found for student %s' % student.fullname)
+    return reportcards
+
+
+def _lookup(student, reportcard, base_url):
+    """Find a student's report card, and its PDF if it is archived or cached."""
+    result = BatchResult(student)
+    try:
+        if isinstance(reportcard, Exception):
+            raise reportcard
+        result.reportcard = reportcard
+        result.pdf = archive.lookup(reportcard)
+        if result.pdf is None:
+            result.digest, result.pdf = pdf_cache.lookup(reportcard, base_url)
+    except Exception as e:
+        logger.exception("Unable to prepare report card for %s", student.fullname)
+        result.error = e
+    return result
+
+
+def _load_bundles(results):
+    """Bundles for the results that still need rendering, keyed by report card id."""
+    reportcards = [result.reportcard for result in results if result.ok and result.pdf is None]
+    try:
+        return {bundle.reportcard.id: bundle for bundle in ReportCardBundle.load(reportcards)}
+    except Exception:
+        # Leave each card to load its own data, so one bad card fails alone
+        logger.exception("Unable to load report cards in bulk")
+        return {}
+
+
+def _submit(executor, result, bundle, base_url):
+    """Prepare one student's HTML and queue the PDF render."""
+    if not result.ok or result.pdf is not None:
+        return result, None
+    try:
+        result.prepared = prepare_reportcard(result.reportcard, base_url=base_url, bundle=bundle)
+    except Exception as e:
+        logger.exception("Unable to prepare report card for %s", result.student.fullname)
+        result.error = e
+        return result, None
+    return result, executor.submit(render_prepared, result.prepared)
+
+
+def _collect(result, future):
+    if future is not None:
+        try:
+            result.pdf = future.result()
+        except Exception as e:
+            logger.exception("Unable to render report card for %s", result.student.fullname)
+            result.error = e
+        else:
+            pdf_cache.store(result.reportcard, result.digest, result.pdf)
+    return result
+
+
+def render_batch(students, term, base_url=None, workers=None):
+    """Render report cards for many students.
+
+    Yields a BatchResult per student, in the order given.  Failures are
+    reported on the result rather than raised, so one bad card does not
+    abort the batch.
+    """
+    workers = workers or RENDER_WORKERS
+    stage_signatures()
+    students = iter(students)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Load report cards a pool's worth at a time, in bulk
+        for chunk in iter(lambda: list(islice(students, workers * 2)), []):
+            reportcards = find_reportcards(chunk, term)
+            results = [_lookup(student, reportcards[student.id], base_url) for student in chunk]
+            bundles = _load_bundles(results)
+            for result in results:
+                bundle = bundles.get(result.reportcard.id) if result.reportcard else None
+                pending.append(_submit(executor, result, bundle, base_url))
+                # Keep the pool fed without holding the whole grade in memory
+                while len(pending) > workers * 2:
+                    yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+    logger.debug("Template cache: %s", template_cache.stats())
+
+
+def batch_failure_text(failures):
+    """Plain text listing of failed cards."""
+    return "\n".join("%s: %s" % (result.student.fullname, result.error) for result in failures) + "\n"
+
+
+def write_merged_pdf(results, out):
+    """Merge successfully rendered cards into one PDF.  Returns the failures.
+
+    Each card is spooled to a temporary file as it arrives, so the rendered
+    bytes are not held in memory.  Memory is not flat though: PyPDF2 only
+    copies pages when the writer is written, so every card's file stays open
+    until the end and the writer then holds the objects of every page.  Both
+    grow with the batch, which is one grade or one export job.
+    """
+    failures = []
+    writer = PdfFileWriter()
+    spooled = []
+    try:
+        for result in results:
+            if result.ok:
+                pdf = tempfile.TemporaryFile()
+                pdf.write(result.pdf)
+                pdf.seek(0)
+                spooled.append(pdf)
+                reader = PdfFileReader(pdf)
+                for number in range(reader.getNumPages()):
+                    writer.addPage(reader.getPage(number))
+            else:
+                failures.append(result)
+        writer.write(out)
+    finally:
+        for pdf in spooled:
+            pdf.close()
+    return failures
+
+
+class StreamBuffer(object):
+    """Write-only file whose contents are handed out in chunks as they are written."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(results, failures=None):
+    """Yield a ZIP of the rendered cards, a card at a time.
+
+    Failed cards are appended to failures, if given, and listed in FAILED.txt.
+    """
+    failures = [] if failures is None else failures
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip:
+        for result in results:
+            if result.ok:
+                zip.writestr(unidecode(result.filename).replace('/', '-'), result.pdf)
+                yield buffer.drain()
+            else:
+                failures.append(result)
+        if failures:
+            zip.writestr("FAILED.txt", batch_failure_text(failures))
+    yield buffer.drain()
+
+
+def write_zip(results, out):
+    """Write each rendered card into a ZIP file.  Returns the failures."""
+    failures = []
+    for chunk in stream_zip(results, failures):
+        out.write(chunk)
+    return failures
+
+
+def comment_report_data(term, grade):
+    """Gather the section and subject grids for a grade's comment report."""
+    return CommentReport(term, grade).data()
+
+
+def comment_report_html(term, grade):
+    """Render the comment report for a grade as HTML."""
+    return get_template('comment_report_template.html').render(dict(
+        data=comment_report_data(term, grade),
+    ))
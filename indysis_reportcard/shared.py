@@ -0,0 +1,153 @@
+"""Small values every web and Celery process must agree on.
+
+The access index and the grading registry are kept in process, and need to
+hear when another process changes what they were built from.  They do that
+through generation numbers kept here.  The PDF cache keeps its pointers to
+each report card's latest file here, so any process can delete it.
+
+Values live in Redis (REPORTCARD_SHARED_REDIS_URL, by default the Celery
+broker), as edit leases do.  Set REPORTCARD_SHARED_BACKEND to 'memory' to
+keep them in process instead, eg. for tests.  While Redis can't be reached
+generation() returns None, so data built during the outage is dropped once
+it is back, and until then only expires with its timeout.
+"""
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BACKEND = getattr(settings, 'REPORTCARD_SHARED_BACKEND', 'redis')
+REDIS_URL = getattr(settings, 'REPORTCARD_SHARED_REDIS_URL', getattr(settings, 'CELERY_BROKER_URL', None))
+
+
+class MemoryBackend(object):
+    """Values in a dict, for a single process."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self.lock:
+            return [self.values.get(key) for key in keys]
+
+    def add(self, key, value):
+        with self.lock:
+            self.values.setdefault(key, str(value))
+
+    def incr(self, key):
+        with self.lock:
+            self.values[key] = str(int(self.values.get(key, 0)) + 1)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = str(value)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+
+class RedisBackend(object):
+    """Values as Redis keys, which never expire."""
+
+    def __init__(self, url=None, client=None):
+        self.client = client or redis.StrictRedis.from_url(url or REDIS_URL)
+
+    def get_many(self, keys):
+        return [None if value is None else value.decode('utf-8') for value in self.client.mget(keys)]
+
+    def add(self, key, value):
+        self.client.setnx(key, value)
+
+    def incr(self, key):
+        self.client.incr(key)
+
+    def set(self, key, value):
+        self.client.set(key, value)
+
+    def delete_many(self, keys):
+        self.client.delete(*keys)
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'redis': RedisBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = BACKENDS[BACKEND]()
+        return _backend
+
+
+def set_backend(backend):
+    """Use a different backend.  Returns the previous one."""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def generation(key):
+    """The current value of a generation number, or None if it can't be read."""
+    backend = get_backend()
+    try:
+        value, = backend.get_many([key])
+        if value is None:
+            # Start from the time rather than 0, so a lost counter never repeats an old value
+            backend.add(key, int(time.time() * 1000))
+            value, = backend.get_many([key])
+    except redis.RedisError:
+        logger.warning("Unable to read generation %s", key, exc_info=True)
+        return None
+    return value
+
+
+def bump(key):
+    """Change a generation number, so every process drops what it built from the old one."""
+    try:
+        get_backend().incr(key)
+    except redis.RedisError:
+        logger.warning("Unable to bump generation %s", key, exc_info=True)
+
+
+def get_many(keys):
+    """{key: value} for those of the keys that are set."""
+    keys = list(keys)
+    if not keys:
+        return {}
+    try:
+        values = get_backend().get_many(keys)
+    except redis.RedisError:
+        logger.warning("Unable to read shared values", exc_info=True)
+        return {}
+    return {key: value for key, value in zip(keys, values) if value is not None}
+
+
+def set_value(key, value):
+    try:
+        get_backend().set(key, value)
+    except redis.RedisError:
+        logger.warning("Unable to set shared value %s", key, exc_info=True)
+
+
+def delete_many(keys):
+    keys = list(keys)
+    if not keys:
+        return
+    try:
+        get_backend().delete_many(keys)
+    except redis.RedisError:
+        logger.warning("Unable to delete shared values", exc_info=True)
@@ -0,0 +1,102 @@
+// Field level saving of report card entries.
+//
+// Each change to an entry's mark or comment is sent on its own to the
+// save_entry view, with the entry's modified stamp so that edits made
+// elsewhere in the meantime are not overwritten.  Saves of the same entry
+// are sent one after another, each with the stamp the previous one returned,
+// so quick successive edits are not mistaken for a conflict.
+
+var ENTRY_FIELD_PAIRS = {
+  'choice': 'percentile',
+  'percentile': 'choice',
+  'second_choice': 'second_percentile',
+  'second_percentile': 'second_choice'
+};
+
+function entry_csrf_token() {
+  var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+  return match ? decodeURIComponent(match[1]) : null;
+}
+
+function setup_entry_save($, url_template, url_extra) {
+  var $form = $('#edit_rc');
+  var versions = $form.data('entry-versions') || {};
+  var timers = {};
+  var queues = {};
+
+  function field_value($form, name) {
+    var $input = $form.find('[name="' + name + '"]');
+    if ($input.is(':radio')) {
+      $input = $input.filter(':checked');
+    }
+    var value = $input.val();
+    return (value === undefined || value === '') ? null : value;
+  }
+
+  function save($input) {
+    var match = /^(form-\d+)-(\w+)$/.exec($input.attr('name'));
+    if (!match || !(match[2] in ENTRY_FIELD_PAIRS || match[2] === 'comment')) {
+      return;
+    }
+    var prefix = match[1], field = match[2];
+    var entry_id = $form.find('[name="' + prefix + '-id"]').val();
+    var fields = {};
+    fields[field] = field_value($form, prefix + '-' + field);
+    var pair = ENTRY_FIELD_PAIRS[field];
+    if (pair && $form.find('[name="' + prefix + '-' + pair + '"]').length) {
+      fields[pair] = field_value($form, prefix + '-' + pair);
+    }
+
+    enqueue(entry_id, function () {
+      return send($input, entry_id, fields);
+    });
+  }
+
+  function enqueue(entry_id, run) {
+    var previous = queues[entry_id];
+    var finished = $.Deferred();
+    queues[entry_id] = finished.promise();
+
+    function start() {
+      run().always(finished.resolve);
+    }
+
+    if (previous) {
+      previous.always(start);
+    } else {
+      start();
+    }
+  }
+
+  function send($input, entry_id, fields) {
+    return $.ajax({
+      url: url_template.replace(/0$/, entry_id) + (url_extra || ''),
+      type: 'POST',
+      contentType: 'application/json',
+      headers: {'X-CSRFToken': entry_csrf_token()},
+      data: JSON.stringify({fields: fields, modified: versions[entry_id]})
+    }).done(function (result) {
+      versions[entry_id] = result.modified;
+      $input.closest('.form-group, td').removeClass('has-error').toggleClass('has-success', result.completed);
+    }).fail(function (xhr) {
+      var result = xhr.responseJSON || {};
+      $input.closest('.form-group, td').addClass('has-error');
+      if (result.conflict) {
+        alert('This mark or comment was changed by someone else. Reload the page to see their changes.');
+      } else if (result.errors) {
+        alert(result.errors.join('\n'));
+      }
+    });
+  }
+
+  $form.on('change', 'select, input:radio, input[type=number], input[type=text]', function () {
+    save($(this));
+  });
+  $form.on('input', 'textarea', function () {
+    var $input = $(this), name = $input.attr('name');
+    clearTimeout(timers[name]);
+    timers[name] = setTimeout(function () {
+      save($input);
+    }, 2000);
+  });
+}
@@ -0,0 +1,27 @@
+"""Storage for generated report card files that must not be public.
+
+Everything under MEDIA_ROOT is served to anyone by the web server.  Archived
+and exported report cards are kept under REPORTCARD_PRIVATE_ROOT instead and
+only handed out by views that check the user.
+"""
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class PrivateStorage(FileSystemStorage):
+    """File system storage outside the media root, with no public URL."""
+
+    @property
+    def base_location(self):
+        default = getattr(settings, 'REPORTCARD_PRIVATE_ROOT', os.path.join(settings.BASE_DIR, 'private'))
+        return self._value_or_setting(self._location, default)
+
+    def url(self, name):
+        raise ValueError("Private report card files have no public URL")
+
+
+private_storage = PrivateStorage()
@@ -1,22 +1,176 @@
+import json
 import logging
+import tempfile
+from itertools import groupby
 
-from django.db import transaction
+from celery import chord
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db.models import F
+from django.utils import timezone
 from raven.contrib.django.raven_compat.models import client
 
 from indy_sis.celery import app
-from indysis_reportcard.models import ReportCardTerm, ReportCard, ReportCardTemplate
+from indysis_reportcard import archive
+from indysis_reportcard.emails import email_reportcards
+from indysis_reportcard.materialize import chunked, materialize_reportcards
+from indysis_reportcard.models import ReportCardTerm, ReportCardExportJob, ReportCardArchive
+from indysis_reportcard.rendering import (COMMENT_REPORT_PDF_OPTIONS, batch_failure_text, comment_report_html,
+                                          html_to_pdf, render_batch, write_merged_pdf, write_zip)
 from sis.studentdb.models import Student
 
 
 @app.task
 def create_reportcards(term_id):
+    """Create the report cards and entries for every active student in a term."""
     term = ReportCardTerm.objects.get(pk=term_id)
-    for student in Student.objects.filter(is_active=True, year__isnull=False):
-        template = term.get_template(grade=student.year)
-        with transaction.atomic():
-            try:
-                reportcard = ReportCard.objects.get_or_create(student=student, term=term, template=template)
-                print("checking report card %s, %s, %s, %s" % (student, term, template, reportcard))
-                template.get_or_create_all_entries(reportcard[0])
-            except Exception as e:
-                client.captureException()
+    return materialize_reportcards(term).as_dict()
+
+
+OPEN_CHUNK_SIZE = getattr(settings, 'REPORTCARD_OPEN_CHUNK_SIZE', 100)
+
+
+@app.task
+def open_term(term_id):
+    """Create a newly opened term's report cards, a chunk of one grade's students per subtask.
+
+    Progress and failures are recorded on the term; finish_open_term marks it
+    ready once every chunk has run.
+    """
+    students = Student.objects.filter(is_active=True, year__isnull=False).order_by('year', 'id').values_list(
+        'year_id', 'id')
+    chunks = []
+    for grade_id, rows in groupby(students, key=lambda row: row[0]):
+        chunks += chunked([student_id for grade_id, student_id in rows], OPEN_CHUNK_SIZE)
+    ReportCardTerm.objects.filter(pk=term_id).update(
+        open_state=ReportCardTerm.OPEN_RUNNING, open_progress=0, open_total=sum(len(ids) for ids in chunks),
+        open_failures='', open_finished=None)
+    if not chunks:
+        return finish_open_term([], term_id)
+    chord(open_term_chunk.s(term_id, ids) for ids in chunks)(finish_open_term.s(term_id))
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=30)
+def open_term_chunk(self, term_id, student_ids):
+    """Create the report cards and entries for some of a term's students.
+
+    Safe to run again, since only missing rows are created.  Once out of
+    retries the failure is returned rather than raised, so the term still
+    finishes opening.
+    """
+    term = ReportCardTerm.objects.get(pk=term_id)
+    try:
+        result = materialize_reportcards(term, Student.objects.filter(id__in=student_ids)).as_dict()
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        logging.exception("Unable to create report cards for %d students in %s", len(student_ids), term)
+        client.captureException()
+        result = dict(reportcards_created=0, entries_created=0,
+                      failures=[dict(student=student_id, error=str(e)) for student_id in student_ids])
+    ReportCardTerm.objects.filter(pk=term_id).update(open_progress=F('open_progress') + len(student_ids))
+    return result
+
+
+@app.task
+def finish_open_term(results, term_id):
+    """Record the outcome of opening a term once every chunk is done."""
+    failures = [failure for result in results for failure in result['failures']]
+    ReportCardTerm.objects.filter(pk=term_id).update(
+        open_state=ReportCardTerm.OPEN_FAILED if failures else ReportCardTerm.OPEN_READY,
+        open_progress=F('open_total'),
+        open_failures=json.dumps(failures) if failures else '',
+        open_finished=timezone.now())
+    return dict(reportcards_created=sum(result['reportcards_created'] for result in results),
+                entries_created=sum(result['entries_created'] for result in results),
+                failures=failures)
+
+
+def _track_progress(job, results):
+    """Pass batch results through, recording progress on the job."""
+    for done, result in enumerate(results, 1):
+        job.set_progress(done)
+        yield result
+
+
+@app.task
+def run_export_job(job_id):
+    """Build the output file for a queued export job."""
+    job = ReportCardExportJob.objects.get(pk=job_id)
+    job.set_state(ReportCardExportJob.RUNNING)
+    failures = []
+    try:
+        if job.kind == ReportCardExportJob.COMMENT_REPORT:
+            job.set_progress(0, total=1)
+            pdf = html_to_pdf(comment_report_html(job.term, job.grade_level), options=COMMENT_REPORT_PDF_OPTIONS)
+            job.output.save(job.filename, ContentFile(pdf), save=False)
+            job.set_progress(1)
+        else:
+            students = Student.objects.filter(year=job.grade_level, is_active=True).order_by(
+                "last_name", "first_name")
+            job.set_progress(0, total=students.count())
+            results = _track_progress(job, render_batch(students, job.term, base_url=job.base_url or None))
+            write = write_zip if job.kind == ReportCardExportJob.ZIP else write_merged_pdf
+            with tempfile.TemporaryFile() as out:
+                failures = write(results, out)
+                out.seek(0)
+                job.output.save(job.filename, File(out), save=False)
+    except Exception as e:
+        logging.exception("Export job %s failed", job.id)
+        client.captureException()
+        job.set_state(ReportCardExportJob.FAILED, str(e))
+        return
+
+    job.state = ReportCardExportJob.DONE
+    job.message = batch_failure_text(failures) if failures else ''
+    job.save()
+
+
+@app.task
+def archive_term(term_id, base_url=None):
+    """Render every report card in a closed term into a new archive.
+
+    base_url is the site address images and stylesheets are loaded from, as for exports.
+    """
+    term = ReportCardTerm.objects.get(pk=term_id)
+    if term.is_open:
+        return
+    students = Student.objects.filter(reportcard__term=term).distinct().order_by(
+        'year', 'last_name', 'first_name')
+    term_archive = ReportCardArchive.objects.create(term=term, total=students.count(), base_url=base_url or '')
+    failures = []
+    try:
+        for done, result in enumerate(render_batch(students, term, base_url=term_archive.base_url or None), 1):
+            if result.ok:
+                archive.add(term_archive, result)
+            else:
+                failures.append(result)
+            if done % 10 == 0:
+                ReportCardArchive.objects.filter(pk=term_archive.pk).update(progress=done)
+        archive.write_manifest(term_archive)
+    except Exception as e:
+        logging.exception("Archiving term %s failed", term)
+        client.captureException()
+        term_archive.state = ReportCardArchive.FAILED
+        term_archive.message = str(e)
+        term_archive.save()
+        return
+
+    term_archive.progress = term_archive.total
+    term_archive.message = batch_failure_text(failures) if failures else ''
+    # The term may have been reopened while we were rendering
+    term.refresh_from_db()
+    term_archive.state = ReportCardArchive.STALE if term.is_open else ReportCardArchive.COMPLETE
+    term_archive.save()
+
+
+@app.task
+def send_reportcard_emails(term_id, recipients, mark_emailed=False, base_url=None, bcc_ok=False):
+    """Email report cards.  recipients is a list of (student id, [addresses]) pairs."""
+    term = ReportCardTerm.objects.get(pk=term_id)
+    recipients = {student_id: addresses for student_id, addresses in recipients}
+    students = Student.objects.filter(id__in=recipients).order_by('last_name', 'first_name')
+    mailer = email_reportcards(students, term, recipients, mark_emailed=mark_emailed, base_url=base_url,
+                               bcc_ok=bcc_ok)
+    return dict(sent=mailer.sent, emailed=len(mailer.emailed), failed=[student.id for student in mailer.failed])
@@ -0,0 +1,104 @@
+"""Which teachers are named against each subject on a student's report card.
+
+ReportCardSubject.teachers(student) takes a multi-join query per subject and
+student, and rendering a card asked it for every subject.  SubjectTeachers
+works the same answer out for a whole set of students in two queries and
+keeps it, per term, for the rendering and editing pages.
+
+Resolvers share the access index's generation number and timeout, so they
+are rebuilt whenever access rules or class memberships change.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from django.db.models import F, Q
+
+from indysis_reportcard import access
+from indysis_reportcard.models import ReportCardTerm
+from sis.studentdb.models import Faculty
+
+_lock = threading.Lock()
+_resolvers = {}
+
+
+class SubjectTeachers(object):
+    """Teachers by student and subject for one term, as ReportCardSubject.teachers(student)."""
+
+    def __init__(self, term_id, school_year_id):
+        self.term_id = term_id
+        self.school_year_id = school_year_id
+        self.teaching = {}
+        self.faculty = {}
+        self.rank = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, student_ids):
+        """Load the teachers of any of the students not seen yet."""
+        missing = set(student_ids) - set(self.teaching)
+        if not missing:
+            return
+        rows = Faculty.objects.filter(
+            Q(is_active=True) &
+            Q(classes__students__in=missing) &
+            Q(reportcardaccess__student_classes__students__in=missing) &
+            Q(reportcardaccess__student_classes__school_year=self.school_year_id) &
+            Q(reportcardaccess__teachers__in=F('reportcardaccess__student_classes__teachers'))
+        ).values_list('id', 'classes__students', 'reportcardaccess__student_classes__students',
+                      'reportcardaccess__sections', 'reportcardaccess__subjects').distinct()
+
+        teaching = {student_id: defaultdict(set) for student_id in missing}
+        for teacher_id, class_student, access_student, section_id, subject_id in rows:
+            if class_student == access_student:
+                if section_id is not None:
+                    teaching[class_student][('section', section_id)].add(teacher_id)
+                if subject_id is not None:
+                    teaching[class_student][('subject', subject_id)].add(teacher_id)
+
+        teacher_ids = {teacher_id for found in teaching.values() for ids in found.values() for teacher_id in ids}
+        with self.lock:
+            new = teacher_ids - set(self.faculty)
+            if new:
+                self.faculty.update((teacher.id, teacher) for teacher in Faculty.objects.filter(id__in=new))
+                ordered = sorted(self.faculty.values(),
+                                 key=lambda teacher: (teacher.last_name or '', teacher.first_name or ''))
+                self.rank = {teacher.id: n for n, teacher in enumerate(ordered)}
+            self.teaching.update(teaching)
+
+    def teachers(self, student_id, subject):
+        """Teachers of a subject for a student, in Faculty order."""
+        self.resolve([student_id])
+        found = self.teaching[student_id]
+        ids = found.get(('section', subject.section_id), set()) | found.get(('subject', subject.id), set())
+        return [self.faculty[teacher_id] for teacher_id in sorted(ids, key=self.rank.get)]
+
+    def teacher_ids(self, student_id):
+        """[(kind, section or subject id, [teacher ids])] for a student, in a stable order."""
+        self.resolve([student_id])
+        return sorted((kind, element_id, sorted(ids)) for (kind, element_id), ids in self.teaching[student_id].items())
+
+    def by_subject(self, student_id, subjects):
+        """{subject: teachers} for a student."""
+        return {subject: self.teachers(student_id, subject) for subject in subjects}
+
+
+def get_resolver(term):
+    """The subject teacher resolver for a term or term id."""
+    term_id = getattr(term, 'id', term)
+    current = access.generation()
+    with _lock:
+        entry = _resolvers.get(term_id)
+    if entry is not None and entry[0] == current and time.time() - entry[1] < access.TIMEOUT:
+        return entry[2]
+    school_year_id = getattr(term, 'school_year_id', None)
+    if school_year_id is None:
+        school_year_id = ReportCardTerm.objects.filter(pk=term_id).values_list('school_year', flat=True).first()
+    resolver = SubjectTeachers(term_id, school_year_id)
+    with _lock:
+        _resolvers[term_id] = (current, time.time(), resolver)
+    return resolver
+
+
+def clear():
+    with _lock:
+        _resolvers.clear()
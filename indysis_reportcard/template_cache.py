@@ -0,0 +1,90 @@
+"""Compiled template cache.
+
+Report card and email templates are stored as text in the database and were
+compiled again for every card rendered.  Compiled templates are kept here,
+per process, keyed on the object, the field and the modified stamps of the
+object and of any shared template the text came from.  A stale entry is never
+served: a changed stamp is a miss, and saving a template drops its entries.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import django.template
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from indysis_reportcard.models import ReportCardSharedTemplate, ReportCardTemplate, ReportCardTerm
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = getattr(settings, 'REPORTCARD_TEMPLATE_CACHE_SIZE', 256)
+
+_lock = threading.Lock()
+_templates = OrderedDict()
+_stats = dict(hits=0, misses=0)
+
+
+def _source(obj, field):
+    """The template text for a field, and the shared template it came from."""
+    if isinstance(obj, ReportCardTemplate):
+        text = getattr(obj, field)
+        if obj.shared_template_id and text in (None, ''):
+            return getattr(obj.shared_template, field), obj.shared_template
+    return getattr(obj, field), None
+
+
+def get_compiled(obj, field):
+    """The compiled template for a text field of a report card template or term."""
+    text, shared = _source(obj, field)
+    key = (obj._meta.label, obj.pk, field)
+    stamp = (obj.modified, shared.pk if shared else None, shared.modified if shared else None)
+    with _lock:
+        cached = _templates.get(key)
+        if cached is not None and cached[0] == stamp:
+            _templates.move_to_end(key)
+            _stats['hits'] += 1
+            return cached[1]
+        _stats['misses'] += 1
+
+    compiled = django.template.Template(text)
+    with _lock:
+        _templates[key] = (stamp, compiled)
+        while len(_templates) > CACHE_SIZE:
+            _templates.popitem(last=False)
+    return compiled
+
+
+def render_field(obj, field, data):
+    """Render a template field of a report card template or term."""
+    return get_compiled(obj, field).render(django.template.Context(data))
+
+
+def stats():
+    """Hit and miss counts, and the number of templates held."""
+    with _lock:
+        return dict(_stats, size=len(_templates))
+
+
+def clear():
+    with _lock:
+        _templates.clear()
+        _stats.update(hits=0, misses=0)
+
+
+def invalidate(obj):
+    """Drop the compiled templates of an object, and any that used it as their shared template."""
+    label = obj._meta.label
+    with _lock:
+        for key in [key for key, (stamp, compiled) in _templates.items()
+                    if key[:2] == (label, obj.pk)
+                    or (isinstance(obj, ReportCardSharedTemplate) and stamp[1] == obj.pk)]:
+            del _templates[key]
+
+
+@receiver([post_save, post_delete], sender=ReportCardTemplate)
+@receiver([post_save, post_delete], sender=ReportCardSharedTemplate)
+@receiver([post_save, post_delete], sender=ReportCardTerm)
+def template_changed(sender, instance, **kwargs):
+    invalidate(instance)
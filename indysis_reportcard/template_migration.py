@@ -0,0 +1,157 @@
+"""Moving report cards from one template to another.
+
+ReportCard.change_template used to look up each entry's equivalent with a
+query of its own and save or delete entries one at a time.  TemplateMigration
+matches a pair of templates' elements once, by the same names, and
+migrate_reportcards() applies the match to any number of report cards with
+one update per matched element and one delete, in a single transaction.
+Where two entries of a card end up on the same element of the new template,
+or the card already has an entry for it, they are merged as check_reportcards
+merges duplicates.  Given dry_run it reports what would happen and changes
+nothing.
+"""
+from collections import OrderedDict, defaultdict
+
+from django.core import serializers
+from django.db import transaction
+from django.utils import timezone
+
+from indysis_reportcard import duplicates, pdf_cache
+from indysis_reportcard.materialize import chunked
+from indysis_reportcard.models import (ReportCard, ReportCardCompletion, ReportCardEntry, ReportCardSection,
+                                       ReportCardStrand, ReportCardSubject)
+
+CHUNK_SIZE = 500
+
+
+def _label(section, subject=None, strand=None):
+    return ' / '.join(str(element) for element in (section, subject, strand) if element is not None)
+
+
+class TemplateMigration(object):
+    """Where each element's entries go when moving to new_template, as change_template matched them."""
+
+    def __init__(self, new_template):
+        self.new_template = new_template
+        self.sections = {}
+        self.subjects = {}
+        self.strands = {}
+        # The first match wins, in each model's default ordering
+        for section in ReportCardSection.objects.filter(template=new_template).order_by('sortorder', 'id'):
+            self.sections.setdefault(section.name, section)
+        for subject in ReportCardSubject.objects.filter(section__template=new_template).select_related(
+                'section').order_by('sortorder', 'id'):
+            self.subjects.setdefault((subject.section.name, subject.name_en, subject.name_fr), subject)
+        for strand in ReportCardStrand.objects.filter(subject__section__template=new_template).select_related(
+                'subject__section').order_by('sortorder', 'id'):
+            self.strands.setdefault((strand.subject.section.name, strand.subject.name_en, strand.subject.name_fr,
+                                     strand.text_en, strand.text_fr), strand)
+        self.labels = {}
+        for section in self.sections.values():
+            self.labels[(section.id, None, None)] = _label(section)
+        for subject in self.subjects.values():
+            self.labels[(subject.section_id, subject.id, None)] = _label(subject.section, subject)
+        for strand in self.strands.values():
+            self.labels[(strand.subject.section_id, strand.subject_id, strand.id)] = _label(
+                strand.subject.section, strand.subject, strand)
+        self.matches = {}
+
+    def match(self, entry):
+        """(section id, subject id, strand id) in the new template for an entry, or None."""
+        key = (entry.section_id, entry.subject_id, entry.strand_id)
+        if key not in self.matches:
+            self.matches[key] = self._match(entry)
+        return self.matches[key]
+
+    def _match(self, entry):
+        if entry.strand:
+            new = self.strands.get((entry.section.name, entry.subject.name_en, entry.subject.name_fr,
+                                    entry.strand.text_en, entry.strand.text_fr))
+            if new:
+                return new.subject.section_id, new.subject_id, new.id
+        elif entry.subject:
+            new = self.subjects.get((entry.section.name, entry.subject.name_en, entry.subject.name_fr))
+            if new:
+                return new.section_id, new.id, None
+        elif entry.section:
+            new = self.sections.get(entry.section.name)
+            if new:
+                return new.id, None, None
+        return None
+
+    def describe(self, key):
+        return self.labels[key]
+
+
+def migrate_reportcards(reportcards, new_template, dry_run=False):
+    """Move report cards to new_template, deleting entries with no equivalent.
+
+    Returns a diff: the elements matched and unmatched, with their entry
+    counts, the entries deleted, serialized, and the collisions, where
+    entries were merged into one, with the merged away entries serialized.
+    """
+    reportcards = list(reportcards)
+    migration = TemplateMigration(new_template)
+    targets = OrderedDict()
+    matched = OrderedDict()
+    unmatched = OrderedDict()
+    deleted = []
+    for entry in ReportCardEntry.objects.filter(reportcard__in=reportcards).select_related(
+            'section', 'subject', 'strand').order_by('reportcard_id', 'id'):
+        old = _label(entry.section, entry.subject, entry.strand)
+        new = migration.match(entry)
+        if new is None:
+            unmatched[old] = unmatched.get(old, 0) + 1
+            deleted.append(entry)
+        else:
+            targets.setdefault((entry.reportcard_id, new), []).append(entry)
+            matched.setdefault((old, new), 0)
+            matched[(old, new)] += 1
+
+    moves = defaultdict(list)
+    merges = []
+    for (reportcard_id, new), entries in targets.items():
+        keep, source, others = duplicates.plan(entries)
+        if others:
+            merges.append((reportcard_id, new, keep, source, others))
+        if new != (keep.section_id, keep.subject_id, keep.strand_id):
+            moves[new].append(keep.id)
+
+    students = {reportcard.id: reportcard.student.fullname for reportcard in ReportCard.objects.filter(
+        id__in={merge[0] for merge in merges}).select_related('student')}
+    diff = {
+        'template': str(new_template),
+        'reportcards': len(reportcards),
+        'matched': [dict(element=old, to=migration.describe(new), entries=count)
+                    for (old, new), count in matched.items()],
+        'unmatched': [dict(element=old, entries=count) for old, count in unmatched.items()],
+        'deleted': serializers.serialize('python', deleted),
+        'collisions': [dict(reportcard=reportcard_id, student=students.get(reportcard_id),
+                            element=migration.describe(new), entries=[keep.id] + [entry.id for entry in others],
+                            keep=keep.id, values_from=source.id)
+                       for reportcard_id, new, keep, source, others in merges],
+        'merged': serializers.serialize('python', [entry for merge in merges for entry in merge[4]]),
+    }
+    if dry_run:
+        return diff
+
+    ids = [reportcard.id for reportcard in reportcards]
+    with transaction.atomic():
+        # Merge first, so no two entries are moved onto the same element
+        duplicates.merge([(keep, source, others) for reportcard_id, new, keep, source, others in merges])
+        for chunk in chunked([entry.id for entry in deleted], CHUNK_SIZE):
+            ReportCardEntry.objects.filter(id__in=chunk).delete()
+        for (section_id, subject_id, strand_id), entry_ids in moves.items():
+            for chunk in chunked(entry_ids, CHUNK_SIZE):
+                ReportCardEntry.objects.filter(id__in=chunk).update(
+                    section_id=section_id, subject_id=subject_id, strand_id=strand_id)
+        # entries_version is reset so the new template's missing entries are created on next use
+        ReportCard.objects.filter(id__in=ids).update(
+            template=new_template, entries_version=0, modified=timezone.now())
+        for chunk in chunked(ids, CHUNK_SIZE):
+            ReportCardCompletion.refresh(chunk)
+    for reportcard in reportcards:
+        reportcard.template = new_template
+        reportcard.entries_version = 0
+    transaction.on_commit(lambda: pdf_cache.invalidate(*ids))
+    return diff
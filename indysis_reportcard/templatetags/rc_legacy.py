@@ -6,6 +6,7 @@ from django import template
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+from indysis_reportcard.grading import get_registry
 from indysis_reportcard.models import ReportCardEntry, ReportCard
 
 register = template.Library()
@@ -20,6 +21,8 @@ def reportcard_element_generic(context, item, field, entry,
                                for_print=False,
                                show_heading=True):
     heading = ""
+    if entry:
+        get_registry().prime(entry)
     if not entry:
         value = None
         # raise KeyError('item %s not found' % item)
@@ -125,6 +128,7 @@ def reportcard_element_print_if_equal(context, item, field='grade',
                                       value=None, print_value='X', for_print=True):
     entry = context['element_to_entry'].get(item, None)
     if field == 'grade':
+        get_registry().prime(entry)
         rc_value = entry.choice
         if entry.section.gradingscheme.percentile and not rc_value:
             rc_value = entry.percentile
@@ -1,8 +1,9 @@
 from django import template
 from django.core.exceptions import FieldError
-from django.db.models import Q
 
+from indysis_reportcard.element_index import ElementIndex
 from indysis_reportcard.models import ReportCardEntry, ReportCard, ReportCardSubject
+from indysis_reportcard.teachers import get_resolver
 from indysis_reportcard.templatetags.rc_legacy import reportcard_element
 
 register = template.Library()
@@ -15,46 +16,21 @@ def rc_format(item, field='grade'):
     return ''
 
 
+def element_index(context):
+    """The card's ElementIndex, from the render data or else made once per render."""
+    rc: ReportCard = context['reportcard']
+    index = context.get('element_index')
+    if index is None or index.reportcard_id != rc.id:
+        indexes = context.render_context.setdefault('element_indexes', {})
+        if rc.id not in indexes:
+            indexes[rc.id] = ElementIndex(rc)
+        index = indexes[rc.id]
+    return index
+
+
 @register.simple_tag(takes_context=True)
 def rc_item(context, section, subject, strand):
-    rc: ReportCard = context['reportcard']
-    entries = rc.reportcardentry_set
-    query = (
-        Q(section__name__iexact=section) |
-        Q(section__field_code__iexact=section)
-    )
-    try:
-        if str(int(section)) == section:
-            query |= Q(section__sortorder=int(section))
-    except ValueError:
-        pass
-
-    if subject:
-        query &= (
-            Q(subject__name__iexact=subject) |
-            Q(subject__field_code__iexact=subject)
-        )
-        try:
-            if str(int(subject)) == subject:
-                query |= Q(subject__sortorder=int(subject))
-        except ValueError:
-            pass
-    else:
-        query &= Q(subject__isnull=True)
-
-    if strand:
-        query &= (
-            Q(strand__text__iexact=strand) |
-            Q(strand__field_code__iexact=strand)
-        )
-        try:
-            if str(int(strand)) == strand:
-                query |= Q(strand__sortorder=int(strand))
-        except ValueError:
-            pass
-    else:
-        query &= Q(strand__isnull=True)
-    return entries.filter(query).first()
+    return element_index(context).get(section, subject, strand)
 
 
 @register.simple_tag(takes_context=True)
@@ -79,7 +55,13 @@ def subject_teachers(context, subject):
         return ''
     if not isinstance(subject, ReportCardSubject):
         return ''
-    teachers = subject.teachers(student)
+    teachers_by_subject = context.get('teachers_by_subject')
+    if teachers_by_subject is not None and subject in teachers_by_subject:
+        teachers = teachers_by_subject[subject]
+    elif context.get('reportcard') is not None:
+        teachers = get_resolver(context['reportcard'].term_id).teachers(student.id, subject)
+    else:
+        teachers = subject.teachers(student)
     return ' / '.join([teacher.fullname_nocomma for teacher in teachers])
 
 
@@ -0,0 +1,47 @@
+from collections import namedtuple
+
+from django.test import SimpleTestCase
+
+from indysis_reportcard.access import AccessIndex, Rule
+
+Teacher = namedtuple('Teacher', 'id')
+SchoolYear = namedtuple('SchoolYear', 'id')
+
+
+class AccessIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        # Template 1 for grade 7 has section 10 (subjects 100, 101) and section 11 (subject 110)
+        index = AccessIndex(1)
+        index.section_template = {10: 1, 11: 1}
+        index.subject_section = {100: 10, 101: 10, 110: 11}
+        index.section_subjects.update({10: [100, 101], 11: [110]})
+        index.template_grades[1] = {7}
+        index.rules = [
+            Rule(1, frozenset([5]), frozenset([10]), frozenset(), frozenset([50])),
+            Rule(2, frozenset([6]), frozenset(), frozenset([110]), frozenset([51])),
+        ]
+        index.class_year = {50: 2019, 51: 2018}
+        index.class_students.update({50: {1000, 1001}, 51: {1002}})
+        index.students = {1000: (7, True), 1001: (7, False), 1002: (7, True)}
+        self.index = index
+
+    def test_sections(self):
+        self.assertTrue(self.index.may_edit_section(Teacher(5), 10))
+        self.assertFalse(self.index.may_edit_section(Teacher(5), 11))
+        self.assertTrue(self.index.may_edit_section(Teacher(6), 11))
+        self.assertTrue(self.index.may_edit_section(None, 11))
+
+    def test_subjects(self):
+        self.assertEqual(self.index.subject_ids(Teacher(5)), {100, 101})
+        self.assertEqual(self.index.subject_ids(), {100, 101, 110})
+        self.assertEqual(self.index.subject_student_ids(110, Teacher(6)), {1002})
+        self.assertEqual(self.index.subject_student_ids(110, Teacher(5)), set())
+
+    def test_subject_grades(self):
+        self.assertEqual(self.index.subject_grades(110), {7})
+        self.assertEqual(self.index.subject_grades(999), set())
+
+    def test_students(self):
+        self.assertEqual(self.index.student_ids(Teacher(5), SchoolYear(2019)), {1000})
+        self.assertEqual(self.index.student_ids(None, SchoolYear(2018)), {1002})
+        self.assertEqual(self.index.subject_grade_pairs(Teacher(6)), {(110, 7)})
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from django.test import SimpleTestCase
+
+from indysis_reportcard.duplicates import plan
+from indysis_reportcard.models import ReportCardEntry
+
+
+def entry(id, modified, **values):
+    return ReportCardEntry(id=id, modified=datetime(2019, 6, modified), **values)
+
+
+class DuplicatesTestCase(SimpleTestCase):
+    def test_keeps_lowest_id(self):
+        entries = [entry(3, 1), entry(2, 1), entry(5, 1)]
+        keep, source, others = plan(entries)
+        self.assertEqual(keep.id, 2)
+        self.assertEqual([other.id for other in others], [3, 5])
+
+    def test_values_from_completed_then_fullest_then_latest(self):
+        self.assertEqual(plan([entry(1, 9, comment='Good'), entry(2, 1, completed=True)])[1].id, 2)
+        self.assertEqual(plan([entry(1, 1, comment='Good', percentile=80), entry(2, 9, comment='Fine')])[1].id, 1)
+        self.assertEqual(plan([entry(1, 1, comment='Good'), entry(2, 9, comment='Fine')])[1].id, 2)
@@ -0,0 +1,31 @@
+from collections import namedtuple
+
+from django.test import SimpleTestCase
+
+from indysis_reportcard.element_index import ElementIndex
+
+ReportCard = namedtuple('ReportCard', 'id')
+Entry = namedtuple('Entry', 'id')
+
+
+class ElementIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        index = ElementIndex(ReportCard(1), [Entry(i) for i in range(1, 5)])
+        index.rows = [
+            (1, 'Learning Skills', 'LS', 1, None, None, None, None, None, None, None, None),
+            (2, 'Learning Skills', 'LS', 1, 20, 'Responsibility', 'RESP', 1, None, None, None, None),
+            (3, 'Subjects', 'SUBJ', 2, 30, 'Math', 'MA', 2, None, None, None, None),
+            (4, 'Subjects', 'SUBJ', 2, 30, 'Math', 'MA', 2, 40, 'Number Sense', 'NS', 1),
+        ]
+        self.index = index
+
+    def test_names_and_codes(self):
+        self.assertEqual(self.index.get('learning skills', '', ''), Entry(1))
+        self.assertEqual(self.index.get('LS', 'resp', None), Entry(2))
+        self.assertEqual(self.index.get('subj', 'Math', 'ns'), Entry(4))
+        self.assertIsNone(self.index.get('Subjects', 'Science', ''))
+
+    def test_sortorder(self):
+        self.assertEqual(self.index.get('2', 'MA', ''), Entry(3))
+        # A subject sortorder matches whatever the section, as the old query did
+        self.assertEqual(self.index.get('Nothing', '1', ''), Entry(2))
@@ -0,0 +1,44 @@
+from django.core.mail import EmailMessage
+from django.test import SimpleTestCase
+
+from indysis_reportcard.google import GmailSender, SendError, StubTransport
+
+
+class GmailSenderTestCase(SimpleTestCase):
+    def test_batches(self):
+        transport = StubTransport(fail=['bad@example.com'])
+        sender = GmailSender(transport, batch_size=2)
+        messages = [EmailMessage(subject="Report card", body="Attached", from_email="school@example.com", to=[to])
+                    for to in ('a@example.com', 'bad@example.com', 'c@example.com')]
+
+        errors = sender.send_messages(messages)
+
+        self.assertEqual(len(transport.outbox), 2)
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], SendError)
+        self.assertIsNone(errors[2])
+        metrics = sender.metrics()
+        self.assertEqual(metrics['count'], 3)
+        self.assertEqual(metrics['errors'], 1)
+
+    def test_send_raises(self):
+        sender = GmailSender(StubTransport(fail=['bad@example.com']))
+        with self.assertRaises(SendError):
+            sender.send(EmailMessage(subject="x", body="y", from_email="school@example.com", to=['bad@example.com']))
+
+    def test_failed_batch(self):
+        class BrokenTransport(StubTransport):
+            def send(self, bodies):
+                if self.outbox:
+                    raise IOError("Connection reset")
+                return super().send(bodies)
+
+        sender = GmailSender(BrokenTransport(), batch_size=2)
+        messages = [EmailMessage(subject="Report card", body="Attached", from_email="school@example.com", to=[to])
+                    for to in ('a@example.com', 'b@example.com', 'c@example.com')]
+
+        errors = sender.send_messages(messages)
+
+        # The first batch was sent before the second failed
+        self.assertEqual(errors[:2], [None, None])
+        self.assertIsInstance(errors[2], IOError)
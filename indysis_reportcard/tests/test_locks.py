@@ -0,0 +1,42 @@
+from collections import namedtuple
+
+from django.test import SimpleTestCase
+
+from indysis_reportcard import locks
+
+Student = namedtuple('Student', 'id fullname')
+Subject = namedtuple('Subject', 'id name')
+
+
+class User(namedtuple('User', 'id username')):
+    def get_full_name(self):
+        return self.username.title()
+
+
+class LeaseTestCase(SimpleTestCase):
+    def setUp(self):
+        self.previous = locks.set_backend(locks.MemoryBackend())
+        self.students = [Student(1, 'Doe, Jane'), Student(2, 'Roe, Rick')]
+        self.subjects = [Subject(10, 'Math')]
+        self.alice = User(100, 'alice')
+        self.bob = User(101, 'bob')
+
+    def tearDown(self):
+        locks.set_backend(self.previous)
+
+    def test_conflicts(self):
+        self.assertEqual(locks.conflicting_check(self.alice, self.subjects, self.students, 'subject'), [])
+        # Renewing our own leases is not a conflict
+        self.assertEqual(locks.conflicting_check(self.alice, self.subjects, self.students), [])
+
+        conflicts = locks.conflicting_check(self.bob, self.subjects, self.students[1:], 'student')
+        self.assertEqual(len(conflicts), 1)
+        self.assertIn("Alice is editing", conflicts[0].conflict_str)
+
+        locks.conflicting_clear(self.alice, self.subjects, self.students)
+        self.assertEqual(locks.conflicting_check(self.bob, self.subjects, self.students[1:], 'student'), [])
+
+    def test_expiry(self):
+        backend = locks.get_backend()
+        backend.acquire(['key'], 100, '{"user": 100}', ttl=-1)
+        self.assertEqual(backend.acquire(['key'], 101, '{"user": 101}', ttl=60), {})
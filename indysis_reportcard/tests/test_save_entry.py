@@ -0,0 +1,75 @@
+import json
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import Group
+from django.test import TestCase
+from django.urls import reverse
+from sis.studentdb.models import Faculty, GradeLevel, SchoolYear, Student, Term
+
+from indysis_reportcard.models import (GradingScheme, ReportCard, ReportCardAccess, ReportCardCompletion,
+                                       ReportCardEntry, ReportCardSection, ReportCardSubject, ReportCardSubmission,
+                                       ReportCardTemplate, ReportCardTerm)
+
+
+class SaveEntryTestCase(TestCase):
+    def setUp(self):
+        year = SchoolYear.objects.create(name="Current Year", start_date=datetime.now(),
+                                         end_date=datetime.now() + timedelta(days=90), active_year=True)
+        term = Term.objects.create(name="Term 1", shortname="T1", start_date=year.start_date,
+                                   end_date=year.end_date, school_year=year)
+        GradeLevel.objects.create(id=1, name="Grade 1")
+        student = Student.objects.create(username='student', first_name='Sam', last_name='Student')
+        template = ReportCardTemplate.objects.create(name="Elementary")
+        section = ReportCardSection.objects.create(
+            name="Subjects", template=template, gradingscheme=GradingScheme.objects.create(name="Letters"))
+        subject = ReportCardSubject.objects.create(name="Math", section=section)
+        other_subject = ReportCardSubject.objects.create(name="Art", section=section)
+        rcterm = ReportCardTerm.objects.create(school_year=year, term=term)
+        rcterm.templates.add(template)
+        self.reportcard = ReportCard.objects.create(student=student, term=rcterm, template=template)
+        self.entry = ReportCardEntry.objects.create(reportcard=self.reportcard, section=section, subject=subject)
+        self.other = ReportCardEntry.objects.create(reportcard=self.reportcard, section=section,
+                                                    subject=other_subject, comment="Done", completed=True)
+        ReportCardCompletion.refresh([self.reportcard.id])
+
+        self.teacher = Faculty.objects.create_user(username='teacher', password='12345')
+        self.teacher.groups.add(Group.objects.create(name='faculty'))
+        self.rule = ReportCardAccess.objects.create(description="Math")
+        self.rule.teachers.add(self.teacher)
+        self.rule.subjects.add(subject)
+        self.client.login(username='teacher', password='12345')
+
+    def save(self, modified=None, **fields):
+        return self.client.post(
+            reverse('reportcard:save_entry', args=[self.entry.id]),
+            json.dumps({"fields": fields, "modified": modified or self.entry.modified.isoformat()}),
+            content_type='application/json')
+
+    def test_completes_reportcard(self):
+        ReportCard.objects.filter(pk=self.reportcard.pk).update(modified=datetime(2019, 1, 1))
+        response = self.save(comment="Works hard")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['completed'])
+        self.assertTrue(response.json()['reportcard_completed'])
+        self.assertTrue(ReportCardEntry.objects.get(pk=self.entry.pk).completed)
+        self.assertTrue(ReportCardSubmission.objects.get(reportcard=self.reportcard, teacher=self.teacher).completed)
+        completion = ReportCardCompletion.objects.get(reportcard=self.reportcard, subject=self.entry.subject)
+        self.assertEqual(completion.filled, completion.total)
+        self.assertGreater(ReportCard.objects.get(pk=self.reportcard.pk).modified, datetime(2019, 1, 1))
+
+        response = self.save(modified=response.json()['modified'], comment="")
+        self.assertFalse(response.json()['completed'])
+        self.assertFalse(ReportCardSubmission.objects.get(reportcard=self.reportcard, teacher=self.teacher).completed)
+
+    def test_conflict(self):
+        response = self.save(modified=datetime(2019, 1, 1).isoformat(), comment="Works hard")
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(response.json()['conflict'])
+        self.assertIsNone(response.json()['fields']['comment'])
+        self.assertIsNone(ReportCardEntry.objects.get(pk=self.entry.pk).comment)
+
+    def test_forbidden(self):
+        self.rule.teachers.remove(self.teacher)
+        response = self.save(comment="Works hard")
+        self.assertEqual(response.status_code, 403)
+        self.assertIsNone(ReportCardEntry.objects.get(pk=self.entry.pk).comment)
@@ -0,0 +1,64 @@
+from django.test import SimpleTestCase
+
+from indysis_reportcard import access, grading, shared
+
+
+class FakeRedis(object):
+    """The few Redis commands the shared backend uses, over one dict standing in for the server."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def mget(self, keys):
+        return [self.server.get(key) for key in keys]
+
+    def setnx(self, key, value):
+        self.server.setdefault(key, str(value).encode('utf-8'))
+
+    def incr(self, key):
+        self.server[key] = str(int(self.server.get(key, b'0')) + 1).encode('utf-8')
+
+    def set(self, key, value):
+        self.server[key] = str(value).encode('utf-8')
+
+    def delete(self, *keys):
+        for key in keys:
+            self.server.pop(key, None)
+
+
+class GenerationTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = {}
+        self.previous = shared.set_backend(shared.RedisBackend(client=FakeRedis(self.server)))
+
+    def tearDown(self):
+        shared.set_backend(self.previous)
+
+    def test_generation_moves_across_processes(self):
+        # Another web or Celery process, with its own connection to the same server
+        other = shared.RedisBackend(client=FakeRedis(self.server))
+        before = access.generation()
+        self.assertEqual(other.get_many([access.GENERATION_KEY]), [before])
+
+        shared.set_backend(other)
+        access.invalidate()
+        shared.set_backend(shared.RedisBackend(client=FakeRedis(self.server)))
+
+        self.assertNotEqual(access.generation(), before)
+        self.assertEqual(access.generation(), other.get_many([access.GENERATION_KEY])[0])
+
+    def test_grading_generation_moves_across_processes(self):
+        other = shared.RedisBackend(client=FakeRedis(self.server))
+        before = grading.generation()
+        shared.set_backend(other)
+        grading.invalidate()
+        self.assertNotEqual(grading.generation(), before)
+        # Separate from the access index generation
+        self.assertNotEqual(grading.GENERATION_KEY, access.GENERATION_KEY)
+
+    def test_values_across_processes(self):
+        shared.set_value('reportcard-pdf:1', 'abc')
+        shared.set_backend(shared.RedisBackend(client=FakeRedis(self.server)))
+        self.assertEqual(shared.get_many(['reportcard-pdf:1', 'reportcard-pdf:2']), {'reportcard-pdf:1': 'abc'})
+        shared.delete_many(['reportcard-pdf:1'])
+        self.assertEqual(shared.get_many(['reportcard-pdf:1']), {})
@@ -1,7 +1,7 @@
 from django.conf.urls import url
 
-from .views import batch_generate_reportcard
-from .views import conflicting_edit_student, ping_student_edit, done_student_edit
+from .views import batch_generate_reportcard, queue_export, export_status, download_export
+from .views import conflicting_edit_student, ping_student_edit, done_student_edit, save_entry
 from .views import conflicting_edit_subject, ping_subject_edit, done_subject_edit
 from .views import generate_comment_report, comment_report, term_state
 from .views import generate_student, generate_grade_batch, generate_grade_zip
@@ -20,6 +20,7 @@ urlpatterns = [
     url(r'done/student/(?P<student_id>\d+)/(?P<term_id>\d+)$', done_student_edit, name='done_student_edit'),
     url(r'conflict/student/(?P<student_id>\d+)/(?P<term_id>\d+)$', conflicting_edit_student,
         name='conflicting_edit_student'),
+    url(r'entry/(?P<entry_id>\d+)$', save_entry, name='save_entry'),
 
     # TODO Refactor to use class_id instead of grade_id
     url(r'edit/subject/(?P<subject_id>\d+)/(?P<grade_id>\d+)/(?P<term_id>\d+)$', edit_subject, name='edit_subject'),
@@ -41,6 +42,11 @@ urlpatterns = [
     url(r'email_grade_batch/(?P<term_id>\d+)/(?P<year_id>\d+)$', email_grade_batch, name='email_grade_batch'),
 
     url(r'term/generate_all/(?P<id>\d+)$', batch_generate_reportcard, name='generate_all'),
+    url(r'export/(?P<term_id>\d+)/(?P<kind>pdf|zip|comments)$', queue_export, name='queue_export_all'),
+    url(r'export/(?P<term_id>\d+)/(?P<kind>pdf|zip|comments)/(?P<year_id>\d+)$', queue_export,
+        name='queue_export'),
+    url(r'export/status/(?P<term_id>\d+)$', export_status, name='export_status'),
+    url(r'export/download/(?P<job_id>\d+)$', download_export, name='download_export'),
 
     url(r'term/comment_report/(?P<id>\d+)$', comment_report, name='comment_report'),
     url(r'term/generate_comment_report/(?P<grade_id>\d+)/(?P<term_id>\d+)', generate_comment_report,
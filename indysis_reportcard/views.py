@@ -1,44 +1,45 @@
 """Report card Views."""
+import csv
 import datetime
-import logging
+import json
 import os
-import shutil
 import tempfile
-import zipfile
-from copy import deepcopy
+from collections import defaultdict
 from itertools import groupby
-from typing import Set
 
-import django.template
-import pdfkit
 import reversion
-from PyPDF2 import PdfFileReader, PdfFileMerger
 from constance import config
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.models import User
-from django.core.mail import EmailMultiAlternatives
-from django.db import IntegrityError, models, transaction
-from django.db.models import Q, Count, Subquery, OuterRef, F
-from django.forms import modelformset_factory, Select
-from django.http import Http404, HttpResponse, JsonResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Count
+from django.forms import modelform_factory, modelformset_factory, Select
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
 from django.shortcuts import get_object_or_404, redirect, render
-from django.template.loader import get_template
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
-from unidecode import unidecode
 
 from indy_sis.celery import app
-from indysis_reportcard.google import GmailSender
-from indysis_reportcard.models import (GradingSchemeLevelChoice, ReportCard,
-                                       ReportCardEditorTracking, ReportCardEntry,
+from indysis_reportcard.access import get_index
+from indysis_reportcard.comment_report import CommentReport
+from indysis_reportcard.emails import email_reportcards
+from indysis_reportcard.grading import limit_choices
+from indysis_reportcard.locks import conflicting_check, conflicting_clear
+from indysis_reportcard.models import (ReportCard, ReportCardCompletion,
+                                       ReportCardEntry,
                                        ReportCardSubject, ReportCardTemplate, ReportCardTerm,
-                                       ReportCardYearGradeContent, ReportCardTemplateImage, ReportCardSection,
-                                       ReportCardAccess)
-from indysis_reportcard.tasks import create_reportcards
+                                       ReportCardExportJob,
+                                       ReportCardArchive)
+from indysis_reportcard.rendering import (COMMENT_REPORT_PDF_OPTIONS, comment_report_html, get_reportcard,
+                                          html_to_pdf, prepare_reportcard, render_batch, render_reportcard,
+                                          stream_zip, write_merged_pdf)
+from indysis_reportcard.tasks import archive_term, open_term, run_export_job, send_reportcard_emails
+from indysis_reportcard.teachers import get_resolver
 from sis.studentdb.models import Faculty, GradeLevel, SchoolYear, Student
 
 
@@ -73,11 +74,6 @@ def index(request):
     ))
 
 
-class CountQuery(Subquery):
-    template = "(SELECT COUNT(*) FROM (%(subquery)s) _count)"
-    output_field = models.IntegerField()
-
-
 @user_passes_test(access_allowed)
 def view_term(request, id):
     """View report cards for a term as a teacher."""
@@ -98,37 +94,15 @@ def view_term(request, id):
     if is_reportcard_admin(request.user) and request.GET.get('teacher_id', False):
         url_extra = '?teacher_id=%d' % teacher.id
 
+    access = get_index(term)
+
     # Determine which subjects match
-    subjects = ReportCardSubject.objects.filter(Q(section__template__reportcardterm=term) & (
-        Q(section__reportcardaccess__sections__template__reportcardterm=term) |
-        Q(reportcardaccess__subjects__section__template__reportcardterm=term)
-    ))
-    if teacher:
-        subjects = subjects.filter(
-            Q(reportcardaccess__teachers=teacher) |
-            Q(section__reportcardaccess__teachers=teacher)
-        )
-    subjects = subjects.distinct()
-
-    student_filter = (Q(is_active=True) &
-            Q(year__isnull=False) &
-            (
-                    Q(classes__reportcardaccess__sections__template__reportcardterm=term) |
-                    Q(classes__reportcardaccess__subjects__section__template__reportcardterm=term)
-            ) &
-            (
-                    Q(classes__reportcardaccess__subjects__section__template__grades=F('year')) |
-                    Q(classes__reportcardaccess__sections__template__grades=F('year'))
-            ) &
-            (
-                Q(classes__school_year=this_year)
-            ))
-    if teacher:
-        student_filter &= Q(classes__reportcardaccess__teachers=teacher)
+    subjects = ReportCardSubject.objects.filter(id__in=access.subject_ids(teacher))
 
-    students = Student.objects.filter(student_filter).distinct().prefetch_related('classes')
+    students = Student.objects.filter(id__in=access.student_ids(teacher, this_year)).select_related(
+        'year').prefetch_related('classes')
 
-    grades = students.values('year').order_by().distinct()
+    grades = [{'year': grade_id} for grade_id in sorted({student.year_id for student in students})]
 
     # Generate a list of potential subject-grade pairs
     subject_grades = set([(subject.id, grade['year'])
@@ -137,40 +111,9 @@ def view_term(request, id):
 
     # At this point, we know what subjects, students and grades
     # There is a risk that we will show extraneous subject/grade pairs
-    # So we iterate the access rules for the teacher and build a parallel list,
+    # So we use the access rules for the teacher to build a parallel list,
     # being sure to avoid including subjects not mapped to the student's grade
-    teacher_subject_grades = set()
-    rules_filter = (
-        (
-                Q(subjects__in=subjects) |
-                Q(sections__in=ReportCardSection.objects.filter(reportcardsubject__in=subjects))
-        ) &
-        (
-                Q(sections__template__reportcardterm=term) |
-                Q(subjects__section__template__reportcardterm=term)
-        )
-    )
-    if teacher:
-        rules_filter &= Q(teachers=teacher)
-    rules = ReportCardAccess.objects.filter(rules_filter)
-    rules = rules.prefetch_related('sections',
-                                   'student_classes',
-                                   'subjects',
-                                   'student_classes__students',
-                                   'student_classes__students__year')
-    for rule in rules:
-            for section in rule.sections.filter(template__reportcardterm=term).all():
-                for subject in section.subjects.all():
-                    for year in rule.student_classes.filter(
-                            students__year__reportcardtemplate__reportcardsection__reportcardsubject=subject
-                    ).values('students__year').distinct():
-                        teacher_subject_grades.add((subject.id, year['students__year']))
-            for subject in rule.subjects.filter(section__template__reportcardterm=term).all():
-                for year in rule.student_classes.filter(
-                    students__year__reportcardtemplate__reportcardsection__reportcardsubject=subject
-                ).values('students__year').distinct():
-                    teacher_subject_grades.add((subject.id, year['students__year']))
-    subject_grades &= teacher_subject_grades
+    subject_grades &= access.subject_grade_pairs(teacher)
 
     completed = {}
 
@@ -203,6 +146,8 @@ def view_term(request, id):
         num_students=Count('student__year')):
         grade_student_counts[grade.id] = grade
 
+    filled = ReportCardCompletion.filled_by_subject_grade(term)
+
     for grade_id in sorted([x['year'] for x in grades]):
         for subject in subjects.order_by('name'):
 
@@ -216,27 +161,8 @@ def view_term(request, id):
                 "grade": grade_student_counts[grade_id],
                 "name": subject.name,
                 "num_students": grade_student_counts[grade_id].num_students,
-                "filled": 0,
+                "filled": filled.get((subject.id, grade_id), 0),
             }
-
-            num_completed = ReportCardEntry.objects.filter(
-                completed=True,
-                reportcard=OuterRef('pk'),
-                subject_id=subject.id,
-                reportcard__student__year_id=info['grade_id'],
-                reportcard__student__classes__school_year=this_year
-            ).values('pk')
-            reportcard_metrics = ReportCard.objects.annotate(
-                num_completed=CountQuery(num_completed)
-            ).filter(
-                student__year=info['grade_id'],
-                term__school_year=this_year,
-                reportcardentry__subject=subject.id
-            ).annotate(
-                num_total=Count('pk'),
-            ).all()
-
-            info['filled'] = sum(1 if s.num_completed == s.num_total else 0 for s in reportcard_metrics)
             subject_info.append(info)
 
     students = [
@@ -283,7 +209,11 @@ def term_state(request, id, state):
         term.save()
     messages.success(request, "Changed term %s to %s" % (term, term.status))
     if term.is_open:
-        create_reportcards.apply_async((term.id,))
+        ReportCardArchive.mark_stale(term)
+        transaction.on_commit(lambda: open_term.apply_async((term.id,)))
+    else:
+        base_url = request.build_absolute_uri("/").rstrip("/")
+        transaction.on_commit(lambda: archive_term.apply_async((term.id, base_url)))
     return redirect(reverse('reportcard:term_admin', args=[id]))
 
 
@@ -314,43 +244,38 @@ def term_admin(request, id):
         for student_id, group in groupby(completed, lambda x: x['id'])
     }
 
-    # Counts filled entries
-
-    filled_entries = {s['id']: s['num'] for s in Student.objects.filter(
-        Q(reportcard__reportcardentry__completed=True) &
-        Q(reportcard__term=term)
-    ).distinct().annotate(
-        num=Count('reportcard__reportcardentry')).values('id', 'num').all()}
+    # Counts of total and filled entries
+    entry_counts = ReportCardCompletion.totals_by_student(term)
 
-    # Counts total entries
-    total_entries = {s['id']: s['num'] for s in Student.objects.filter(
-        Q(reportcard__term=term)
-    ).distinct().annotate(
-        num=Count('reportcard__reportcardentry')).values('id', 'num').all()}
+    emailed = dict(ReportCard.objects.filter(term=term, emailed=True).values('student').order_by().annotate(
+        num=Count('id')).values_list('student', 'num'))
 
     # Calculate which teachers are expected to complete cards for each grade
-    grade_teachers = {}
-    for grade in GradeLevel.objects.all():
-        grade_teachers[grade] = Faculty.objects.filter(
-            reportcardaccess__student_classes__students__year=grade,
-        ).distinct()
+    grade_teacher_ids = defaultdict(set)
+    for teacher_id, grade_id in Faculty.objects.filter(
+            reportcardaccess__student_classes__students__year__isnull=False).values_list(
+            'id', 'reportcardaccess__student_classes__students__year').distinct():
+        grade_teacher_ids[grade_id].add(teacher_id)
+    faculty = list(Faculty.objects.filter(id__in={teacher_id for ids in grade_teacher_ids.values()
+                                                  for teacher_id in ids}))
+    grade_teachers = {grade_id: [t for t in faculty if t.id in ids] for grade_id, ids in grade_teacher_ids.items()}
 
     students = [
         {
             "student": s,
-            "emailed": ReportCard.objects.filter(student=s, term=term, emailed=True).count(),
-            "expecting": len(grade_teachers[s.year]),
+            "emailed": emailed.get(s.id, 0),
+            "expecting": len(grade_teachers.get(s.year_id, [])),
             "completed": len(completed.get(s.id, [])),
-            "total_entries": total_entries.get(s.id, 0),
-            "filled_entries": filled_entries.get(s.id, 0),
-            "percent_filled": (float(filled_entries.get(s.id, 0)) /
-                               (total_entries.get(s.id, 1) or 1)) * 100,
-            "complete_teachers": [t for t in grade_teachers[s.year]
+            "total_entries": entry_counts.get(s.id, (0, 0))[0],
+            "filled_entries": entry_counts.get(s.id, (0, 0))[1],
+            "percent_filled": (float(entry_counts.get(s.id, (0, 0))[1]) /
+                               (entry_counts.get(s.id, (1, 0))[0] or 1)) * 100,
+            "complete_teachers": [t for t in grade_teachers.get(s.year_id, [])
                                   if t.id in completed.get(s.id, [])],
-            "incomplete_teachers": [t for t in grade_teachers[s.year]
+            "incomplete_teachers": [t for t in grade_teachers.get(s.year_id, [])
                                     if t.id not in completed.get(s.id, [])],
         }
-        for s in all_students if s.year is not None
+        for s in all_students if s.year_id is not None
     ]
 
     teachers = []
@@ -365,6 +290,7 @@ def term_admin(request, id):
         superuser=is_reportcard_admin(request.user),
         teachers=teachers,
         templates=ReportCardTemplate.objects.filter(is_active=True).all(),
+        archive=ReportCardArchive.objects.filter(term=term).first(),
     ))
 
 
@@ -472,193 +398,35 @@ def generate_reportcard(request, student, term, stream=True,
     Creates output if stream is False (or writes to it if output can .write())
     disposition specifies the Content-Disposition type.
     """
-    template = term.get_template(grade=student.year)
-    reportcard = ReportCard.objects.filter(student=student,
-                                           term=term, template=template).first()
-
-    if not reportcard:
-        raise Http404('No report card data found for student %s' % student.fullname)
+    reportcard = get_reportcard(student, term)
 
     html = request and request.GET.get('html', False)
+    base_url = base_url or request.build_absolute_uri("/").rstrip("/")
 
-    data = deepcopy(reportcard.data)
-
-    past_entries = reportcard.get_past_terms(term)
-    term_objects = reportcard.get_past_term_list(term)
-    terms = past_entries.keys()
-    element_to_past = {tno: {} for tno in terms}
-    for tno in terms:
-        element_to_past[tno] = {
-            rce.most_specific_element: rce for rce in past_entries[tno]
-        }
-    all_entries = template.get_or_create_all_entries(reportcard)
-
-    inst_to_element = {instance: element for element, instance in all_entries.items()}
-
-    formset = SubjectFormSet(queryset=ReportCardEntry.objects.filter(reportcard=reportcard))
-    element_to_entry = {inst_to_element[form.instance]: form.instance for form in formset}
-
-    subjects: Set[ReportCardSubject] = set([item for item in all_entries if isinstance(item, ReportCardSubject)])
-    subject_teachers = {
-        subject.name_en.replace(" ", "_").lower(): subject.teachers(student) for subject in subjects if subject.name_en
-    }
-    subject_teachers.update({
-        subject.name_fr.replace(" ", "_").lower(): subject.teachers(student) for subject in subjects if subject.name_fr
-    })
-
-    head = term.school_year.principal
-    head = Faculty.objects.filter(user_ptr=head).first()
-    head_title = term.school_year.principal_title or ''
-    head_title_en = term.school_year.principal_title_en or ''
-    head_title_fr = term.school_year.principal_title_fr or ''
-    head_signature = ''
-    if head and head.signature:
-        head_signature = head.signature
-    head = head.fullname_nocomma
-
-    assistant_head = term.school_year.vice_principal
-    assistant_head = Faculty.objects.filter(user_ptr=assistant_head).first()
-    assistant_head_title = term.school_year.vice_principal_title or ''
-    assistant_head_title_en = term.school_year.vice_principal_title_en or ''
-    assistant_head_title_fr = term.school_year.vice_principal_title_fr or ''
-    assistant_head_signature = ''
-    if assistant_head and assistant_head.signature:
-        assistant_head_signature = assistant_head.signature
-    assistant_head = assistant_head.fullname_nocomma
-
-    data.update(dict(
-        reportcard=reportcard,
-        student=student,
-        term=term,
-        template=template,
-        element_to_entry=element_to_entry,
-        element_to_past=element_to_past,
-        terms=terms,
-        term_objects=term_objects,
-        unseen_terms=range(len(terms) + 1, 3),
-        head=head,
-        head_title=head_title,
-        head_title_en=head_title_en,
-        head_title_fr=head_title_fr,
-        head_signature=head_signature,
-        assistant_head=assistant_head,
-        assistant_head_title=assistant_head_title,
-        assistant_head_title_en=assistant_head_title_en,
-        assistant_head_title_fr=assistant_head_title_fr,
-        assistant_head_signature=assistant_head_signature,
-        school_name=config.SCHOOL_NAME,
-        school_address_line1=config.SCHOOL_ADDRESS_LINE1,
-        school_address_line2=config.SCHOOL_ADDRESS_LINE2,
-        school_address_city=config.SCHOOL_ADDRESS_CITY,
-        school_address_provstate=config.SCHOOL_ADDRESS_PROVSTATE,
-        school_address_postcode=config.SCHOOL_ADDRESS_POSTCODE,
-        school_email=config.SCHOOL_EMAIL,
-        school_phone=config.SCHOOL_PHONE,
-        school_fax=config.SCHOOL_FAX,
-        html=html,
-        subject_teachers=subject_teachers,
-        base_url=base_url or request.build_absolute_uri("/").rstrip("/"),
-        grading_schemes=reportcard.template.get_grading_schemes()
-    ))
-
-    content = ReportCardYearGradeContent.objects.filter(school_year=term.school_year, grade_level=student.year).first()
-    if content:
-        data['static_content'] = mark_safe(content.content)
-
-    data['images'] = {image.name: image for image in ReportCardTemplateImage.objects.all()}
-
-    def render_string(string):
-        tpl = django.template.Template(string)
-        ctx = django.template.Context(data)
-        return tpl.render(ctx)
-
-    header = render_string(reportcard.template.get_template('header_template'))
-    footer = render_string(reportcard.template.get_template('footer_template'))
-    cover = render_string(reportcard.template.get_template('coverpage_template'))
-    content = render_string(reportcard.template.get_template('body_template'))
-
-    options = {
-        'load-error-handling': 'skip',
-        'page-size': 'Letter',
-        'margin-top': '0.6in',
-        'margin-left': '0.5in',
-        'margin-right': '0.5in',
-        'margin-bottom': '0.6in',
-        'encoding': "UTF-8",
-        'no-outline': None,
-        'no-header-line': None,
-        'disable-smart-shrinking': None,
-        'zoom': 1,
-    }
+    if html:
+        return HttpResponse(prepare_reportcard(reportcard, html=html, base_url=base_url).content)
 
-    # Files
-    # for file in ReportCardTemplateImage.objects.all():
-    #     filepath = "/tmp/%s" % os.path.basename(file.image.url_300x300)
-    #     if not os.path.exists(filepath):
-    #         shutil.copy(
-    #             os.path.join(settings.MEDIA_ROOT, 'reportcard',
-    #                          os.path.basename(
-    #                              file.signature.url_300x300)), filepath)
-
-    # Signatures
-    for teach in Faculty.objects.filter(is_active=True).all():
-        if teach.signature:
-            sigpath = "/tmp/%s" % os.path.basename(teach.signature.url_300x60)
-            if not os.path.exists(sigpath):
-                shutil.copy(
-                    os.path.join(settings.MEDIA_ROOT, 'signatures',
-                                 os.path.basename(
-                                     teach.signature.url_300x60)), sigpath)
+    pdf, data = render_reportcard(reportcard, base_url=base_url, context=not stream)
 
-    if html:
-        return HttpResponse(content)
+    if stream:
+        response = HttpResponse(pdf)
+        response['Content-Type'] = 'application/pdf'
+        response['Content-Disposition'] = '%s' % disposition
+        filename = slugify(reportcard.filename)
 
-    files = []
-    try:
-        with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as header_html:
-            options['header-html'] = header_html.name
-            header_html.write(header.encode('utf-8'))
-            files.append(header_html)
-        with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as footer_html:
-            options['footer-html'] = footer_html.name
-            footer_html.write(footer.encode('utf-8'))
-            files.append(footer_html)
-
-        pdf_kwargs = {}
-        if cover.strip(" \r\n"):
-            with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as cover_html:
-                cover_html.write(cover.encode('utf-8'))
-                files.append(cover_html)
-            pdf_kwargs['cover'] = cover_html.name
-
-        pdf = pdfkit.PDFKit(content, "string",
-                            options=options,
-                            **pdf_kwargs).to_pdf()
-
-        if stream:
-            response = HttpResponse(pdf)
-            response['Content-Type'] = 'application/pdf'
-            response['Content-Disposition'] = '%s' % disposition
-            filename = slugify(reportcard.filename)
-
-            if filename:
-                response['Content-Disposition'] += ';filename=\'' + filename + "\'"
-            return response
+        if filename:
+            response['Content-Disposition'] += ';filename=\'' + filename + "\'"
+        return response
+    else:
+        # Check if quacks like a file handle
+        if output is None:
+            return pdf, data
+        if hasattr(output, 'write'):
+            output.write(pdf)
         else:
-            # Check if quacks like a file handle
-            if output is None:
-                return pdf, data
-            if hasattr(output, 'write'):
+            with open(output, "wb"):
                 output.write(pdf)
-            else:
-                with open(output, "wb"):
-                    output.write(pdf)
-                return output, data
-
-    finally:
-        # Ensure temporary file is deleted after finishing work
-        for file in files:
-            os.remove(file.name)
+            return output, data
 
 
 @user_passes_test(access_allowed)
@@ -677,65 +445,21 @@ def email_rc_wrapper(student_id, term_id, to, mark_emailed=False, base_url=None,
 
 
 def email_rc(student: Student, term, to, mark_emailed=False, base_url=None, bcc_ok=False):
-    template = term.get_template(grade=student.year)
-    pdf, data = generate_reportcard(None, student, term, stream=False,
-                                    output=None, base_url=base_url)
-
-    def render_string(string):
-        tpl = django.template.Template(string)
-        ctx = django.template.Context(data)
-        return tpl.render(ctx)
+    email_reportcards([student], term, {student.id: [to]}, mark_emailed=mark_emailed, base_url=base_url,
+                      bcc_ok=bcc_ok)
 
-    filename = '%s.pdf' % slugify(student.fullname)
-    message_body = render_string(term.email_body_template)
-    subject = render_string(term.email_subject_template)
 
-    html = get_template("email_wrapper.html").render({
-        "school_name": config.SCHOOL_NAME,
-        "content": message_body,
-    })
-
-    msg = EmailMultiAlternatives(
-        subject=subject,
-        body=message_body,
-        from_email=config.REPORT_CARD_SENDER_EMAIL or settings.DEFAULT_REPORT_CARD_SENDER_EMAIL,
-        to=[to])
-    msg.attach_alternative(html, "text/html")
-
-    if bcc_ok and config.REPORT_CARD_BCC_EMAIL:
-        msg.bcc.append(config.REPORT_CARD_BCC_EMAIL)
-    msg.attach(filename=filename, content=pdf, mimetype="application/pdf")
-
-    if not os.environ.get('NO_EMAIL'):
-        if config.REPORT_CARD_GMAIL and config.REPORT_CARD_SENDER_EMAIL:
-            GmailSender.send_email(msg)
-            method = 'gmail'
+def parent_addresses(request, student):
+    """Addresses to send a student's report card to; the current user's in DEBUG."""
+    addresses = []
+    for parent in student.parents.filter():
+        if settings.DEBUG:
+            to = request.user.email
         else:
-            msg.send()
-            method = 'smtp'
-    else:
-        method = 'none'
-    logging.info("%s report card using %s to %s",
-                 'DID NOT send' if os.environ.get('NO_EMAIL') else 'Sent', method, to,
-                 extra={
-                     "from": config.REPORT_CARD_SENDER_EMAIL or settings.DEFAULT_REPORT_CARD_SENDER_EMAIL,
-                     "to": to,
-                     "subject": subject,
-                     "student": student.id,
-                     "student_name": student.fullname,
-                     "grade": student.year.name
-                 })
-
-    if mark_emailed:
-        template = term.get_template(grade=student.year)
-        with reversion.create_revision():
-            reversion.set_comment("Emailed")
-            reportcard = ReportCard.objects.filter(
-                student=student,
-                term=term, template=template).first()
-            if reportcard:
-                reportcard.emailed = True
-                reportcard.save()
+            to = parent.email
+        if to:
+            addresses.append(to)
+    return addresses
 
 
 @user_passes_test(is_reportcard_admin)
@@ -764,17 +488,8 @@ def email_rc_to_parents(request, student_id, term_id):
         messages.error(request, "Term is open, not sending emails")
         return
 
-    for parent in student.parents.filter():
-        if settings.DEBUG:
-            to = request.user.email
-        else:
-            to = parent.email
-
-        if not to:
-            continue
-
-        base_url = request.build_absolute_uri("/").rstrip("/")
-        email_rc_wrapper.delay(student.id, term.id, to, mark_emailed=True, base_url=base_url, bcc_ok=True)
+    addresses = parent_addresses(request, student)
+    for to in addresses:
         if not os.environ.get('NO_EMAIL'):
             messages.warning(request, "Queued Report card email for %s to %s" % (
                 student.fullname, to))
@@ -782,6 +497,11 @@ def email_rc_to_parents(request, student_id, term_id):
             messages.warning(request, "DID NOT send email as NO_EMAIL env var set - for %s to %s" % (
                 student.fullname, to))
 
+    if addresses:
+        base_url = request.build_absolute_uri("/").rstrip("/")
+        send_reportcard_emails.delay(term.id, [(student.id, addresses)], mark_emailed=True, base_url=base_url,
+                                     bcc_ok=True)
+
     return redirect(reverse('reportcard:term_admin', args=[term.id]))
 
 
@@ -790,132 +510,17 @@ def generate_comment_report(request, grade_id, term_id):
     term = get_object_or_404(ReportCardTerm, pk=term_id)
     grade = get_object_or_404(GradeLevel, pk=grade_id)
 
-    filename = slugify(term.term.name + '-' + grade.name)
-    if term.is_open:
-        filename += " (Draft)"
-
-    subjects = []
-    data = {
-        "grade": grade.name,
-        "subjects": subjects,
-    }
-
-    reportcards = term.reportcard_set.filter(student__year=grade).all()
-    tpl = reportcards[0].template
-
-    def mark_or_grade(section, entry):
-        if section.gradingscheme.percentile and not entry.choice:
-            return entry.percentile if entry.percentile is not None else ''
-        else:
-            if not entry.choice:
-                return '-'
-            if entry.strand:
-                language = entry.strand.rc_language
-            else:
-                language = entry.subject.rc_language
-            return getattr(entry.choice, 'name_' + language)
-
-    def makegrid_section(section):
-        items = ReportCardEntry.objects.filter(
-            reportcard__in=reportcards, section=section,
-            subject__isnull=True, strand__isnull=True).order_by(
-            'reportcard__student__last_name',
-            'reportcard__student__first_name').all()
-        grid = [{
-            "student": i.reportcard.student,
-            "marks": [(m.subject.name, mark_or_grade(section, m))
-                      for m in ReportCardEntry.objects.filter(
-                    reportcard=i.reportcard, section=section,
-                    subject__isnull=False,
-                    strand__isnull=True,
-                    subject__graded=True).order_by(
-                    'subject__sortorder').distinct().all()],
-            "comments": i.comment}
-            for i in items]
-        return grid
-
-    def makegrid_subject(section, subject):
-        out = []
-        for rc in reportcards:
-
-            subjectent = ReportCardEntry.objects.filter(
-                reportcard=rc, section=section, subject=subject,
-                strand=None).first()
-            strands = ReportCardEntry.objects.filter(
-                reportcard=rc, section=section,
-                subject=subject, strand__isnull=False).order_by(
-                'strand__sortorder').distinct().all()
-
-            marks = []
-            comments = []
-
-            if subject.comments_area:
-                if subject.comments_area and subjectent:
-                    comments.append(subjectent.comment
-                                    if subjectent.comment is not None else '')
-                if subject.graded and subjectent:
-                    marks.append((subject.rc_label,
-                                  mark_or_grade(section, subjectent)))
-            for strand in strands:
-                if strand.strand.graded:
-                    marks.append((strand.strand.rc_label,
-                                  mark_or_grade(section, strand)))
-
-            comments = "\n\n".join(comments)
-            out.append({"student": rc.student, "marks": marks,
-                        "comments": comments})
-        return out
-
-    for section in tpl.sections:
-        if section.comments_area:
-            subjects.append({
-                "name": section.name,
-                "grid": makegrid_section(section),
-                "teacher": reportcards[0].student.homeroom_teacher,
-            })
-        for subject in section.subjects:
-            out = makegrid_subject(section, subject)
-            rce = ReportCardEntry.objects.filter(
-                        reportcard=reportcards[0], section=section,
-                        subject=subject,
-                        strand=None).first()
-            teachers = ""
-            if rce:
-                teachers = " and ".join([
-                    t.fullname_nocomma for t in
-                    rce.get_teachers()])
-            subjects.append({
-                "name": subject.name,
-                "grid": out,
-                "teacher": teachers,
-            })
-
-    # from pprint import pprint
-    # pprint(data)
-
-    html = render(request, 'comment_report_template.html', dict(
-        data=data,
-    ))
-    options = {
-        'load-error-handling': 'skip',
-        'page-size': 'Letter',
-        'margin-top': '1in',
-        'margin-left': '0.5in',
-        'margin-right': '0.5in',
-        'margin-bottom': '0.8in',
-        'encoding': "UTF-8",
-        'no-outline': None,
-        'no-header-line': None,
-        'disable-smart-shrinking': None,
-        'zoom': 1,
-        'dpi': 300,
-    }
-
     if request.GET.get("html", False):
-        return html
+        return HttpResponse(comment_report_html(term, grade))
+
+    if request.GET.get("csv", False):
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="Comment Report - %s.csv"' % slugify(grade.name)
+        writer = csv.writer(response)
+        writer.writerows(CommentReport(term, grade).rows())
+        return response
 
-    pdf = pdfkit.PDFKit(html.content.decode('utf-8'), "string",
-                        options=options).to_pdf()
+    pdf = html_to_pdf(comment_report_html(term, grade), options=COMMENT_REPORT_PDF_OPTIONS)
 
     response = HttpResponse(pdf)
     response['Content-Type'] = 'application/pdf'
@@ -954,16 +559,74 @@ def batch_generate_reportcard(request, id):
         if ReportCard.objects.filter(emailed=True, term=term, grade_level=year).exists():
             queued[year.id] = True
 
+    export_jobs = list(ReportCardExportJob.objects.filter(term=term).select_related('grade_level')[:50])
+
     return render(request, 'all_reportcards.html', dict(
         term=term,
         school_year=term.school_year,
         config=config,
         superuser=is_reportcard_admin(request.user),
         grades=GradeLevel.objects.order_by('id').all(),
-        emails_queued=queued
+        emails_queued=queued,
+        export_jobs=export_jobs,
+        exports_running=any(job.state in (ReportCardExportJob.PENDING, ReportCardExportJob.RUNNING)
+                            for job in export_jobs),
     ))
 
 
+@user_passes_test(is_reportcard_admin)
+@require_POST
+def queue_export(request, term_id, kind, year_id=None):
+    """Queue a background export for one grade, or every grade in the term."""
+    term = get_object_or_404(ReportCardTerm, pk=term_id)
+    if kind not in dict(ReportCardExportJob.KINDS):
+        raise Http404
+
+    if year_id:
+        grades = [get_object_or_404(GradeLevel, pk=year_id)]
+    else:
+        grades = GradeLevel.objects.filter(reportcardtemplate__reportcardterm=term).distinct().order_by('id')
+
+    base_url = request.build_absolute_uri("/").rstrip("/")
+    for grade in grades:
+        job = ReportCardExportJob.objects.create(
+            kind=kind, term=term, grade_level=grade, base_url=base_url, created_by=request.user)
+        transaction.on_commit(lambda job_id=job.id: run_export_job.apply_async((job_id,)))
+        messages.info(request, "Queued %s" % job)
+
+    return redirect(reverse('reportcard:generate_all', args=[term.id]))
+
+
+@user_passes_test(is_reportcard_admin)
+def export_status(request, term_id):
+    """Status of recent export jobs for a term, for polling."""
+    term = get_object_or_404(ReportCardTerm, pk=term_id)
+    jobs = ReportCardExportJob.objects.filter(term=term).select_related('grade_level', 'term')[:50]
+    return JsonResponse({"jobs": [job.as_dict() for job in jobs]})
+
+
+@user_passes_test(is_reportcard_admin)
+def download_export(request, job_id):
+    """Download a finished export, which is kept out of the public media root."""
+    job = get_object_or_404(ReportCardExportJob, pk=job_id, state=ReportCardExportJob.DONE)
+    if not job.output:
+        raise Http404
+    content_type = 'application/zip' if job.kind == ReportCardExportJob.ZIP else 'application/pdf'
+    try:
+        response = FileResponse(job.output.open('rb'), content_type=content_type)
+    except (IOError, OSError):
+        raise Http404
+    response['Content-Disposition'] = 'attachment;filename=\'%s\'' % job.filename
+    return response
+
+
+def report_batch_failures(request, failures):
+    """Flash a message for each report card that failed to render."""
+    for result in failures:
+        messages.error(request, "Unable to generate report card for %s: %s" % (
+            result.student.fullname, result.error))
+
+
 @user_passes_test(is_reportcard_admin)
 def generate_grade_batch(request, term_id, year_id):
     """Generate report cards for a grade."""
@@ -973,32 +636,21 @@ def generate_grade_batch(request, term_id, year_id):
     students = Student.objects.filter(year=year, is_active=True).order_by(
         "last_name", "first_name").all()
 
-    files = []
-    try:
-        merger = PdfFileMerger()
-        for student in students:
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
-                generate_reportcard(request, student, term, stream=False,
-                                    output=pdf_file.file)
-                files.append(pdf_file)
-                merger.append(PdfFileReader(pdf_file.file))
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=True) as out_file:
-            merger.write(out_file.file)
-            out_file.seek(0)
-            response = HttpResponse(out_file.file)
-            response['Content-Type'] = 'application/pdf'
-            response['Content-Disposition'] = 'attachment;filename=\''
-            filename = '%s - %s' % (year, term)
-            if term.is_open:
-                filename += " (Draft)"
-
-            response['Content-Disposition'] += filename + ".pdf\'"
-            return response
-
-    finally:
-        for file in files:
-            file.file.close()
-            os.remove(file.name)
+    base_url = request.build_absolute_uri("/").rstrip("/")
+    # PDF can't be written incrementally (the page tree and xref come last),
+    # so merge to disk and stream the file from there.
+    out_file = tempfile.TemporaryFile()
+    failures = write_merged_pdf(render_batch(students, term, base_url=base_url), out_file)
+    report_batch_failures(request, failures)
+    out_file.seek(0)
+    response = FileResponse(out_file, content_type='application/pdf')
+    response['Content-Disposition'] = 'attachment;filename=\''
+    filename = '%s - %s' % (year, term)
+    if term.is_open:
+        filename += " (Draft)"
+
+    response['Content-Disposition'] += filename + ".pdf\'"
+    return response
 
 
 @user_passes_test(is_reportcard_admin)
@@ -1009,34 +661,16 @@ def generate_grade_zip(request, term_id, year_id):
 
     students = Student.objects.filter(year=year, is_active=True).order_by("last_name", "first_name").all()
 
-    files = []
-    try:
-
-        with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as zip_file:
-            files.append(zip_file)
-            zip = zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED)
-
-            files = []
-            for student in students:
-                pdf, data = generate_reportcard(request, student, term, stream=False, output=None)
-                zip.writestr(unidecode(data['reportcard'].filename).replace('/', '-'), pdf)
-
-            zip.close()
-            zip_file.seek(0)
-            response = HttpResponse(zip_file.file)
-            response['Content-Type'] = 'application/pdf'
-            response['Content-Disposition'] = 'attachment;filename=\''
-            filename = '%s - %s' % (year, term)
-            if term.is_open:
-                filename += " (Draft)"
-
-            response['Content-Disposition'] += filename + ".zip\'"
-            return response
+    base_url = request.build_absolute_uri("/").rstrip("/")
+    response = StreamingHttpResponse(stream_zip(render_batch(students, term, base_url=base_url)),
+                                     content_type='application/zip')
+    response['Content-Disposition'] = 'attachment;filename=\''
+    filename = '%s - %s' % (year, term)
+    if term.is_open:
+        filename += " (Draft)"
 
-    finally:
-        for file in files:
-            file.file.close()
-            os.remove(file.name)
+    response['Content-Disposition'] += filename + ".zip\'"
+    return response
 
 
 @user_passes_test(is_reportcard_admin)
@@ -1054,6 +688,7 @@ def email_grade_batch(request, term_id, year_id):
 
     sent = 0
     num_students = 0
+    recipients = []
     for student in students:
 
         template = term.get_template(grade=student.year)
@@ -1070,20 +705,16 @@ def email_grade_batch(request, term_id, year_id):
                            (student.fullname,))
             continue
 
-        for parent in student.parents.filter():
-            if settings.DEBUG:
-                to = request.user.email
-            else:
-                to = parent.email
-
-            if not to:
-                continue
-
-            base_url = request.build_absolute_uri("/").rstrip("/")
-            email_rc_wrapper.delay(student.id, term.id, to, mark_emailed=True, base_url=base_url)
-            sent += 1
+        addresses = parent_addresses(request, student)
+        if addresses:
+            recipients.append((student.id, addresses))
+            sent += len(addresses)
         num_students += 1
 
+    if recipients:
+        base_url = request.build_absolute_uri("/").rstrip("/")
+        send_reportcard_emails.delay(term.id, recipients, mark_emailed=True, base_url=base_url)
+
     messages.warning(request, "Processed %d students.  "
                               "Queued %d emails to parents in %s / %s." %
                      (num_students, sent,
@@ -1194,12 +825,12 @@ def do_conflict_check_student(request, student_id, term_id, check_only=False, cl
         template, teacher, term, student, all_entries)
 
     if not clear:
-        conflicting = ReportCardEditorTracking.conflicting_check(
+        conflicting = conflicting_check(
             user=request.user, students=[student],
             subjects=[subject for subject in subject_access if subject_access[subject]],
             check_only=check_only)
     else:
-        ReportCardEditorTracking.conflicting_clear(
+        conflicting_clear(
             user=request.user, students=[student], subjects=subject_access)
         return
 
@@ -1245,6 +876,110 @@ def done_student_edit(request, student_id, term_id):
     return JsonResponse({"ok": True})
 
 
+def touch_reportcards(reportcard_ids):
+    """Update ReportCard.modified without saving, so that no version is recorded for it."""
+    if reportcard_ids:
+        ReportCard.objects.filter(id__in=reportcard_ids).update(modified=datetime.datetime.now())
+
+
+ENTRY_FIELDS = ('choice', 'percentile', 'comment', 'second_choice', 'second_percentile')
+
+
+def entry_versions(formset):
+    """JSON map of entry id to its modified stamp, for optimistic concurrency in save_entry."""
+    return json.dumps({form.instance.id: form.instance.modified.isoformat() for form in formset})
+
+
+def entry_editable(teacher, term, entry):
+    """Whether the teacher's access rules cover this entry, as access_for_template."""
+    if not teacher:
+        return True
+    access = get_index(term)
+    if not access.may_edit_section(teacher, entry.section_id):
+        return False
+    return entry.subject_id is None or entry.subject_id in access.subject_ids(teacher)
+
+
+@user_passes_test(access_allowed)
+@require_POST
+@transaction.atomic
+def save_entry(request, entry_id):
+    """Save some fields of one entry, for autosave while editing.
+
+    Takes a JSON body of {"fields": {name: value}, "modified": stamp}, where
+    stamp is the entry's modified time as the page last saw it.  If the entry
+    has been saved since, nothing is written and the current values are
+    returned with status 409.
+    """
+    teacher = request.user
+    try:
+        if is_reportcard_admin(request.user):
+            if request.GET.get('teacher_id', False):
+                teacher = User.objects.get(pk=int(request.GET['teacher_id']))
+            else:
+                teacher = None
+    except Exception:
+        pass
+
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        fields = data['fields']
+        if not fields or any(name not in ENTRY_FIELDS for name in fields):
+            raise ValueError("Unknown field")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return JsonResponse({"ok": False, "errors": ["Invalid request"]}, status=400)
+
+    entry = get_object_or_404(
+        ReportCardEntry.objects.select_for_update().select_related(
+            'reportcard__term', 'section__gradingscheme', 'section__second_gradingscheme', 'subject', 'strand'),
+        pk=entry_id)
+    term = entry.reportcard.term
+    if not entry.reportcard.editable(teacher) or not entry_editable(teacher, term, entry):
+        return JsonResponse({"ok": False, "errors": ["You may not edit this entry"]}, status=403)
+
+    if data.get('modified') != entry.modified.isoformat():
+        return JsonResponse({
+            "ok": False,
+            "conflict": True,
+            "modified": entry.modified.isoformat(),
+            "fields": {name: getattr(entry, name + '_id' if name.endswith('choice') else name)
+                       for name in ENTRY_FIELDS},
+        }, status=409)
+
+    form = modelform_factory(ReportCardEntry, fields=list(fields))(
+        {name: '' if value is None else value for name, value in fields.items()}, instance=entry)
+    # Only the choices of the section's own schemes are valid, as on the editing pages
+    schemes = {'choice': entry.section.gradingscheme_id, 'second_choice': entry.section.second_gradingscheme_id}
+    for name, scheme_id in schemes.items():
+        if name in form.fields:
+            limit_choices(form.fields[name], scheme_id)
+    if not form.is_valid():
+        return JsonResponse({"ok": False, "errors": [error for errors in form.errors.values() for error in errors]},
+                            status=400)
+
+    was_completed = entry.completed
+    entry.check_completed()
+    with reversion.create_revision():
+        reversion.set_comment(f"Autosave entry {entry.id} by {request.user}")
+        reversion.set_user(request.user)
+        entry.save(update_fields=list(fields) + ['completed', 'modified'])
+        # As saving the edit page does: the teacher is done once every entry they may edit is completed
+        entries = ReportCardEntry.objects.filter(reportcard=entry.reportcard_id).only(
+            'id', 'section', 'subject', 'completed')
+        entry.reportcard.set_completed(teacher, all(
+            other.completed for other in entries if entry_editable(teacher, term, other)))
+    touch_reportcards([entry.reportcard_id])
+    if entry.completed != was_completed:
+        ReportCardCompletion.entry_completed_changed(entry)
+
+    return JsonResponse({
+        "ok": True,
+        "modified": entry.modified.isoformat(),
+        "completed": entry.completed,
+        "reportcard_completed": all(other.completed for other in entries),
+    })
+
+
 @user_passes_test(access_allowed)
 @transaction.atomic
 def edit_student(request, student_id, term_id):
@@ -1307,7 +1042,7 @@ def edit_student(request, student_id, term_id):
         return redirect(
             reverse('reportcard:view_student', args=[student.id, term.id]) + url_extra)
 
-    conflicting = ReportCardEditorTracking.conflicting_check(
+    conflicting = conflicting_check(
         user=request.user, students=[student],
         subjects=[subject for subject in subject_access if subject_access[subject]],
         edit_type='student')
@@ -1323,35 +1058,36 @@ def edit_student(request, student_id, term_id):
                                 queryset=ReportCardEntry.objects.filter(id__in=ok_ids))
 
         if formset.is_valid():
+            completion_changed = False
             for form in formset:
+                was_completed = form.instance.completed
                 form.instance.check_completed()
-                form.changed_data.append('completed')
+                if form.instance.completed != was_completed:
+                    completion_changed = True
+                    form.changed_data.append('completed')
 
+            # Only entries that changed are saved, so only they get versions
             with reversion.create_revision():
-                reversion.set_comment(f"Save student {student.id} {student.fullname} by {request.user}")
+                reversion.set_comment(f"Save student {student.id} {student.fullname} "
+                                      f"by {request.user}")
                 reversion.set_user(request.user)
-                formset.save()
+                changed = formset.save()
                 completed = reportcard.set_completed(
                     teacher, all([form.instance.completed for form in formset]))
-                reportcard.modified = datetime.datetime.now()
-                reversion.add_to_revision(reportcard)
-                reportcard.save()
+            if changed:
+                touch_reportcards([reportcard.id])
+            if completion_changed:
+                ReportCardCompletion.refresh([reportcard.id])
 
             if completed:
                 messages.success(request,
                                  'All fields have been filled in for %s.' %
                                  reportcard.student.fullname)
 
-            if request.GET.get('autosave', 0):
-                messages.warning(request,
-                                 'Your work on "%s" was automatically saved.' %
-                                 reportcard.student.fullname)
-                return redirect(reverse('reportcard:view_term', args=[term.id]) + url_extra)
-
             if 'save' in request.POST or 'save_review' in request.POST:
                 messages.info(request, 'Report card for %s saved' %
                               reportcard.student.fullname)
-                ReportCardEditorTracking.conflicting_clear(
+                conflicting_clear(
                     user=request.user, students=[student], subjects=subject_access)
                 if 'save_review' in request.POST:
                     return redirect(
@@ -1379,14 +1115,17 @@ def edit_student(request, student_id, term_id):
 
     subj_teacher = {}
     sect_teacher = {}
+    resolver = get_resolver(term)
 
     for section in template.sections:
-        teachers = Faculty.objects.filter(
-            reportcardaccess__sections=section
-        ).distinct()
+        section_teachers = []
+        for subject in section.subjects:
+            for teacher in resolver.teachers(student.id, subject):
+                if teacher not in section_teachers:
+                    section_teachers.append(teacher)
         sect_teacher[section] = {
-            "teachers": teachers.all(),
-            "num": teachers.count(),
+            "teachers": section_teachers,
+            "num": len(section_teachers),
         }
 
         for subject in section.subjects:
@@ -1394,37 +1133,23 @@ def edit_student(request, student_id, term_id):
             if subject not in element_to_form:
                 continue
 
-            teachers = Faculty.objects.filter(
-                Q(reportcardaccess__sections=section) |
-                Q(reportcardaccess__subjects__section=section)
-            ).distinct()
+            teachers = resolver.teachers(student.id, subject)
             subj_teacher[subject] = {
-                "teachers": teachers.all(),
-                "num": teachers.count(),
+                "teachers": teachers,
+                "num": len(teachers),
             }
 
             if subject.graded:
-                element_to_form[subject].fields['choice'].queryset = (
-                    GradingSchemeLevelChoice.objects.filter(
-                        gradingschemelevel__gradingscheme=section.gradingscheme).order_by(
-                        'sortorder'))
-                if section.second_gradingscheme:
-                    element_to_form[subject].fields['second_choice'].queryset = (
-                        GradingSchemeLevelChoice.objects.filter(
-                            gradingschemelevel__gradingscheme=section.second_gradingscheme).order_by(
-                            'sortorder'))
+                limit_choices(element_to_form[subject].fields['choice'], section.gradingscheme_id)
+                if section.second_gradingscheme_id:
+                    limit_choices(element_to_form[subject].fields['second_choice'], section.second_gradingscheme_id)
 
             for strand in subject.strands:
                 if strand in element_to_form:
-                    element_to_form[strand].fields['choice'].queryset = (
-                        GradingSchemeLevelChoice.objects.filter(
-                            gradingschemelevel__gradingscheme=section.gradingscheme).order_by(
-                            'sortorder'))
-                    if section.second_gradingscheme:
-                        element_to_form[strand].fields['second_choice'].queryset = (
-                            GradingSchemeLevelChoice.objects.filter(
-                                gradingschemelevel__gradingscheme=section.second_gradingscheme).order_by(
-                                'sortorder'))
+                    limit_choices(element_to_form[strand].fields['choice'], section.gradingscheme_id)
+                    if section.second_gradingscheme_id:
+                        limit_choices(element_to_form[strand].fields['second_choice'],
+                                      section.second_gradingscheme_id)
 
     return render(request, 'edit_student.html', dict(
         config=config,
@@ -1434,6 +1159,7 @@ def edit_student(request, student_id, term_id):
         term=term,
         template=template,
         formset=formset,
+        entry_versions=entry_versions(formset),
         element_to_form=element_to_form,
         request=request,
         section_access=section_access,
@@ -1467,16 +1193,17 @@ def access_for_template(template, teacher, term, student, entries):
     subject_access = {}
     ok_ids = []
     num_editable = 0
+    access = get_index(term)
+    teacher_subjects = access.subject_ids(teacher) if teacher else None
     for section in template.sections:
-        section_access[section] = section.may_edit(teacher)
+        section_access[section] = section.may_edit(teacher, term=term)
         if section_access[section]:
             ok_ids.append(entries[section].id)
             if section.comments_area:
                 num_editable += 1
 
-            teacher_subjects = term.subject_objs(teacher)
             for subject in section.subjects:
-                subject_access[subject] = subject in teacher_subjects
+                subject_access[subject] = teacher_subjects is None or subject.id in teacher_subjects
                 if subject_access[subject]:
                     if subject.graded or subject.comments_area:
                         num_editable += 1
@@ -1505,7 +1232,7 @@ def do_conflict_check_subject(request, subject_id, grade_id, term_id,
     term = get_object_or_404(ReportCardTerm, pk=term_id)
     grade = get_object_or_404(GradeLevel, pk=grade_id)
     subject = get_object_or_404(ReportCardSubject, pk=subject_id)
-    students = subject.students(grade=grade, teacher=teacher)
+    students = subject.students(grade=grade, teacher=teacher, term=term)
 
     # get/create report cards and find completed students
     ok_students = []
@@ -1516,11 +1243,11 @@ def do_conflict_check_subject(request, subject_id, grade_id, term_id,
             ok_students.append(student)
 
     if not clear:
-        conflicting = ReportCardEditorTracking.conflicting_check(
+        conflicting = conflicting_check(
             user=request.user, students=ok_students, subjects=[subject],
             edit_type='subject')
     else:
-        ReportCardEditorTracking.conflicting_clear(
+        conflicting_clear(
             user=request.user, students=ok_students, subjects=[subject])
         return
 
@@ -1593,7 +1320,7 @@ def edit_subject(request, subject_id, grade_id, term_id):
         messages.info(request, "Term is not open")
         return redirect(reverse('reportcard.view_term', args=[term.id]) + url_extra)
 
-    students = subject.students(grade=grade)
+    students = subject.students(grade=grade, term=term)
     if len(students) == 0:
         messages.warning(request,
                          'No students found for subject %s' %
@@ -1611,20 +1338,22 @@ def edit_subject(request, subject_id, grade_id, term_id):
 
     # get/create report cards and find completed students
     ok_students = []
+    reportcards = []
     for student in students:
         reportcard = ReportCard.objects.filter(student=student,
                                                term=term, template=template).first()
         if not reportcard:
             reportcard = ReportCard(student=student, term=term, template=template)
-            reportcard.save()
-        template.get_or_create_all_entries(reportcard)
         reportcard.save()
+        reportcards.append(reportcard)
         if not teacher:
             ok_students.append(student)
         elif reportcard.editable(teacher):
             ok_students.append(student)
+    # Only report cards whose template changed since their entries were completed need checking
+    template.ensure_entries(reportcards)
 
-    conflicting = ReportCardEditorTracking.conflicting_check(
+    conflicting = conflicting_check(
         user=request.user, students=ok_students, subjects=[subject],
         edit_type='subject')
     if conflicting:
@@ -1639,18 +1368,22 @@ def edit_subject(request, subject_id, grade_id, term_id):
         if formset.is_valid():
 
             seen_students = set()
+            completion_changed = set()
 
+            # Only entries that changed are saved, so only they get versions
             with reversion.create_revision():
                 reversion.set_comment(f"Save subject {subject.id} {subject.name} by {request.user}")
                 reversion.set_user(request.user)
                 for form in formset:
+                    was_completed = form.instance.completed
                     form.instance.check_completed()
-                    form.changed_data.append('completed')
+                    if form.instance.completed != was_completed:
+                        completion_changed.add(form.instance.reportcard_id)
+                        form.changed_data.append('completed')
                     seen_students.add(form.instance.reportcard.student)
-                    form.instance.reportcard.modified = datetime.datetime.now()
-                    reversion.add_to_revision(form.instance.reportcard)
-                    form.instance.reportcard.save()
-                formset.save()
+                changed = formset.save()
+            touch_reportcards({entry.reportcard_id for entry in changed})
+            ReportCardCompletion.refresh(completion_changed)
 
             for student in seen_students:
                 reportcard = ReportCard.objects.get(
@@ -1665,14 +1398,8 @@ def edit_subject(request, subject_id, grade_id, term_id):
             if is_reportcard_admin(request.user) and request.GET.get('teacher_id', False):
                 extra = '?teacher_id=%d' % teacher.id
 
-            if request.GET.get('autosave', 0):
-                messages.warning(request,
-                                 'Your work on "%s" was automatically saved.' %
-                                 subject)
-                return redirect(reverse('reportcard:view_term', args=[term.id]) + extra)
-
             if 'save_edit' not in request.POST:
-                ReportCardEditorTracking.conflicting_clear(
+                conflicting_clear(
                     user=request.user, students=ok_students, subjects=[subject])
                 return redirect(reverse('reportcard:view_term', args=[term.id]) + extra)
 
@@ -1688,15 +1415,9 @@ def edit_subject(request, subject_id, grade_id, term_id):
 
     for form in formset:
         section = form.instance.section
-        form.fields['choice'].queryset = (
-            GradingSchemeLevelChoice.objects.filter(
-                gradingschemelevel__gradingscheme=section.gradingscheme).order_by(
-                'sortorder'))
-        if section.second_gradingscheme:
-            form.fields['second_choice'].queryset = (
-                GradingSchemeLevelChoice.objects.filter(
-                    gradingschemelevel__gradingscheme=section.second_gradingscheme).order_by(
-                    'sortorder'))
+        limit_choices(form.fields['choice'], section.gradingscheme_id)
+        if section.second_gradingscheme_id:
+            limit_choices(form.fields['second_choice'], section.second_gradingscheme_id)
 
     instance_lookup = {form.instance: form for form in formset}
     instance_errors = {
@@ -1729,6 +1450,7 @@ def edit_subject(request, subject_id, grade_id, term_id):
         request=request,
         subject=subject,
         formset=formset,
+        entry_versions=entry_versions(formset),
         student_map=student_map,
         scheme='percentile' if subject.section.gradingscheme.percentile else 'choice',
         student_errors=student_errors,
@@ -0,0 +1,85 @@
+import json
+import os
+import queue
+import socketserver
+import time
+
+from django.core.management.base import BaseCommand
+
+from sis.studentdb.pdf_render import (SOCKET_PATH, STATUS_ERROR, STATUS_OK, PdfkitBackend, WkhtmltopdfProcess,
+                                      recv_message, send_message, worker_options)
+
+SAMPLE_HTML = "<html><body><h1>PDF render benchmark</h1>%s</body></html>" % ("<p>Lorem ipsum dolor sit amet.</p>" * 200)
+
+
+class RenderHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        job = json.loads(recv_message(self.request).decode('utf-8'))
+        engine = self.server.engines.get()
+        try:
+            pdf = engine.render(job['html'], job.get('header'), job.get('footer'), job.get('cover'),
+                                worker_options(job.get('options')))
+        except Exception as e:
+            self.request.sendall(STATUS_ERROR)
+            send_message(self.request, str(e).encode('utf-8'))
+        else:
+            self.request.sendall(STATUS_OK)
+            send_message(self.request, pdf)
+        finally:
+            self.server.engines.put(engine)
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = """
+    Run a long-lived PDF renderer for PDF_RENDER_BACKEND = 'worker'.
+    Keeps wkhtmltopdf processes running and takes jobs over a Unix socket.
+    With --benchmark, compare it with starting wkhtmltopdf for each document instead.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=SOCKET_PATH, help="Socket path")
+        parser.add_argument('--processes', type=int, default=2, help="Number of wkhtmltopdf processes")
+        parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                            help="Render a sample document N times with each engine and exit")
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            return self.benchmark(options['benchmark'])
+
+        engines = queue.Queue()
+        for _ in range(options['processes']):
+            engines.put(WkhtmltopdfProcess())
+
+        path = options['socket']
+        if os.path.exists(path):
+            os.remove(path)
+        # Only this user may connect: the socket is created without group or other permissions
+        umask = os.umask(0o177)
+        try:
+            server = RenderServer(path, RenderHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        server.engines = engines
+        self.stdout.write("Rendering PDFs on %s with %d processes" % (path, options['processes']))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+            while not engines.empty():
+                engines.get().stop()
+
+    def benchmark(self, count):
+        for name, engine in (('pdfkit', PdfkitBackend()), ('worker', WkhtmltopdfProcess())):
+            start = time.time()
+            for _ in range(count):
+                engine.render(SAMPLE_HTML, options={'encoding': 'UTF-8'})
+            elapsed = time.time() - start
+            self.stdout.write("%-8s %d documents in %.2fs (%.3fs each)" % (name, count, elapsed, elapsed / count))
+            if hasattr(engine, 'stop'):
+                engine.stop()
@@ -2,7 +2,6 @@ import csv
 from datetime import datetime, timedelta
 
 import django.forms
-import pdfkit
 from constance import config
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
@@ -16,6 +15,7 @@ from django.template.loader import render_to_string
 from django.utils.html import escape
 
 from sis.studentdb import google_geocode
+from sis.studentdb.pdf_render import render_pdf
 from sis.studentdb.models import (
     AfterschoolPackage, AfterschoolProgramAttendance, BeforeschoolProgramAttendance,
     FoodOrderEvent, GradeLevel, SchoolYear, Student, StudentClass)
@@ -607,7 +607,7 @@ def student_information_report(request):
         'zoom': 1,
     }
 
-    pdf = pdfkit.PDFKit(content, "string", options=options).to_pdf()
+    pdf = render_pdf(content, options=options)
 
     response = HttpResponse(pdf)
     response['Content-Type'] = 'application/pdf'
@@ -0,0 +1,352 @@
+"""HTML to PDF rendering.
+
+Everything that produces a PDF goes through render_pdf(), which hands the
+job to the configured backend:
+
+``pdfkit`` (the default)
+    Runs wkhtmltopdf once per document.
+
+``worker``
+    Sends the job over a Unix socket to a long-running renderer started with
+    ``manage.py pdf_render_worker``.  The worker keeps wkhtmltopdf processes
+    running between documents, so fonts and Qt are only loaded once.  If the
+    worker can't be reached the job is rendered with pdfkit instead.  The
+    socket is only open to the user running the worker, so run it as the
+    web server's user.  It only passes on the wkhtmltopdf options listed in
+    WORKER_OPTIONS; PDF_RENDER_WORKER_OPTIONS replaces that list.
+
+Set PDF_RENDER_BACKEND to choose, and PDF_RENDER_SOCKET for the socket path.
+"""
+import json
+import logging
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+
+import pdfkit
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+BACKEND = getattr(settings, 'PDF_RENDER_BACKEND', 'pdfkit')
+SOCKET_PATH = getattr(settings, 'PDF_RENDER_SOCKET', '/tmp/indysis-pdf-render.sock')
+WORKER_TIMEOUT = getattr(settings, 'PDF_RENDER_TIMEOUT', 120)
+WKHTMLTOPDF = getattr(settings, 'WKHTMLTOPDF_CMD', None)
+
+# The options the report card and student information PDFs use, and whether each takes a value.
+# header-html and footer-html are not here: the worker writes those files itself.
+WORKER_OPTIONS = getattr(settings, 'PDF_RENDER_WORKER_OPTIONS', {
+    'load-error-handling': True,
+    'page-size': True,
+    'margin-top': True,
+    'margin-left': True,
+    'margin-right': True,
+    'margin-bottom': True,
+    'encoding': True,
+    'no-outline': False,
+    'no-header-line': False,
+    'disable-smart-shrinking': False,
+    'zoom': True,
+    'dpi': True,
+    'quiet': False,
+})
+
+_HEADER = struct.Struct('!I')
+STATUS_OK = b'0'
+STATUS_ERROR = b'1'
+
+
+class RenderError(Exception):
+    """A document could not be rendered."""
+
+
+_pdfkit_configuration = None
+
+
+def _configuration():
+    """pdfkit configuration, located once rather than on every document."""
+    global _pdfkit_configuration
+    if _pdfkit_configuration is None:
+        if WKHTMLTOPDF:
+            _pdfkit_configuration = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF)
+        else:
+            _pdfkit_configuration = pdfkit.configuration()
+    return _pdfkit_configuration
+
+
+class PdfTempFiles(object):
+    """Write the header, footer and cover HTML of a job to temporary files.
+
+    Used as a context manager; the files are removed on exit.  options gains
+    the header-html and footer-html paths, and cover is the cover file path.
+    """
+
+    def __init__(self, html, header=None, footer=None, cover=None, options=None):
+        self.html = html
+        self.header = header
+        self.footer = footer
+        self.cover_html = cover
+        self.options = dict(options or {})
+        self.cover = None
+        self.files = []
+
+    def _write(self, content, suffix='.html'):
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as html:
+            html.write(content.encode('utf-8'))
+        self.files.append(html.name)
+        return html.name
+
+    def write_html(self):
+        """Also write the body to a file, for backends that can't take it on stdin."""
+        return self._write(self.html)
+
+    def output_path(self):
+        """A temporary file for the PDF."""
+        return self._write('', suffix='.pdf')
+
+    def __enter__(self):
+        try:
+            if self.header is not None:
+                self.options['header-html'] = self._write(self.header)
+            if self.footer is not None:
+                self.options['footer-html'] = self._write(self.footer)
+            if self.cover_html and self.cover_html.strip(" \r\n"):
+                self.cover = self._write(self.cover_html)
+        except Exception:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        for name in self.files:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        self.files = []
+
+
+class PdfkitBackend(object):
+    """Start wkhtmltopdf for each document."""
+
+    def render(self, html, header=None, footer=None, cover=None, options=None):
+        with PdfTempFiles(html, header, footer, cover, options) as job:
+            kwargs = dict(cover=job.cover) if job.cover else {}
+            return pdfkit.PDFKit(html, "string", options=job.options, configuration=_configuration(),
+                                 **kwargs).to_pdf()
+
+
+def option_args(options):
+    """wkhtmltopdf command line arguments for pdfkit style options."""
+    args = []
+    for key, value in options.items():
+        key = '--' + key.lstrip('-')
+        if key == '--quiet':
+            continue
+        args.append(key)
+        if value not in (None, ''):
+            args.append(str(value))
+    return args
+
+
+def worker_options(options):
+    """Check options sent to the worker against WORKER_OPTIONS.  Raises RenderError for any other."""
+    checked = {}
+    for key, value in (options or {}).items():
+        name = str(key).lstrip('-')
+        if name not in WORKER_OPTIONS:
+            raise RenderError("Option not allowed: %s" % key)
+        if WORKER_OPTIONS[name]:
+            # A value that looks like an option would be read as one
+            if not isinstance(value, (str, int, float)) or str(value).startswith('-'):
+                raise RenderError("Invalid value for %s" % key)
+        elif value not in (None, ''):
+            # A value after a flag would be read as another input document
+            raise RenderError("Option %s takes no value" % key)
+        checked[name] = value
+    return checked
+
+
+def _quote(arg):
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class WkhtmltopdfProcess(object):
+    """A long-running wkhtmltopdf that reads the arguments for each document from stdin.
+
+    Used by the pdf_render_worker command.  wkhtmltopdf reports each
+    finished document on stderr, which is how we know the PDF is ready.  A
+    document ends with a "Done" line, an "Exit with code" line or both, in
+    either order, so after the first of them we wait DRAIN_TIMEOUT seconds
+    for the other.  stderr is also drained before each document is sent, so
+    output from one document is never read as the end of the next.
+    """
+
+    DONE = b'Done'
+    EXIT = b'Exit with code'
+    DRAIN_TIMEOUT = 0.05
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or WORKER_TIMEOUT
+        self.process = None
+
+    def start(self):
+        wkhtmltopdf = _configuration().wkhtmltopdf
+        if isinstance(wkhtmltopdf, bytes):
+            wkhtmltopdf = wkhtmltopdf.decode('utf-8')
+        self.process = subprocess.Popen([wkhtmltopdf, '--read-args-from-stdin'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def _read(self, timeout):
+        """Read what stderr has within timeout seconds; b'' if nothing came or wkhtmltopdf exited."""
+        fd = self.process.stderr.fileno()
+        ready, _, _ = select.select([fd], [], [], timeout)
+        return os.read(fd, 4096) if ready else b''
+
+    @staticmethod
+    def _lines(output):
+        """The complete lines of output; progress bars are redrawn with carriage returns."""
+        return [line.strip() for line in re.split(br'[\r\n]', output)[:-1]]
+
+    def _seen(self, output):
+        lines = self._lines(output)
+        return {marker for marker in (self.DONE, self.EXIT) if any(line.startswith(marker) for line in lines)}
+
+    def _drain(self):
+        """Discard output left over from the previous document."""
+        output = b''
+        while True:
+            chunk = self._read(0)
+            if not chunk:
+                break
+            output += chunk
+        if output.strip():
+            logger.warning("Unexpected wkhtmltopdf output: %s", output.decode('utf-8', 'replace'))
+
+    def _wait(self):
+        """Read progress output until the current document is finished."""
+        output = b''
+        while not self._seen(output):
+            chunk = self._read(self.timeout)
+            if not chunk:
+                self.stop()
+                raise RenderError("wkhtmltopdf timed out or exited: %s" % output.decode('utf-8', 'replace'))
+            output += chunk
+        # The other closing line, if there is one, follows straight away
+        while len(self._seen(output)) < 2:
+            chunk = self._read(self.DRAIN_TIMEOUT)
+            if not chunk:
+                break
+            output += chunk
+        if self.EXIT in self._seen(output):
+            raise RenderError(output.decode('utf-8', 'replace'))
+
+    def render(self, html, header=None, footer=None, cover=None, options=None):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        with PdfTempFiles(html, header, footer, cover, options) as job:
+            args = option_args(job.options) + [job.write_html()]
+            if job.cover:
+                args += ['cover', job.cover]
+            output = job.output_path()
+            args.append(output)
+            self._drain()
+            self.process.stdin.write((' '.join(_quote(arg) for arg in args) + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+            self._wait()
+            with open(output, 'rb') as pdf:
+                return pdf.read()
+
+
+def send_message(sock, data):
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    size, = _HEADER.unpack(recv_exactly(sock, _HEADER.size))
+    return recv_exactly(sock, size)
+
+
+class WorkerBackend(object):
+    """Render through the pdf_render_worker process, falling back to pdfkit."""
+
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or SOCKET_PATH
+        self.timeout = timeout or WORKER_TIMEOUT
+        self.fallback = PdfkitBackend()
+
+    def render(self, html, header=None, footer=None, cover=None, options=None):
+        job = json.dumps(dict(html=html, header=header, footer=footer, cover=cover,
+                              options=options or {})).encode('utf-8')
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                send_message(sock, job)
+                status = recv_exactly(sock, 1)
+                result = recv_message(sock)
+        except (OSError, ConnectionError):
+            logger.warning("PDF render worker unavailable at %s, using pdfkit", self.socket_path, exc_info=True)
+            return self.fallback.render(html, header, footer, cover, options)
+
+        if status != STATUS_OK:
+            logger.warning("PDF render worker failed (%s), using pdfkit", result.decode('utf-8', 'replace'))
+            return self.fallback.render(html, header, footer, cover, options)
+        return result
+
+
+BACKENDS = {
+    'pdfkit': PdfkitBackend,
+    'worker': WorkerBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The configured rendering backend."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = BACKENDS[BACKEND]()
+        return _backend
+
+
+def set_backend(backend):
+    """Use a different backend, eg. to compare engines.  Returns the previous one."""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def render_pdf(html, header=None, footer=None, cover=None, options=None):
+    """Render HTML, with optional header, footer and cover page HTML, to PDF bytes.
+
+    options are wkhtmltopdf options as accepted by pdfkit.  Does not touch the
+    database, so it is safe to call from worker threads.
+    """
+    return get_backend().render(html, header=header, footer=footer, cover=cover, options=options)
@@ -12,3 +12,8 @@ DATABASES = {
 }
 
 from indy_sis.settings import *
+
+# Keep edit leases in process rather than in Redis
+REPORTCARD_LOCK_BACKEND = 'memory'
+# Generation numbers likewise
+REPORTCARD_SHARED_BACKEND = 'memory'